@@ -181,6 +181,25 @@ class PostProcessingOptions(BaseModel):
     )
 
 
+class ImageFormat(Enum):
+    PNG = "png"
+    JPEG = "jpeg"
+    WEBP = "webp"
+
+
+class ImageEncoding(BaseModel):
+    format: ImageFormat = Field(
+        description="output image format", default=ImageFormat.PNG
+    )
+    quality: int = Field(
+        description="jpeg and webp quality (ignored for png and lossless webp)",
+        default=90,
+        ge=1,
+        le=100,
+    )
+    lossless: bool = Field(description="lossless webp", default=False)
+
+
 class FaceSwapRequest(BaseModel):
     image: str = Field(
         description="base64 reference image",
@@ -189,6 +208,10 @@ class FaceSwapRequest(BaseModel):
     )
     units: List[FaceSwapUnit]
     postprocessing: Optional[PostProcessingOptions] = None
+    output: Optional[ImageEncoding] = Field(
+        description="output encoding, defaults to the webui samples format",
+        default=None,
+    )
 
 
 class FaceSwapResponse(BaseModel):
@@ -196,10 +219,47 @@ class FaceSwapResponse(BaseModel):
     infos: Optional[List[str]]  # not really used atm
 
     @property
-    def pil_images(self) -> Image.Image:
+    def pil_images(self) -> List[Image.Image]:
+        return [base64_to_pil(img) for img in self.images]
+
+
+class FaceSwapBatchRequest(BaseModel):
+    images: List[str] = Field(
+        description="base64 target images",
+        examples=[["data:image/jpeg;base64,/9j/4AAQSkZJRgABAQECWAJYAAD...."]],
+        default=None,
+    )
+    units: List[FaceSwapUnit]
+    postprocessing: Optional[PostProcessingOptions] = None
+    output: Optional[ImageEncoding] = Field(
+        description="output encoding, defaults to the webui samples format",
+        default=None,
+    )
+
+
+class FaceSwapBatchResult(BaseModel):
+    images: List[str] = Field(
+        description="base64 swapped images of one target", default=[]
+    )
+    error: Optional[str] = Field(
+        description="error message if this target failed", default=None
+    )
+
+    @property
+    def pil_images(self) -> List[Image.Image]:
         return [base64_to_pil(img) for img in self.images]
 
 
+class FaceSwapBatchResponse(BaseModel):
+    results: List[FaceSwapBatchResult] = Field(
+        description="one result per target image, in request order", default=[]
+    )
+
+
+class FaceSwapBatchStreamResult(FaceSwapBatchResult):
+    index: int = Field(description="index of the target image in the request")
+
+
 class FaceSwapCompareRequest(BaseModel):
     image1: str = Field(
         description="base64 reference image",
@@ -220,22 +280,60 @@ class FaceSwapExtractRequest(BaseModel):
         default=None,
     )
     postprocessing: Optional[PostProcessingOptions]
+    output: Optional[ImageEncoding] = Field(
+        description="output encoding, defaults to the webui samples format",
+        default=None,
+    )
 
 
 class FaceSwapExtractResponse(BaseModel):
     images: List[str] = Field(description="base64 face images", default=None)
 
     @property
-    def pil_images(self) -> Image.Image:
+    def pil_images(self) -> List[Image.Image]:
         return [base64_to_pil(img) for img in self.images]
 
 
-def pil_to_base64(img: Image.Image) -> np.array:  # type:ignore
+class FaceSwapExtractStreamResult(BaseModel):
+    index: int = Field(description="index of the image the face comes from")
+    image: Optional[str] = Field(description="base64 face image", default=None)
+    error: Optional[str] = Field(
+        description="error message if this image failed", default=None
+    )
+
+    @property
+    def pil_image(self) -> Optional[Image.Image]:
+        return base64_to_pil(self.image) if self.image else None
+
+
+class FaceSwapJobStatus(Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+class FaceSwapJob(BaseModel):
+    id: str = Field(description="job id")
+    status: FaceSwapJobStatus = Field(description="job status")
+    progress: float = Field(description="progress (0 to 1)", default=0)
+    error: Optional[str] = Field(description="error message if failed", default=None)
+    created: float = Field(description="submission time (unix timestamp)")
+    started: Optional[float] = Field(
+        description="start time (unix timestamp)", default=None
+    )
+    finished: Optional[float] = Field(
+        description="end time (unix timestamp)", default=None
+    )
+
+
+def pil_to_base64(img: Image.Image, format: str = "PNG", **save_options) -> np.array:  # type: ignore
     if isinstance(img, str):
         img = Image.open(img)
 
     buffer = BytesIO()
-    img.save(buffer, format="PNG")
+    img.save(buffer, format=format, **save_options)
     img_data = buffer.getvalue()
     base64_data = base64.b64encode(img_data)
     return base64_data.decode("utf-8")
@@ -8,3 +8,8 @@ def preload(parser: ArgumentParser) -> None:
         choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
         help="Set the log level (DEBUG, INFO, WARNING, ERROR, CRITICAL)",
     )
+    parser.add_argument(
+        "--faceswaplab_preload",
+        action="store_true",
+        help="Load and warm up faceswaplab models in background when the server starts",
+    )
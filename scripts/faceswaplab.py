@@ -10,9 +10,9 @@ from scripts import faceswaplab_globals
 from scripts.faceswaplab_api import faceswaplab_api
 from scripts.faceswaplab_postprocessing import upscaling
 from scripts.faceswaplab_settings import faceswaplab_settings
-from scripts.faceswaplab_swapping import swapper
+from scripts.faceswaplab_swapping import preloader, swapper
 from scripts.faceswaplab_ui import faceswaplab_tab, faceswaplab_unit_ui
-from scripts.faceswaplab_utils import faceswaplab_logging, imgutils, models_utils
+from scripts.faceswaplab_utils import faceswaplab_logging, imgutils, models_utils, nsfw
 from scripts.faceswaplab_utils.models_utils import get_current_swap_model
 from scripts.faceswaplab_utils.typing import *
 from scripts.faceswaplab_utils.ui_utils import dataclasses_from_flat_list
@@ -65,6 +65,7 @@ try:
     import modules.script_callbacks as script_callbacks
 
     script_callbacks.on_app_started(faceswaplab_api.faceswaplab_api)
+    script_callbacks.on_app_started(preloader.start_preloader)
 except:
     logger.error("Failed to register API")
 
@@ -182,17 +183,16 @@ class FaceSwapScript(scripts.Script):
                 images = []
                 infotexts = []
                 if (len(self.swap_in_generated_units)) > 0:
+                    # Check the whole batch in one pass, the units read the cached verdicts
+                    nsfw.check_against_nsfw_batch(orig_images)
                     for i, (img, info) in enumerate(zip(orig_images, orig_infotexts)):
                         batch_index = i % p.batch_size
-                        swapped_images = swapper.process_images_units(
+                        # Each swapped image is saved as soon as it is produced
+                        swapped_images = swapper.iter_process_images_units(
                             get_current_swap_model(),
                             self.swap_in_generated_units,
                             images=[(img, info)],
                         )
-                        if swapped_images is None:
-                            continue
-
-                        logger.info(f"{len(swapped_images)} images swapped")
                         for swp_img, new_info in swapped_images:
                             img = swp_img  # Will only swap the last image in the batch in next units (FIXME : hard to fix properly but not really critical)
 
@@ -1,27 +1,62 @@
+import base64
+import json
 import tempfile
+import uuid
 from PIL import Image
 import numpy as np
-from fastapi import FastAPI
+from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, ValidationError
 from modules.api import api
 from client_api.api_utils import (
     FaceSwapResponse,
 )
 from scripts.faceswaplab_globals import VERSION_FLAG
 import gradio as gr
-from typing import Dict, List, Optional, Union
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+    Union,
+)
+from scripts.faceswaplab_api.inference_executor import (
+    ANALYSIS,
+    BUILD,
+    SWAP,
+    ExecutorBusy,
+    get_inference_executor,
+)
+from scripts.faceswaplab_api.jobs import JobStore, JobWorkers
 from scripts.faceswaplab_swapping import swapper
+from scripts.faceswaplab_swapping.preloader import PRELOAD_STATE
 from scripts.faceswaplab_ui.faceswaplab_unit_settings import FaceSwapUnitSettings
 from scripts.faceswaplab_utils.imgutils import (
+    IMAGE_MEDIA_TYPES,
+    as_pil,
     base64_to_pil,
+    bytes_to_cv2,
+    encode_image,
 )
 from scripts.faceswaplab_postprocessing.postprocessing_options import (
     PostProcessingOptions,
 )
 from client_api import api_utils
+from scripts.faceswaplab_swapping import face_checkpoints
 from scripts.faceswaplab_swapping.face_checkpoints import (
     build_face_checkpoint_and_save,
 )
-from scripts.faceswaplab_utils.typing import PILImage
+from scripts.faceswaplab_utils import nsfw
+from scripts.faceswaplab_utils.faceswaplab_logging import logger
+from scripts.faceswaplab_utils.sd_utils import get_sd_option
+from scripts.faceswaplab_utils.typing import AnyImage, PILImage
 
 
 def encode_to_base64(image: Union[str, Image.Image, np.ndarray]) -> str:  # type: ignore
@@ -62,6 +97,55 @@ def encode_np_to_base64(image: np.ndarray) -> str:  # type: ignore
     return api.encode_pil_to_base64(pil)
 
 
+def encode_output(image: PILImage, output: Optional[api_utils.ImageEncoding]) -> bytes:
+    """
+    Encode an image with the requested output encoding (png if None).
+    """
+    output = output or api_utils.ImageEncoding()
+    return encode_image(
+        image,
+        format=output.format.value,
+        quality=output.quality,
+        lossless=output.lossless,
+    )
+
+
+def encode_output_to_base64(
+    image: PILImage, output: Optional[api_utils.ImageEncoding]
+) -> str:
+    """
+    Encode an image to base64 with the requested output encoding, or like the webui if None.
+    """
+    if output is None:
+        return encode_to_base64(image)
+    return base64.b64encode(encode_output(image, output)).decode("utf-8")
+
+
+def multipart_response(parts: List[Tuple[bytes, str]]) -> Response:
+    """
+    Build a multipart/mixed response, one part per (content, media type).
+    """
+    boundary = uuid.uuid4().hex
+    body = b"".join(
+        f"--{boundary}\r\nContent-Type: {media_type}\r\n\r\n".encode()
+        + content
+        + b"\r\n"
+        for content, media_type in parts
+    )
+    body += f"--{boundary}--\r\n".encode()
+    return Response(content=body, media_type=f"multipart/mixed; boundary={boundary}")
+
+
+def parse_form_request(model: Any, data: Optional[str]) -> Any:
+    """
+    Parse the json request sent in a multipart form field, answer 422 if it is not valid.
+    """
+    try:
+        return model.parse_raw(data or "{}")
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
 def get_faceswap_units_settings(
     api_units: List[api_utils.FaceSwapUnit],
 ) -> List[FaceSwapUnitSettings]:
@@ -71,7 +155,247 @@ def get_faceswap_units_settings(
     return units
 
 
+T = TypeVar("T")
+
+
+async def run_inference(
+    endpoint_class: str, func: Callable[..., T], *args: Any, **kwargs: Any
+) -> T:
+    """
+    Run blocking work on the inference executor, answer 429 with Retry-After if it is full.
+    """
+    try:
+        return await get_inference_executor().run(endpoint_class, func, *args, **kwargs)
+    except ExecutorBusy as e:
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
+
+def process_swap_request(
+    request: api_utils.FaceSwapRequest,
+    monitor: Optional[swapper.ProcessingMonitor] = None,
+) -> api_utils.FaceSwapResponse:
+    """
+    Run a swap request (used by /faceswaplab/swap_face and by jobs).
+    """
+    src_image: Optional[Image.Image] = base64_to_pil(request.image)
+    response = FaceSwapResponse(images=[], infos=[])
+
+    if src_image is not None:
+        units = get_faceswap_units_settings(request.units)
+        for img in swap_request_images(request, src_image, units, monitor=monitor):
+            response.images.append(encode_output_to_base64(img, request.output))
+
+        response.infos = []  # Not used atm
+    return response
+
+
+def swap_request_images(
+    request: api_utils.FaceSwapRequest,
+    src_image: AnyImage,
+    units: List[FaceSwapUnitSettings],
+    monitor: Optional[swapper.ProcessingMonitor] = None,
+) -> List[PILImage]:
+    if request.postprocessing:
+        pp_options = PostProcessingOptions.from_api_dto(request.postprocessing)
+    else:
+        pp_options = None
+
+    swapped_images: Optional[List[PILImage]] = swapper.batch_process(
+        [src_image],
+        None,
+        units=units,
+        postprocess_options=pp_options,
+        monitor=monitor,
+    )
+    if swapped_images is None:
+        # batch_process logs the cause
+        raise RuntimeError(
+            "Swap failed (no enabled unit or processing error), check the server logs"
+        )
+    return swapped_images
+
+
+def process_swap_binary_request(
+    request: api_utils.FaceSwapRequest, image: bytes, sources: List[bytes]
+) -> Response:
+    """
+    Run a swap request whose target (and optionally sources) are sent as files, return the first
+    swapped image as raw bytes.
+    """
+    try:
+        # Decoded once with OpenCV, the swap works on the BGR buffer
+        src_image = bytes_to_cv2(image)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    units = get_faceswap_units_settings(request.units)
+    for unit, source in zip(units, sources):
+        unit.source_img = source
+    images = swap_request_images(request, src_image, units)
+    if not images:
+        raise HTTPException(
+            status_code=500, detail="Swap failed, check the server logs"
+        )
+    output = request.output or api_utils.ImageEncoding()
+    return Response(
+        content=encode_output(images[0], output),
+        media_type=IMAGE_MEDIA_TYPES[output.format.value],
+    )
+
+
+def extract_request_images(
+    request: api_utils.FaceSwapExtractRequest, images: Sequence[AnyImage]
+) -> List[PILImage]:
+    pp_options = None
+    if request.postprocessing:
+        pp_options = PostProcessingOptions.from_api_dto(request.postprocessing)
+    return swapper.extract_faces(
+        images, extract_path=None, postprocess_options=pp_options
+    )
+
+
+def iter_swap_batch_request(
+    request: api_utils.FaceSwapBatchRequest,
+) -> Iterator[api_utils.FaceSwapBatchStreamResult]:
+    """
+    Swap the same units into several target images, yield the result of each target in request
+    order as soon as it is encoded.
+
+    Units and their source faces are resolved once for the whole batch. Targets go through the
+    batch pipeline (swapper.iter_batch_pipeline) : they are decoded ahead and results encoded while
+    the next target is swapped. An error on one target is reported in its result and does not stop
+    the batch.
+    """
+    units = [u for u in get_faceswap_units_settings(request.units) if u.enable]
+    try:
+        for unit in units:
+            unit.prepare_sources()
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid source : {e}")
+
+    pp_options = None
+    if request.postprocessing:
+        pp_options = PostProcessingOptions.from_api_dto(request.postprocessing)
+
+    def decode(base64_image: str) -> Image.Image:
+        image = base64_to_pil(base64_image)
+        if image is None:
+            raise ValueError("Missing image")
+        image.load()
+        return image
+
+    def encode(item: swapper.BatchItem) -> str:
+        assert item.image
+        return encode_output_to_base64(as_pil(item.image), request.output)
+
+    # Swapped images of a target come as separate results, the last one is flagged
+    target = api_utils.FaceSwapBatchStreamResult(index=0)
+    for result in swapper.iter_batch_pipeline(
+        request.images or [],
+        units,
+        pp_options,
+        decode=decode,
+        encode=encode,
+    ):
+        target.index = result.index
+        if result.error is not None:
+            logger.error(
+                "Batch swap failed on image %s : %s", result.index, result.error
+            )
+            target.error = str(result.error)
+        elif not result.empty:
+            target.images.append(result.value.output)
+        if result.last:
+            yield target
+            target = api_utils.FaceSwapBatchStreamResult(index=result.index + 1)
+
+
+def process_swap_batch_request(
+    request: api_utils.FaceSwapBatchRequest,
+) -> api_utils.FaceSwapBatchResponse:
+    """
+    Swap the same units into several target images (see iter_swap_batch_request).
+    """
+    return api_utils.FaceSwapBatchResponse(
+        results=[
+            api_utils.FaceSwapBatchResult(images=result.images, error=result.error)
+            for result in iter_swap_batch_request(request)
+        ]
+    )
+
+
+def iter_extract_request(
+    request: api_utils.FaceSwapExtractRequest,
+) -> Iterator[api_utils.FaceSwapExtractStreamResult]:
+    """
+    Extract the faces of each image, yield each face as soon as it is encoded. An error on one
+    image is reported in a result and does not stop the extraction.
+    """
+    pp_options = None
+    if request.postprocessing:
+        pp_options = PostProcessingOptions.from_api_dto(request.postprocessing)
+    for i, base64_image in enumerate(request.images or []):
+        try:
+            image = base64_to_pil(base64_image)
+            if image is None:
+                raise ValueError("Missing image")
+            for face in swapper.iter_extract_faces([image], None, pp_options):
+                yield api_utils.FaceSwapExtractStreamResult(
+                    index=i, image=encode_output_to_base64(face, request.output)
+                )
+        except Exception as e:
+            logger.error("Extract failed on image %s : %s", i, e)
+            yield api_utils.FaceSwapExtractStreamResult(index=i, error=str(e))
+
+
+def stream_inference(
+    endpoint_class: str, func: Callable[..., Iterable[BaseModel]], *args: Any
+) -> StreamingResponse:
+    """
+    Stream the records of func as NDJSON (one json record per line) while they are produced on
+    the inference executor, answer 429 with Retry-After if it is full.
+
+    If the request fails once the response is started, the last line is {"error": "..."}.
+    """
+    try:
+        records = get_inference_executor().stream(
+            endpoint_class,
+            func,
+            *args,
+            max_pending=int(get_sd_option("faceswaplab_api_stream_buffer", 2)),
+        )
+    except ExecutorBusy as e:
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
+    async def lines() -> AsyncIterator[str]:
+        try:
+            async for record in records:
+                yield record.json() + "\n"
+        except Exception as e:
+            logger.error("Stream failed : %s", e)
+            error = e.detail if isinstance(e, HTTPException) else str(e)
+            yield json.dumps({"error": error}) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
 def faceswaplab_api(_: gr.Blocks, app: FastAPI) -> None:
+    job_store = JobStore()
+    # Jobs go through the inference executor, so that they count against its limits
+    JobWorkers(
+        job_store,
+        handler=lambda request, monitor: get_inference_executor().call(
+            SWAP, process_swap_request, request, monitor
+        ),
+    ).start(int(get_sd_option("faceswaplab_jobs_workers", 1)))
+
     @app.get(
         "/faceswaplab/version",
         tags=["faceswaplab"],
@@ -80,6 +404,37 @@ def faceswaplab_api(_: gr.Blocks, app: FastAPI) -> None:
     async def version() -> Dict[str, str]:
         return {"version": VERSION_FLAG}
 
+    @app.get(
+        "/faceswaplab/ready",
+        tags=["faceswaplab"],
+        description="Readiness probe : 200 when models are preloaded and warm (or preloading is disabled), 503 while loading or if preloading failed",
+    )
+    async def ready() -> JSONResponse:
+        status_code = 200 if PRELOAD_STATE.status in ("ready", "disabled") else 503
+        return JSONResponse(
+            status_code=status_code,
+            content={
+                "status": PRELOAD_STATE.status,
+                "error": PRELOAD_STATE.error,
+                "timings": PRELOAD_STATE.timings,
+            },
+        )
+
+    @app.get(
+        "/faceswaplab/stats",
+        tags=["faceswaplab"],
+        description="Get faceswaplab caches statistics (hits, misses, size)",
+    )
+    async def stats() -> Dict[str, Dict[str, Union[int, float]]]:
+        return {
+            "executor": get_inference_executor().stats(),
+            "detection": swapper.DETECTION_CACHE.stats(),
+            "source_faces": swapper.SOURCE_FACES_CACHE.stats(),
+            "checkpoints": face_checkpoints.CHECKPOINT_CACHE.stats(),
+            "nsfw": nsfw.NSFW_CACHE.stats(),
+            "batch_pipeline": swapper.BATCH_PIPELINE_STATS,
+        }
+
     # use post as we consider the method non idempotent (which is debatable)
     @app.post(
         "/faceswaplab/swap_face",
@@ -89,26 +444,73 @@ def faceswaplab_api(_: gr.Blocks, app: FastAPI) -> None:
     async def swap_face(
         request: api_utils.FaceSwapRequest,
     ) -> api_utils.FaceSwapResponse:
-        units: List[FaceSwapUnitSettings] = []
-        src_image: Optional[Image.Image] = base64_to_pil(request.image)
-        response = FaceSwapResponse(images=[], infos=[])
-
-        if src_image is not None:
-            if request.postprocessing:
-                pp_options = PostProcessingOptions.from_api_dto(request.postprocessing)
-            else:
-                pp_options = None
-            units = get_faceswap_units_settings(request.units)
-
-            swapped_images: Optional[List[PILImage]] = swapper.batch_process(
-                [src_image], None, units=units, postprocess_options=pp_options
-            )
+        return await run_inference(SWAP, process_swap_request, request)
 
-            for img in swapped_images:
-                response.images.append(encode_to_base64(img))
+    @app.post(
+        "/faceswaplab/swap_faces",
+        tags=["faceswaplab"],
+        description="Swap faces in several images using the same units. Results are in request order, with an error per failed image",
+    )
+    async def swap_faces(
+        request: api_utils.FaceSwapBatchRequest,
+    ) -> api_utils.FaceSwapBatchResponse:
+        return await run_inference(SWAP, process_swap_batch_request, request)
 
-            response.infos = []  # Not used atm
-        return response
+    @app.post(
+        "/faceswaplab/swap_faces/stream",
+        tags=["faceswaplab"],
+        description="Like /faceswaplab/swap_faces, but stream the results as NDJSON (one FaceSwapBatchStreamResult per line, in request order) as soon as each image is swapped",
+        response_class=StreamingResponse,
+    )
+    async def swap_faces_stream(
+        request: api_utils.FaceSwapBatchRequest,
+    ) -> StreamingResponse:
+        return stream_inference(SWAP, iter_swap_batch_request, request)
+
+    @app.post(
+        "/faceswaplab/jobs",
+        tags=["faceswaplab"],
+        description="Submit a swap request as a job, poll it with GET /faceswaplab/jobs/{job_id}",
+    )
+    async def submit_job(request: api_utils.FaceSwapRequest) -> api_utils.FaceSwapJob:
+        return job_store.submit(request)
+
+    def get_job_or_404(job_id: str) -> api_utils.FaceSwapJob:
+        job = job_store.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+        return job
+
+    @app.get(
+        "/faceswaplab/jobs/{job_id}",
+        tags=["faceswaplab"],
+        description="Get the status and progress of a job",
+    )
+    async def get_job(job_id: str) -> api_utils.FaceSwapJob:
+        return get_job_or_404(job_id)
+
+    @app.delete(
+        "/faceswaplab/jobs/{job_id}",
+        tags=["faceswaplab"],
+        description="Cancel a job. A running job stops at the next image or unit",
+    )
+    async def cancel_job(job_id: str) -> api_utils.FaceSwapJob:
+        get_job_or_404(job_id)
+        return job_store.cancel(job_id)
+
+    @app.get(
+        "/faceswaplab/jobs/{job_id}/result",
+        tags=["faceswaplab"],
+        description="Get the result of a done job (409 if the job is not done)",
+    )
+    async def get_job_result(job_id: str) -> api_utils.FaceSwapResponse:
+        job = get_job_or_404(job_id)
+        result = job_store.get_result(job_id)
+        if job.status != api_utils.FaceSwapJobStatus.DONE or result is None:
+            raise HTTPException(
+                status_code=409, detail=f"Job {job_id} is {job.status.value}"
+            )
+        return result
 
     @app.post(
         "/faceswaplab/compare",
@@ -118,8 +520,11 @@ def faceswaplab_api(_: gr.Blocks, app: FastAPI) -> None:
     async def compare(
         request: api_utils.FaceSwapCompareRequest,
     ) -> float:
-        return swapper.compare_faces(
-            base64_to_pil(request.image1), base64_to_pil(request.image2)
+        return await run_inference(
+            ANALYSIS,
+            lambda: swapper.compare_faces(
+                base64_to_pil(request.image1), base64_to_pil(request.image2)
+            ),
         )
 
     @app.post(
@@ -130,23 +535,102 @@ def faceswaplab_api(_: gr.Blocks, app: FastAPI) -> None:
     async def extract(
         request: api_utils.FaceSwapExtractRequest,
     ) -> api_utils.FaceSwapExtractResponse:
-        pp_options = None
-        if request.postprocessing:
-            pp_options = PostProcessingOptions.from_api_dto(request.postprocessing)
+        return await run_inference(ANALYSIS, process_extract, request)
+
+    def process_extract(
+        request: api_utils.FaceSwapExtractRequest,
+    ) -> api_utils.FaceSwapExtractResponse:
         images = [base64_to_pil(img) for img in request.images]
-        faces = swapper.extract_faces(
-            images, extract_path=None, postprocess_options=pp_options
-        )
-        result_images = [encode_to_base64(img) for img in faces]
+        faces = extract_request_images(request, images)
+        result_images = [encode_output_to_base64(img, request.output) for img in faces]
         response = api_utils.FaceSwapExtractResponse(images=result_images)
         return response
 
+    @app.post(
+        "/faceswaplab/extract/stream",
+        tags=["faceswaplab"],
+        description="Like /faceswaplab/extract, but stream the faces as NDJSON (one FaceSwapExtractStreamResult per line) as soon as each face is extracted",
+        response_class=StreamingResponse,
+    )
+    async def extract_stream(
+        request: api_utils.FaceSwapExtractRequest,
+    ) -> StreamingResponse:
+        return stream_inference(ANALYSIS, iter_extract_request, request)
+
+    @app.post(
+        "/faceswaplab/swap_face/binary",
+        tags=["faceswaplab"],
+        description="Swap a face in an image file using units. request is a FaceSwapRequest json without image. sources are optional source image files, one per unit in unit order (replace source_img). Returns the swapped image file",
+        response_class=Response,
+    )
+    async def swap_face_binary(
+        image: UploadFile = File(...),
+        request: str = Form(...),
+        sources: List[UploadFile] = File(default=[]),
+    ) -> Response:
+        swap_request = parse_form_request(api_utils.FaceSwapRequest, request)
+        image_data = await image.read()
+        sources_data = [await source.read() for source in sources]
+        return await run_inference(
+            SWAP, process_swap_binary_request, swap_request, image_data, sources_data
+        )
+
+    @app.post(
+        "/faceswaplab/compare/binary",
+        tags=["faceswaplab"],
+        description="Compare first face of two image files",
+    )
+    async def compare_binary(
+        image1: UploadFile = File(...), image2: UploadFile = File(...)
+    ) -> float:
+        image1_data = await image1.read()
+        image2_data = await image2.read()
+
+        def process_compare() -> float:
+            try:
+                img1, img2 = bytes_to_cv2(image1_data), bytes_to_cv2(image2_data)
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=str(e))
+            return swapper.compare_faces(img1, img2)
+
+        return await run_inference(ANALYSIS, process_compare)
+
+    @app.post(
+        "/faceswaplab/extract/binary",
+        tags=["faceswaplab"],
+        description="Extract faces of image files. request is an optional FaceSwapExtractRequest json without images. Returns a multipart/mixed response with one part per face",
+        response_class=Response,
+    )
+    async def extract_binary(
+        images: List[UploadFile] = File(...),
+        request: Optional[str] = Form(default=None),
+    ) -> Response:
+        extract_request = parse_form_request(api_utils.FaceSwapExtractRequest, request)
+        images_data = [await image.read() for image in images]
+
+        def process_extract_binary() -> Response:
+            try:
+                cv2_images = [bytes_to_cv2(data) for data in images_data]
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=str(e))
+            output = extract_request.output or api_utils.ImageEncoding()
+            media_type = IMAGE_MEDIA_TYPES[output.format.value]
+            faces = extract_request_images(extract_request, cv2_images) or []
+            return multipart_response(
+                [(encode_output(face, output), media_type) for face in faces]
+            )
+
+        return await run_inference(ANALYSIS, process_extract_binary)
+
     @app.post(
         "/faceswaplab/build",
         tags=["faceswaplab"],
         description="Build a face checkpoint using base64 images, return base64 satetensors",
     )
     async def build(base64_images: List[str]) -> Optional[str]:
+        return await run_inference(BUILD, process_build, base64_images)
+
+    def process_build(base64_images: List[str]) -> Optional[str]:
         if len(base64_images) > 0:
             pil_images = [base64_to_pil(img) for img in base64_images]
             with tempfile.NamedTemporaryFile(
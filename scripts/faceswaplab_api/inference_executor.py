@@ -0,0 +1,282 @@
+import asyncio
+import functools
+import math
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterable,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
+
+from scripts.faceswaplab_utils.faceswaplab_logging import logger
+from scripts.faceswaplab_utils.sd_utils import get_sd_option
+
+T = TypeVar("T")
+
+# Endpoint classes, each one with its own concurrency limit (faceswaplab_api_limit_<class>)
+SWAP = "swap"
+ANALYSIS = "analysis"
+BUILD = "build"
+
+# Messages sent by a stream producer to its consumer
+_ITEM = "item"
+_END = "end"
+_ERROR = "error"
+
+
+class ExecutorBusy(Exception):
+    """
+    Raised when a request can not be admitted. The API answers 429 with a Retry-After header.
+    """
+
+    def __init__(self, message: str, retry_after: int) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class InferenceExecutor:
+    """
+    Run blocking inference work out of the event loop, on a dedicated thread pool.
+
+    A request is admitted if the number of admitted requests (running or waiting for a worker) is
+    lower than workers + queue size, and if its endpoint class is under its own limit, so that a
+    flood of one kind of request (build for instance) can not take all the slots. Otherwise
+    ExecutorBusy is raised immediately instead of letting requests pile up.
+    """
+
+    def __init__(self, workers: int, queue_size: int, limits: Dict[str, int]) -> None:
+        """
+        Args:
+            workers (int): Number of inference threads.
+            queue_size (int): Number of admitted requests that can wait for a worker.
+            limits (Dict[str, int]): Max admitted requests per endpoint class (0 = no limit).
+        """
+        self.workers = workers
+        self.capacity = workers + queue_size
+        self.limits = limits
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="faceswaplab_inference"
+        )
+        self._lock = threading.Lock()
+        # Notified when a request releases its slot (see call)
+        self._released = threading.Condition(self._lock)
+        self._admitted: Dict[str, int] = {}
+        self.rejected = 0
+        # Moving average of the task duration, used to compute Retry-After
+        self._mean_duration = 1.0
+
+    @property
+    def admitted(self) -> int:
+        return sum(self._admitted.values())
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self._mean_duration * self.admitted / self.workers))
+
+    def _admit(self, endpoint_class: str, wait: bool = False) -> None:
+        with self._lock:
+            while True:
+                limit = self.limits.get(endpoint_class, 0)
+                count = self._admitted.get(endpoint_class, 0)
+                if self.admitted >= self.capacity:
+                    message = "Too many requests in queue"
+                elif limit and count >= limit:
+                    message = f"Too many {endpoint_class} requests in queue"
+                else:
+                    self._admitted[endpoint_class] = count + 1
+                    return
+                if not wait:
+                    break
+                self._released.wait()
+            self.rejected += 1
+        raise ExecutorBusy(message, self.retry_after())
+
+    def _release(self, endpoint_class: str) -> None:
+        with self._lock:
+            self._admitted[endpoint_class] -= 1
+            self._released.notify_all()
+
+    def _timed(self, func: Callable[[], T]) -> T:
+        start = time.perf_counter()
+        try:
+            return func()
+        finally:
+            duration = time.perf_counter() - start
+            self._mean_duration = 0.8 * self._mean_duration + 0.2 * duration
+
+    async def run(
+        self, endpoint_class: str, func: Callable[..., T], *args: Any, **kwargs: Any
+    ) -> T:
+        """
+        Run func(*args, **kwargs) on the inference threads and wait for the result without
+        blocking the event loop.
+
+        Raises:
+            ExecutorBusy: If the request can not be admitted.
+        """
+        self._admit(endpoint_class)
+        try:
+            future = self._executor.submit(
+                self._timed, functools.partial(func, *args, **kwargs)
+            )
+        except Exception:
+            self._release(endpoint_class)
+            raise
+        # Released when the work is done, even if the client went away before
+        future.add_done_callback(lambda _: self._release(endpoint_class))
+        return await asyncio.wrap_future(future)
+
+    def call(
+        self, endpoint_class: str, func: Callable[..., T], *args: Any, **kwargs: Any
+    ) -> T:
+        """
+        Run func(*args, **kwargs) on the inference threads and wait for the result, from a thread
+        that is not the event loop (job workers).
+
+        Unlike run, a request that can not be admitted waits for a slot instead of being
+        rejected : the caller is already a queue.
+        """
+        self._admit(endpoint_class, wait=True)
+        try:
+            future = self._executor.submit(
+                self._timed, functools.partial(func, *args, **kwargs)
+            )
+        except Exception:
+            self._release(endpoint_class)
+            raise
+        future.add_done_callback(lambda _: self._release(endpoint_class))
+        return future.result()
+
+    def stream(
+        self,
+        endpoint_class: str,
+        func: Callable[..., Iterable[T]],
+        *args: Any,
+        max_pending: int = 2,
+        **kwargs: Any,
+    ) -> AsyncIterator[T]:
+        """
+        Iterate func(*args, **kwargs) on the inference threads and return an async iterator over
+        its items, for streaming responses.
+
+        At most max_pending items wait for the consumer : the producer is paused until the
+        consumer takes the next one, so a slow client slows down production instead of filling
+        memory. If the consumer stops (client disconnected), the producer stops at the next item
+        and the iterable is closed. The producer starts when the iterator is first iterated. The
+        request holds its slot until the producer stops, or until the iterator is garbage
+        collected if it was never iterated.
+
+        Raises:
+            ExecutorBusy: Immediately, if the request can not be admitted.
+        """
+        self._admit(endpoint_class)
+        loop = asyncio.get_running_loop()
+        items: asyncio.Queue[Tuple[str, Any]] = asyncio.Queue()
+        slots = threading.Semaphore(max_pending)
+        stopped = threading.Event()
+        started = threading.Event()
+        released = threading.Event()
+
+        def release() -> None:
+            # Called by the producer when it stops, or when the iterator is dropped unused
+            if not released.is_set():
+                released.set()
+                self._release(endpoint_class)
+
+        def send(message: Tuple[str, Any]) -> None:
+            try:
+                loop.call_soon_threadsafe(items.put_nowait, message)
+            except RuntimeError:
+                # Event loop closed (server shutdown)
+                stopped.set()
+
+        def produce() -> None:
+            iterator = iter(func(*args, **kwargs))
+            try:
+                for item in iterator:
+                    while not slots.acquire(timeout=0.5):
+                        if stopped.is_set():
+                            return
+                    if stopped.is_set():
+                        return
+                    send((_ITEM, item))
+                send((_END, None))
+            except Exception as e:
+                send((_ERROR, e))
+            finally:
+                close = getattr(iterator, "close", None)
+                if close:
+                    close()
+
+        async def consume() -> AsyncIterator[T]:
+            # The producer starts with the iteration : a response that is never iterated (client
+            # gone before the stream started) does not leave a producer blocked
+            started.set()
+            try:
+                future = self._executor.submit(self._timed, produce)
+            except Exception:
+                release()
+                raise
+            future.add_done_callback(lambda _: release())
+            try:
+                while True:
+                    kind, value = await items.get()
+                    if kind == _END:
+                        return
+                    if kind == _ERROR:
+                        raise value
+                    yield value
+                    slots.release()
+            finally:
+                stopped.set()
+
+        iterator = consume()
+        # The slot is held from admission, it is released if the iterator is dropped unstarted
+        weakref.finalize(iterator, lambda: None if started.is_set() else release())
+        return iterator
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        with self._lock:
+            stats: Dict[str, Union[int, float]] = {
+                "workers": self.workers,
+                "capacity": self.capacity,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "mean_duration": self._mean_duration,
+            }
+            for endpoint_class, count in self._admitted.items():
+                stats[f"admitted_{endpoint_class}"] = count
+            return stats
+
+
+_executor: Optional[InferenceExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_inference_executor() -> InferenceExecutor:
+    """
+    The process wide executor, created from the settings on first use (changes require a restart).
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = InferenceExecutor(
+                workers=int(get_sd_option("faceswaplab_api_workers", 1)),
+                queue_size=int(get_sd_option("faceswaplab_api_queue_size", 8)),
+                limits={
+                    endpoint_class: int(
+                        get_sd_option(f"faceswaplab_api_limit_{endpoint_class}", 0)
+                    )
+                    for endpoint_class in [SWAP, ANALYSIS, BUILD]
+                },
+            )
+            logger.info("API inference executor : %s", _executor.stats())
+        return _executor
@@ -0,0 +1,282 @@
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Generator, List, Optional
+
+from client_api import api_utils
+from client_api.api_utils import FaceSwapJob, FaceSwapJobStatus
+from scripts.faceswaplab_globals import MODELS_DIR
+from scripts.faceswaplab_swapping.swapper import (
+    ProcessingCancelled,
+    ProcessingMonitor,
+)
+from scripts.faceswaplab_utils.faceswaplab_logging import logger
+from scripts.faceswaplab_utils.sd_utils import get_sd_option
+
+JOBS_DB_PATH = os.path.join(MODELS_DIR, "jobs", "jobs.sqlite")
+
+# Run a swap request, the monitor is used for progress and cancellation
+JobHandler = Callable[
+    [api_utils.FaceSwapRequest, ProcessingMonitor], api_utils.FaceSwapResponse
+]
+
+JOB_COLUMNS = "id, status, progress, error, created, started, finished"
+
+# Max seconds between two purges of the finished jobs (see JobWorkers.purge_if_due)
+PURGE_MAX_INTERVAL = 300
+
+
+class JobStore:
+    """
+    A persistent job queue in a SQLite database.
+
+    Requests and results are stored as JSON. Jobs left running by a stopped server are queued
+    again when the store is opened, so that queued work survives a restart.
+    """
+
+    def __init__(self, db_path: str = JOBS_DB_PATH) -> None:
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        # Notified when a job is submitted, workers wait on it
+        self.submitted = threading.Condition()
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with self._connect() as db:
+            db.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    progress REAL NOT NULL DEFAULT 0,
+                    error TEXT,
+                    created REAL NOT NULL,
+                    started REAL,
+                    finished REAL,
+                    cancel_requested INTEGER NOT NULL DEFAULT 0,
+                    request TEXT NOT NULL,
+                    result TEXT
+                )"""
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)"
+            )
+            requeued = db.execute(
+                "UPDATE jobs SET status = ?, progress = 0, started = NULL WHERE status = ?",
+                (FaceSwapJobStatus.QUEUED.value, FaceSwapJobStatus.RUNNING.value),
+            ).rowcount
+        if requeued:
+            logger.info("%s interrupted jobs queued again", requeued)
+
+    @contextmanager
+    def _connect(self) -> Generator[sqlite3.Connection, None, None]:
+        with self._lock:
+            db = sqlite3.connect(self.db_path, timeout=30)
+            try:
+                with db:
+                    yield db
+            finally:
+                db.close()
+
+    @staticmethod
+    def _to_job(row: tuple) -> FaceSwapJob:  # type: ignore
+        id, status, progress, error, created, started, finished = row
+        return FaceSwapJob(
+            id=id,
+            status=FaceSwapJobStatus(status),
+            progress=progress,
+            error=error,
+            created=created,
+            started=started,
+            finished=finished,
+        )
+
+    def submit(self, request: api_utils.FaceSwapRequest) -> FaceSwapJob:
+        job_id = uuid.uuid4().hex
+        with self._connect() as db:
+            db.execute(
+                "INSERT INTO jobs (id, status, created, request) VALUES (?, ?, ?, ?)",
+                (job_id, FaceSwapJobStatus.QUEUED.value, time.time(), request.json()),
+            )
+        with self.submitted:
+            self.submitted.notify()
+        job = self.get(job_id)
+        assert job is not None
+        return job
+
+    def get(self, job_id: str) -> Optional[FaceSwapJob]:
+        with self._connect() as db:
+            row = db.execute(
+                f"SELECT {JOB_COLUMNS} FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return self._to_job(row) if row else None
+
+    def get_result(self, job_id: str) -> Optional[api_utils.FaceSwapResponse]:
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT result FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return api_utils.FaceSwapResponse.parse_raw(row[0])
+
+    def cancel(self, job_id: str) -> Optional[FaceSwapJob]:
+        """
+        Cancel a queued job, or ask a running job to stop (it stops at the next image or unit).
+        """
+        with self._connect() as db:
+            db.execute(
+                "UPDATE jobs SET status = ?, finished = ? WHERE id = ? AND status = ?",
+                (
+                    FaceSwapJobStatus.CANCELLED.value,
+                    time.time(),
+                    job_id,
+                    FaceSwapJobStatus.QUEUED.value,
+                ),
+            )
+            db.execute(
+                "UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = ?",
+                (job_id, FaceSwapJobStatus.RUNNING.value),
+            )
+        return self.get(job_id)
+
+    def is_cancel_requested(self, job_id: str) -> bool:
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return bool(row and row[0])
+
+    def claim_next(self) -> Optional[tuple]:  # type: ignore
+        """
+        Mark the oldest queued job as running and return its id and request, or None if the queue is empty.
+        """
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT id, request FROM jobs WHERE status = ? ORDER BY created LIMIT 1",
+                (FaceSwapJobStatus.QUEUED.value,),
+            ).fetchone()
+            if row is None:
+                return None
+            claimed = db.execute(
+                "UPDATE jobs SET status = ?, started = ? WHERE id = ? AND status = ?",
+                (
+                    FaceSwapJobStatus.RUNNING.value,
+                    time.time(),
+                    row[0],
+                    FaceSwapJobStatus.QUEUED.value,
+                ),
+            ).rowcount
+        if not claimed:
+            # Taken by another process sharing the database
+            return None
+        return row[0], api_utils.FaceSwapRequest.parse_raw(row[1])
+
+    def set_progress(self, job_id: str, progress: float) -> None:
+        with self._connect() as db:
+            db.execute("UPDATE jobs SET progress = ? WHERE id = ?", (progress, job_id))
+
+    def finish(
+        self,
+        job_id: str,
+        status: FaceSwapJobStatus,
+        result: Optional[api_utils.FaceSwapResponse] = None,
+        error: Optional[str] = None,
+    ) -> None:
+        with self._connect() as db:
+            db.execute(
+                "UPDATE jobs SET status = ?, finished = ?, result = ?, error = ?, progress = COALESCE(?, progress) WHERE id = ?",
+                (
+                    status.value,
+                    time.time(),
+                    result.json() if result else None,
+                    error,
+                    1.0 if status == FaceSwapJobStatus.DONE else None,
+                    job_id,
+                ),
+            )
+
+    def purge(self, max_age: float) -> int:
+        """
+        Delete finished jobs (and their results) older than max_age seconds.
+        """
+        with self._connect() as db:
+            return db.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?, ?) AND finished < ?",
+                (
+                    FaceSwapJobStatus.DONE.value,
+                    FaceSwapJobStatus.FAILED.value,
+                    FaceSwapJobStatus.CANCELLED.value,
+                    time.time() - max_age,
+                ),
+            ).rowcount
+
+
+class JobWorkers:
+    """
+    Threads running the jobs of a JobStore, oldest first.
+    """
+
+    def __init__(self, store: JobStore, handler: JobHandler) -> None:
+        self.store = store
+        self.handler = handler
+        self.threads: List[threading.Thread] = []
+        self._purge_lock = threading.Lock()
+        self._next_purge = 0.0
+
+    def start(self, count: int) -> None:
+        for i in range(count):
+            thread = threading.Thread(
+                target=self.work, name=f"faceswaplab_job_worker_{i}", daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    def purge_if_due(self) -> None:
+        """
+        Purge the finished jobs older than the retention, at most every retention / 10 (and at
+        least every PURGE_MAX_INTERVAL seconds), whatever the number of workers.
+        """
+        retention = get_sd_option("faceswaplab_jobs_retention", 24) * 3600
+        with self._purge_lock:
+            now = time.time()
+            if now < self._next_purge:
+                return
+            self._next_purge = now + min(retention / 10, PURGE_MAX_INTERVAL)
+        purged = self.store.purge(retention)
+        if purged:
+            logger.info("%s finished jobs purged", purged)
+
+    def work(self) -> None:
+        while True:
+            try:
+                self.purge_if_due()
+                claimed = self.store.claim_next()
+            except Exception as e:
+                logger.error("Failed to read the jobs queue : %s", e)
+                claimed = None
+            if claimed is None:
+                with self.store.submitted:
+                    # The timeout also covers jobs submitted by another process
+                    self.store.submitted.wait(timeout=5)
+                continue
+            self.run(*claimed)
+
+    def run(self, job_id: str, request: api_utils.FaceSwapRequest) -> None:
+        logger.info("Start job %s", job_id)
+        monitor = ProcessingMonitor(
+            is_cancelled=lambda: self.store.is_cancel_requested(job_id),
+            on_progress=lambda progress: self.store.set_progress(job_id, progress),
+        )
+        try:
+            result = self.handler(request, monitor)
+            self.store.finish(job_id, FaceSwapJobStatus.DONE, result=result)
+            logger.info("Job %s done", job_id)
+        except ProcessingCancelled:
+            self.store.finish(job_id, FaceSwapJobStatus.CANCELLED)
+            logger.info("Job %s cancelled", job_id)
+        except Exception as e:
+            traceback.print_exc()
+            self.store.finish(job_id, FaceSwapJobStatus.FAILED, error=str(e))
+            logger.error("Job %s failed : %s", job_id, e)
@@ -7,6 +7,8 @@ MODELS_DIR = os.path.abspath(os.path.join("models", "faceswaplab"))
 ANALYZER_DIR = os.path.abspath(os.path.join(MODELS_DIR, "analysers"))
 # Defining the absolute path for the 'parser' directory inside 'MODELS_DIR'
 FACE_PARSER_DIR = os.path.abspath(os.path.join(MODELS_DIR, "parser"))
+# Defining the absolute path for the 'upscalers' directory (onnx super-resolution models) inside 'MODELS_DIR'
+UPSCALER_DIR = os.path.abspath(os.path.join(MODELS_DIR, "upscalers"))
 # Defining the absolute path for the 'faces' directory inside 'MODELS_DIR'
 FACES_DIR = os.path.abspath(os.path.join(MODELS_DIR, "faces"))
 
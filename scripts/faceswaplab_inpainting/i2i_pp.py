@@ -8,6 +8,7 @@ from modules.processing import StableDiffusionProcessingImg2Img
 from modules import sd_models
 import traceback
 from scripts.faceswaplab_swapping import swapper
+from scripts.faceswaplab_swapping.face_analysis import GENDER_AGE, SWAP_MODULES
 from scripts.faceswaplab_utils.typing import *
 from typing import *
 
@@ -34,7 +35,9 @@ inpainting_steps : {options.inpainting_steps}
         img = img.copy()
 
         if not faces:
-            faces = swapper.get_faces(imgutils.pil_to_cv2(img))
+            faces = swapper.get_faces(
+                imgutils.pil_to_cv2(img), modules=SWAP_MODULES | {GENDER_AGE}
+            )
 
         if faces:
             for face in faces:
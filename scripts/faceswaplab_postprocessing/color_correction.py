@@ -0,0 +1,124 @@
+from dataclasses import dataclass
+from typing import Any, List
+
+import cv2
+import numpy as np
+
+from scripts.faceswaplab_utils.faceswaplab_logging import logger
+from scripts.faceswaplab_utils.sd_utils import get_sd_option
+from scripts.faceswaplab_utils.typing import CV2ImgU8
+
+# Match the a and b histograms of the face to the target crop, with a lookup table per channel
+HISTOGRAM = "histogram"
+# Match the mean and standard deviation of the a and b channels (Reinhard color transfer)
+MEAN_STD = "mean_std"
+# webui processing.setup_color_correction / apply_color_correction (PIL and skimage)
+WEBUI = "webui"
+METHODS = [HISTOGRAM, MEAN_STD, WEBUI]
+
+# LAB channels transferred from the target crop. The face keeps its own lightness, as the webui
+# correction does with its final luminosity blend.
+COLOR_CHANNELS = [1, 2]
+
+
+@dataclass
+class ColorStats:
+    """
+    Color statistics of a target crop, computed once and applied to every face swapped in it.
+    """
+
+    method: str
+    # HISTOGRAM : values and cumulative distribution of each color channel
+    # MEAN_STD : mean and standard deviation of each color channel
+    # WEBUI : the webui correction target
+    channels: List[Any]
+
+
+def get_color_correction_method() -> str:
+    method = get_sd_option("faceswaplab_color_correction_method", HISTOGRAM)
+    if method not in METHODS:
+        logger.warning("Unknown color correction method %s, use %s", method, HISTOGRAM)
+        return HISTOGRAM
+    return method
+
+
+def setup_color_correction(target: CV2ImgU8, method: str = "") -> ColorStats:
+    """
+    Compute the color statistics of a target crop (BGR).
+
+    Args:
+        target (CV2ImgU8): The crop of the target face, before the swap
+        method (str, optional): One of METHODS. Defaults to faceswaplab_color_correction_method.
+
+    Returns:
+        ColorStats: The statistics to pass to apply_color_correction
+    """
+    method = method or get_color_correction_method()
+    if method == WEBUI:
+        from modules import processing
+
+        from scripts.faceswaplab_utils.imgutils import cv2_to_pil
+
+        return ColorStats(
+            method, [processing.setup_color_correction(cv2_to_pil(target))]
+        )
+
+    lab = cv2.cvtColor(target, cv2.COLOR_BGR2LAB)
+    channels: List[Any] = []
+    for c in COLOR_CHANNELS:
+        channel = lab[:, :, c]
+        if method == MEAN_STD:
+            channels.append((float(channel.mean()), float(channel.std())))
+        else:
+            counts = np.bincount(channel.ravel(), minlength=256)
+            values = np.flatnonzero(counts)
+            quantiles = np.cumsum(counts[values]) / channel.size
+            channels.append((values, quantiles))
+    return ColorStats(method, channels)
+
+
+def get_channel_lut(stats: Any, method: str, channel: np.ndarray) -> np.ndarray:  # type: ignore
+    """
+    Lookup table (256 uint8 values) mapping a channel of the face to the target statistics.
+    """
+    levels = np.arange(256, dtype=np.float64)
+    if method == MEAN_STD:
+        target_mean, target_std = stats
+        mean, std = float(channel.mean()), float(channel.std())
+        lut = (levels - mean) * (target_std / std if std > 0 else 1.0) + target_mean
+    else:
+        # Same mapping as skimage.exposure.match_histograms : each level goes to the target
+        # value at the same quantile
+        target_values, target_quantiles = stats
+        counts = np.bincount(channel.ravel(), minlength=256)
+        quantiles = np.cumsum(counts) / channel.size
+        lut = np.interp(quantiles, target_quantiles, target_values)
+    return np.clip(np.rint(lut), 0, 255).astype(np.uint8)
+
+
+def apply_color_correction(stats: ColorStats, face: CV2ImgU8) -> CV2ImgU8:
+    """
+    Transfer the colors of a target crop (see setup_color_correction) to a swapped face (BGR).
+
+    The face can have another size than the target crop. Its lightness is kept, only the a and b
+    channels of the LAB space are mapped, with one lookup table each.
+
+    Returns:
+        CV2ImgU8: The corrected face
+    """
+    if stats.method == WEBUI:
+        from modules import processing
+
+        from scripts.faceswaplab_utils.imgutils import cv2_to_pil, pil_to_cv2
+
+        return pil_to_cv2(
+            processing.apply_color_correction(stats.channels[0], cv2_to_pil(face))
+        )
+
+    lab = cv2.cvtColor(face, cv2.COLOR_BGR2LAB)
+    for c, channel_stats in zip(COLOR_CHANNELS, stats.channels):
+        channel = lab[:, :, c]
+        lab[:, :, c] = cv2.LUT(
+            channel, get_channel_lut(channel_stats, stats.method, channel)
+        )
+    return cv2.cvtColor(lab, cv2.COLOR_LAB2BGR)
@@ -0,0 +1,103 @@
+import glob
+import os
+from typing import Any, List, Optional
+
+import cv2
+import numpy as np
+
+from scripts.faceswaplab_globals import UPSCALER_DIR
+from scripts.faceswaplab_utils.cache_utils import locked_lru_cache
+from scripts.faceswaplab_utils.faceswaplab_logging import logger
+from scripts.faceswaplab_utils.typing import CV2ImgU8
+
+# Upscalers working on the BGR uint8 face crop directly, without the PIL conversions and copies of
+# the webui upscalers (see upscaling.upscale_img)
+LANCZOS4 = "FaceSwapLab Lanczos4"
+CUBIC = "FaceSwapLab Cubic"
+INTERPOLATIONS = {LANCZOS4: cv2.INTER_LANCZOS4, CUBIC: cv2.INTER_CUBIC}
+# Prefix of the onnx super-resolution models found in UPSCALER_DIR ("FaceSwapLab ONNX <file name>")
+ONNX_PREFIX = "FaceSwapLab ONNX "
+
+
+def get_onnx_models() -> List[str]:
+    """
+    Returns the onnx super-resolution models available in UPSCALER_DIR.
+
+    A model takes a RGB image (1, 3, H, W) in [0, 1], float32 or float16, and returns it upscaled
+    by a fixed factor (the usual Real-ESRGAN / SwinIR exports).
+    """
+    return sorted(glob.glob(os.path.join(UPSCALER_DIR, "*.onnx")))
+
+
+def get_native_upscalers() -> List[str]:
+    """
+    Returns the names of the native upscalers, to list them with the webui upscalers.
+    """
+    return list(INTERPOLATIONS) + [
+        ONNX_PREFIX + os.path.splitext(os.path.basename(path))[0]
+        for path in get_onnx_models()
+    ]
+
+
+def is_native_upscaler(name: Optional[str]) -> bool:
+    return bool(name) and (name in INTERPOLATIONS or name.startswith(ONNX_PREFIX))  # type: ignore
+
+
+@locked_lru_cache(maxsize=2)
+def get_sr_session(model_path: str) -> Any:
+    """
+    Returns the onnxruntime session of a super-resolution model, with the providers and the
+    thread settings of the swap model.
+    """
+    from scripts.faceswaplab_swapping import swapper
+    from scripts.faceswaplab_utils.onnx_sessions import SWAP_SESSION, create_session
+
+    return create_session(model_path, swapper.get_providers(), SWAP_SESSION)
+
+
+def upscale_onnx(img: CV2ImgU8, model_path: str) -> CV2ImgU8:
+    """
+    Run a super-resolution model on a BGR image, returns the image upscaled by the model factor.
+    """
+    session = get_sr_session(model_path)
+    model_input = session.get_inputs()[0]
+    dtype = np.float16 if model_input.type == "tensor(float16)" else np.float32
+    blob = cv2.cvtColor(img, cv2.COLOR_BGR2RGB).transpose(2, 0, 1)[None]
+    blob = blob.astype(dtype) / 255
+    output = session.run(None, {model_input.name: blob})[0][0]
+    output = np.clip(output.transpose(1, 2, 0).astype(np.float32) * 255, 0, 255)
+    return cv2.cvtColor(np.rint(output).astype(np.uint8), cv2.COLOR_RGB2BGR)
+
+
+def upscale(img: CV2ImgU8, name: str, k: int) -> CV2ImgU8:
+    """
+    Upscale a BGR image k times with a native upscaler (see is_native_upscaler).
+
+    The output of an onnx model is resized to k times the input if the model has another factor.
+
+    Args:
+        img (CV2ImgU8): The image to upscale
+        name (str): The name of the upscaler (see get_native_upscalers)
+        k (int): The upscaling factor
+
+    Returns:
+        CV2ImgU8: The upscaled image
+    """
+    height, width = img.shape[:2]
+    size = (width * k, height * k)
+    logger.info("Upscale with %s scale = %s", name, k)
+    if name in INTERPOLATIONS:
+        return cv2.resize(img, size, interpolation=INTERPOLATIONS[name])
+
+    model_name = name[len(ONNX_PREFIX) :]
+    model_path = os.path.join(UPSCALER_DIR, model_name + ".onnx")
+    if not os.path.exists(model_path):
+        logger.error("Upscaler model %s not found, use %s", model_path, LANCZOS4)
+        return cv2.resize(img, size, interpolation=cv2.INTER_LANCZOS4)
+    upscaled = upscale_onnx(img, model_path)
+    if upscaled.shape[:2] != (size[1], size[0]):
+        interpolation = (
+            cv2.INTER_AREA if upscaled.shape[1] > size[0] else cv2.INTER_LANCZOS4
+        )
+        upscaled = cv2.resize(upscaled, size, interpolation=interpolation)
+    return upscaled
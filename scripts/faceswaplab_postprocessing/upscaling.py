@@ -3,9 +3,16 @@ from scripts.faceswaplab_postprocessing.postprocessing_options import (
 )
 from scripts.faceswaplab_utils.faceswaplab_logging import logger
 from PIL import Image
+import cv2
 import numpy as np
 from modules import codeformer_model
 from scripts.faceswaplab_utils.typing import *
+import threading
+
+# The webui upscalers and face restorers (ESRGAN, CodeFormer, GFPGAN...) are not thread safe. They
+# are shared by the batch pipeline threads and the API inference threads, so every call goes
+# through this lock.
+WEBUI_MODELS_LOCK = threading.Lock()
 
 
 def upscale_img(image: PILImage, pp_options: PostProcessingOptions) -> PILImage:
@@ -16,9 +23,10 @@ def upscale_img(image: PILImage, pp_options: PostProcessingOptions) -> PILImage:
             pp_options.upscaler.name,
             pp_options.scale,
         )
-        result_image = pp_options.upscaler.scaler.upscale(
-            image, pp_options.scale, pp_options.upscaler.data_path  # type: ignore
-        )
+        with WEBUI_MODELS_LOCK:
+            result_image = pp_options.upscaler.scaler.upscale(
+                image, pp_options.scale, pp_options.upscaler.data_path  # type: ignore
+            )
 
         # FIXME : Could be better (managing images whose dimensions are not multiples of 16)
         if pp_options.scale == 1 and original_image.size == result_image.size:
@@ -32,17 +40,25 @@ def upscale_img(image: PILImage, pp_options: PostProcessingOptions) -> PILImage:
     return image
 
 
-def restore_face(image: Image.Image, pp_options: PostProcessingOptions) -> Image.Image:
-    if pp_options.face_restorer is not None:
-        original_image = image.copy()
-        logger.info("Restore face with %s", pp_options.face_restorer.name())
-        numpy_image = np.array(image)
+def run_face_restorer(
+    numpy_image: np.ndarray, pp_options: PostProcessingOptions
+) -> np.ndarray:
+    """
+    Restore a RGB uint8 image with the face restorer of the options (which must be set).
+    """
+    logger.info("Restore face with %s", pp_options.face_restorer.name())  # type: ignore
+    with WEBUI_MODELS_LOCK:
         if pp_options.face_restorer_name == "CodeFormer":
-            numpy_image = codeformer_model.codeformer.restore(
+            return codeformer_model.codeformer.restore(
                 numpy_image, w=pp_options.codeformer_weight
             )
-        else:
-            numpy_image = pp_options.face_restorer.restore(numpy_image)
+        return pp_options.face_restorer.restore(numpy_image)  # type: ignore
+
+
+def restore_face(image: Image.Image, pp_options: PostProcessingOptions) -> Image.Image:
+    if pp_options.face_restorer is not None:
+        original_image = image.copy()
+        numpy_image = run_face_restorer(np.array(image), pp_options)
 
         restored_image = Image.fromarray(numpy_image)
         result_image = Image.blend(
@@ -50,3 +66,16 @@ def restore_face(image: Image.Image, pp_options: PostProcessingOptions) -> Image
         )
         return result_image
     return image
+
+
+def restore_face_cv2(image: CV2ImgU8, pp_options: PostProcessingOptions) -> CV2ImgU8:
+    """
+    Same as restore_face on a BGR uint8 image, without converting it to PIL.
+    """
+    if pp_options.face_restorer is not None:
+        rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        restored = run_face_restorer(rgb_image, pp_options)
+        visibility = pp_options.restorer_visibility
+        blended = cv2.addWeighted(rgb_image, 1 - visibility, restored, visibility, 0)
+        return cv2.cvtColor(blended, cv2.COLOR_RGB2BGR)
+    return image
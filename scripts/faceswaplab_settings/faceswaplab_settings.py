@@ -1,4 +1,5 @@
 from scripts.faceswaplab_utils.models_utils import get_swap_models
+from scripts.faceswaplab_postprocessing.native_upscaling import get_native_upscalers
 from modules import script_callbacks, shared
 import gradio as gr
 
@@ -57,6 +58,70 @@ def on_ui_settings() -> None:
         ),
     )
 
+    shared.opts.add_option(
+        "faceswaplab_nsfw_size",
+        shared.OptionInfo(
+            480,
+            "NSFW detection size. Images are downscaled to this smallest side before the NSFW check (ifnude uses 800). Lower is faster",
+            gr.Slider,
+            {"minimum": 256, "maximum": 800, "step": 32},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "faceswaplab_nsfw_validate",
+        shared.OptionInfo(
+            False,
+            "Validate the NSFW detection size : also check images at full size, log when the verdicts differ and use the full size verdict (slower)",
+            gr.Checkbox,
+            {"interactive": True},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_parsing_size",
+        shared.OptionInfo(
+            512,
+            "Improved mask : face parsing resolution. Lower is faster, masks are scaled back to the face size",
+            gr.Slider,
+            {"minimum": 256, "maximum": 512, "step": 32},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "faceswaplab_parsing_fp16",
+        shared.OptionInfo(
+            False,
+            "Improved mask : run face parsing in half precision (cuda only)",
+            gr.Checkbox,
+            {"interactive": True},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_parsing_backend",
+        shared.OptionInfo(
+            "torch",
+            "Improved mask : face parser backend. onnx runs the parser exported by Tools/Convert Model (exported on first use if missing) with onnxruntime, with the providers and threads of the swap model (requires restart)",
+            gr.Radio,
+            {"interactive": True, "choices": ["torch", "onnx"]},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_color_correction_method",
+        shared.OptionInfo(
+            "histogram",
+            "Color corrections of the swapped face. histogram : match the color histograms of the target face, mean_std : match their mean and deviation (fastest), webui : the webui color correction (slowest)",
+            gr.Radio,
+            {"interactive": True, "choices": ["histogram", "mean_std", "webui"]},
+            section=section,
+        ),
+    )
+
     shared.opts.add_option(
         "faceswaplab_det_size",
         shared.OptionInfo(
@@ -72,7 +137,7 @@ def on_ui_settings() -> None:
         "faceswaplab_auto_det_size",
         shared.OptionInfo(
             True,
-            "Auto det_size : Will load model twice and test faces on each if needed (old behaviour). Takes more VRAM. Precedence over fixed det_size",
+            "Auto det_size : Will retry detection with a det_size of 320 if no face is found at 640 (old behaviour, uses the same model). Precedence over fixed det_size",
             gr.Checkbox,
             {"interactive": True},
             section=section,
@@ -90,6 +155,328 @@ def on_ui_settings() -> None:
         ),
     )
 
+    shared.opts.add_option(
+        "faceswaplab_dynamic_batch",
+        shared.OptionInfo(
+            False,
+            "Swap all faces of an image in one inference. Rewrites a copy of the swap model with a dynamic batch axis (stored in models/faceswaplab/dynamic_batch). Faster on images with many faces (requires restart)",
+            gr.Checkbox,
+            {"interactive": True},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_fanout_batch_size",
+        shared.OptionInfo(
+            8,
+            "Non blended units : number of source faces swapped in one inference on the same target image. The target faces are prepared once for all sources. Lower it if you run out of memory",
+            gr.Slider,
+            {"minimum": 1, "maximum": 64, "step": 1},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_detection_cache_size",
+        shared.OptionInfo(
+            64,
+            "Face detection cache size (MB). Detection results are reused when the same pixels are analysed again (units, similarity, inpainting). 0 = disable",
+            gr.Slider,
+            {"minimum": 0, "maximum": 1024, "step": 1},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_source_cache_size",
+        shared.OptionInfo(
+            16,
+            "Source faces cache size (MB). Faces (embedding, gender, age) of source images, API payloads and batch files are reused across requests. 0 = disable",
+            gr.Slider,
+            {"minimum": 0, "maximum": 256, "step": 1},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_source_cache_persist",
+        shared.OptionInfo(
+            False,
+            "Save source faces on disk (models/faceswaplab/source_cache) so that they survive restarts. The face embeddings written there are biometric data of the people on the source images",
+            gr.Checkbox,
+            {"interactive": True},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_source_cache_disk_size",
+        shared.OptionInfo(
+            64,
+            "Max size of the source faces saved on disk (MB). The least recently used are deleted first",
+            gr.Slider,
+            {"minimum": 1, "maximum": 1024, "step": 1},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_checkpoint_cache_size",
+        shared.OptionInfo(
+            16,
+            "Face checkpoints cache size (MB). Decoded checkpoints are kept in memory until their file changes. 0 = disable",
+            gr.Slider,
+            {"minimum": 0, "maximum": 256, "step": 1},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_checkpoint_rescan_interval",
+        shared.OptionInfo(
+            60,
+            "Face checkpoints index rescan interval (seconds). The faces directory is scanned again when it changes or after this delay (to see checkpoints overwritten by another process)",
+            gr.Slider,
+            {"minimum": 1, "maximum": 3600, "step": 1},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_preload_models",
+        shared.OptionInfo(
+            False,
+            "Load and warm up analysis, swap and face parser models in background when the server starts. Readiness is reported on /faceswaplab/ready (requires restart)",
+            gr.Checkbox,
+            {"interactive": True},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_ort_optimization_level",
+        shared.OptionInfo(
+            "all",
+            "onnxruntime graph optimization level (requires restart)",
+            gr.Dropdown,
+            {
+                "interactive": True,
+                "choices": ["disabled", "basic", "extended", "all"],
+            },
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_ort_cache",
+        shared.OptionInfo(
+            False,
+            "Save the graphs optimized by onnxruntime in models/faceswaplab/ort_cache and reuse them on the next starts (faster model loading, uses disk space) (requires restart)",
+            gr.Checkbox,
+            {"interactive": True},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_ort_analysis_intra_op_threads",
+        shared.OptionInfo(
+            0,
+            "onnxruntime intra-op threads of the analysis models. 0 = onnxruntime default (requires restart)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 64, "step": 1},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_ort_analysis_inter_op_threads",
+        shared.OptionInfo(
+            0,
+            "onnxruntime inter-op threads of the analysis models (only used in parallel mode). 0 = onnxruntime default (requires restart)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 64, "step": 1},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_ort_analysis_execution_mode",
+        shared.OptionInfo(
+            "sequential",
+            "onnxruntime execution mode of the analysis models (requires restart)",
+            gr.Radio,
+            {"interactive": True, "choices": ["sequential", "parallel"]},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_ort_swap_intra_op_threads",
+        shared.OptionInfo(
+            0,
+            "onnxruntime intra-op threads of the swap model. 0 = onnxruntime default (requires restart)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 64, "step": 1},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_ort_swap_inter_op_threads",
+        shared.OptionInfo(
+            0,
+            "onnxruntime inter-op threads of the swap model (only used in parallel mode). 0 = onnxruntime default (requires restart)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 64, "step": 1},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_ort_swap_execution_mode",
+        shared.OptionInfo(
+            "sequential",
+            "onnxruntime execution mode of the swap model (requires restart)",
+            gr.Radio,
+            {"interactive": True, "choices": ["sequential", "parallel"]},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_pipeline_decode_workers",
+        shared.OptionInfo(
+            2,
+            "Batch pipeline decode threads. Images opened and decoded ahead of the one being swapped (tools batch and API batch)",
+            gr.Slider,
+            {"minimum": 1, "maximum": 16, "step": 1},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_pipeline_swap_workers",
+        shared.OptionInfo(
+            1,
+            "Batch pipeline swap threads. Threads running detection, swap and post-processing models, keep 1 unless the provider benefits from concurrent runs",
+            gr.Slider,
+            {"minimum": 1, "maximum": 8, "step": 1},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_pipeline_encode_workers",
+        shared.OptionInfo(
+            2,
+            "Batch pipeline encode threads. Results encoded or saved while the next images are swapped",
+            gr.Slider,
+            {"minimum": 1, "maximum": 16, "step": 1},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_pipeline_queue_size",
+        shared.OptionInfo(
+            2,
+            "Batch pipeline queue size. Max images waiting between two stages, bounds memory on large batches",
+            gr.Slider,
+            {"minimum": 1, "maximum": 32, "step": 1},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_api_workers",
+        shared.OptionInfo(
+            1,
+            "API inference threads. Swaps run on these threads so that the server keeps answering during inference (requires restart)",
+            gr.Slider,
+            {"minimum": 1, "maximum": 16, "step": 1},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_api_queue_size",
+        shared.OptionInfo(
+            8,
+            "API queue size. Requests waiting for an inference thread beyond this are rejected with 429 Too Many Requests (requires restart)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 256, "step": 1},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_api_limit_swap",
+        shared.OptionInfo(
+            0,
+            "API max swap_face requests running or queued. 0 = only limited by the queue size (requires restart)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 256, "step": 1},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_api_limit_analysis",
+        shared.OptionInfo(
+            0,
+            "API max compare and extract requests running or queued. 0 = only limited by the queue size (requires restart)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 256, "step": 1},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_api_limit_build",
+        shared.OptionInfo(
+            0,
+            "API max build requests running or queued. 0 = only limited by the queue size (requires restart)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 256, "step": 1},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_api_stream_buffer",
+        shared.OptionInfo(
+            2,
+            "API stream buffer. Results of streaming endpoints waiting for a slow client before processing pauses",
+            gr.Slider,
+            {"minimum": 1, "maximum": 32, "step": 1},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_jobs_workers",
+        shared.OptionInfo(
+            1,
+            "API jobs workers. Threads running the jobs submitted to /faceswaplab/jobs (requires restart)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 16, "step": 1},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "faceswaplab_jobs_retention",
+        shared.OptionInfo(
+            24,
+            "API jobs retention (hours). Finished jobs and their results are deleted after this delay",
+            gr.Slider,
+            {"minimum": 1, "maximum": 720, "step": 1},
+            section=section,
+        ),
+    )
+
     # DEFAULT UI SETTINGS
 
     shared.opts.add_option(
@@ -183,7 +570,8 @@ def on_ui_settings() -> None:
             gr.Dropdown,
             {
                 "interactive": True,
-                "choices": [upscaler.name for upscaler in shared.sd_upscalers],
+                "choices": [upscaler.name for upscaler in shared.sd_upscalers]
+                + get_native_upscalers(),
             },
             section=section,
         ),
@@ -261,6 +649,46 @@ def on_ui_settings() -> None:
             section=section,
         ),
     )
+    shared.opts.add_option(
+        "faceswaplab_adaptive_upscale",
+        shared.OptionInfo(
+            False,
+            "Upscaled swapper : choose the upscaling factor and face restoration of each face from its size on the image. Small faces take the cheap path (changes the result of small faces)",
+            gr.Checkbox,
+            {"interactive": True},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "faceswaplab_upscale_2x_min_size",
+        shared.OptionInfo(
+            160,
+            "Upscaled swapper : upscale faces whose aligned crop is larger than this size on the image (pixels) 2x, smaller faces are not upscaled",
+            gr.Slider,
+            {"minimum": 0, "maximum": 1024, "step": 16},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "faceswaplab_upscale_4x_min_size",
+        shared.OptionInfo(
+            320,
+            "Upscaled swapper : upscale faces whose aligned crop is larger than this size on the image (pixels) 4x",
+            gr.Slider,
+            {"minimum": 0, "maximum": 1024, "step": 16},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "faceswaplab_restore_min_size",
+        shared.OptionInfo(
+            64,
+            "Upscaled swapper : do not restore faces whose aligned crop is smaller than this size on the image (pixels)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 512, "step": 16},
+            section=section,
+        ),
+    )
 
 
 script_callbacks.on_ui_settings(on_ui_settings)
@@ -0,0 +1,185 @@
+import os
+import threading
+from contextlib import redirect_stdout
+from io import StringIO
+from typing import Any, Collection, Dict, FrozenSet, List, Tuple
+
+from insightface.app import FaceAnalysis
+from insightface.model_zoo.arcface_onnx import ArcFaceONNX
+from insightface.model_zoo.attribute import Attribute
+from insightface.model_zoo.landmark import Landmark
+from insightface.model_zoo.retinaface import RetinaFace
+from insightface.utils.storage import ensure_available
+
+from scripts.faceswaplab_utils.faceswaplab_logging import logger
+from scripts.faceswaplab_utils.onnx_sessions import ANALYSIS_SESSION, create_session
+from scripts.faceswaplab_utils.typing import CV2ImgU8, Face
+
+# Analysis modules (insightface tasknames)
+DETECTION = "detection"
+GENDER_AGE = "genderage"
+RECOGNITION = "recognition"
+LANDMARK_2D_106 = "landmark_2d_106"
+LANDMARK_3D_68 = "landmark_3d_68"
+
+# Files of each module in the buffalo_l pack
+BUFFALO_L_FILES: Dict[str, str] = {
+    DETECTION: "det_10g.onnx",
+    GENDER_AGE: "genderage.onnx",
+    RECOGNITION: "w600k_r50.onnx",
+    LANDMARK_2D_106: "2d106det.onnx",
+    LANDMARK_3D_68: "1k3d68.onnx",
+}
+
+# The face key set by each module, used to know if a module has already run on a face
+MODULE_KEYS: Dict[str, str] = {
+    GENDER_AGE: "gender",
+    RECOGNITION: "embedding",
+    LANDMARK_2D_106: "landmark_2d_106",
+    LANDMARK_3D_68: "landmark_3d_68",
+}
+
+# The insightface class of each module (what model_zoo.get_model would pick for these files)
+MODULE_CLASSES: Dict[str, Any] = {
+    DETECTION: RetinaFace,
+    GENDER_AGE: Attribute,
+    RECOGNITION: ArcFaceONNX,
+    LANDMARK_2D_106: Landmark,
+    LANDMARK_3D_68: Landmark,
+}
+
+ALL_MODULES: FrozenSet[str] = frozenset(BUFFALO_L_FILES.keys())
+# bbox and kps are given by the detection model, this is all the swap needs
+SWAP_MODULES: FrozenSet[str] = frozenset({DETECTION})
+# Source faces need an embedding, gender and age (used by blending, checkpoints and same gender)
+SOURCE_MODULES: FrozenSet[str] = frozenset({DETECTION, GENDER_AGE, RECOGNITION})
+
+# The detector keeps every candidate above this score, the requested threshold is applied after.
+# Matches the minimum of the detection threshold sliders.
+DETECTION_THRESHOLD_FLOOR = 0.1
+
+
+class LazyFaceAnalysis(FaceAnalysis):
+    """
+    A FaceAnalysis that only loads and runs the modules a request needs.
+
+    insightface.app.FaceAnalysis creates an onnxruntime session for every model of the pack and
+    runs all of them on every face. Here only the detection model is loaded at creation. The other
+    modules are loaded the first time they are requested and only run on the faces that need them.
+
+    The sessions do not depend on the detection parameters : det_size is the input size of each
+    detection call and det_thresh filters the detector scores, so one instance serves all settings.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        root: str,
+        providers: List[str],
+    ) -> None:
+        # super().__init__ is not called on purpose : it creates a session for every model of the pack
+        self.model_dir = ensure_available("models", name, root=root)
+        self.providers = providers
+        self.models: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self.det_model = self.load_module(DETECTION)
+
+    def load_module(self, taskname: str) -> Any:
+        """
+        Return the model of an analysis module, loading it if needed.
+
+        Args:
+            taskname (str): The module to load (see BUFFALO_L_FILES)
+
+        Returns:
+            The insightface model of the module.
+        """
+        with self._lock:
+            if taskname not in self.models:
+                model_path = os.path.join(self.model_dir, BUFFALO_L_FILES[taskname])
+                logger.info("Load analysis module %s (%s)", taskname, model_path)
+                with redirect_stdout(StringIO()):
+                    model = MODULE_CLASSES[taskname](
+                        model_file=model_path,
+                        session=create_session(
+                            model_path, self.providers, ANALYSIS_SESSION
+                        ),
+                    )
+                    if taskname == DETECTION:
+                        model.prepare(
+                            ctx_id=0,
+                            input_size=(640, 640),
+                            det_thresh=DETECTION_THRESHOLD_FLOOR,
+                        )
+                    else:
+                        model.prepare(ctx_id=0)
+                self.models[taskname] = model
+            return self.models[taskname]
+
+    def get(
+        self,
+        img: CV2ImgU8,
+        det_size: Tuple[int, int] = (640, 640),
+        det_thresh: float = 0.5,
+        modules: Collection[str] = ALL_MODULES,
+    ) -> List[Face]:
+        """
+        Detect the faces of an image and run the requested modules on them.
+
+        Filtering the scores after the detection gives the same faces as a detector prepared with
+        det_thresh : the non maximum suppression only lets a box be removed by a higher score box.
+
+        Args:
+            img (CV2ImgU8): The image (BGR)
+            det_size (Tuple[int, int], optional): The detection input size. Defaults to (640, 640).
+            det_thresh (float, optional): The detection threshold. Defaults to 0.5.
+            modules (Collection[str], optional): The modules to run. Defaults to ALL_MODULES.
+
+        Returns:
+            List[Face]: The detected faces.
+        """
+        if det_thresh < DETECTION_THRESHOLD_FLOOR:
+            logger.warning(
+                "Detection threshold %s is lower than %s, use %s",
+                det_thresh,
+                DETECTION_THRESHOLD_FLOOR,
+                DETECTION_THRESHOLD_FLOOR,
+            )
+        bboxes, kpss = self.det_model.detect(img, input_size=det_size, metric="default")
+        faces: List[Face] = []
+        for i in range(bboxes.shape[0]):
+            if bboxes[i, 4] < det_thresh:
+                continue
+            faces.append(
+                Face(
+                    bbox=bboxes[i, 0:4],
+                    kps=kpss[i] if kpss is not None else None,
+                    det_score=bboxes[i, 4],
+                )
+            )
+        self.complete(img, faces, modules)
+        return faces
+
+    def complete(
+        self, img: CV2ImgU8, faces: List[Face], modules: Collection[str]
+    ) -> bool:
+        """
+        Run the requested modules on already detected faces, if they have not run yet. Faces are updated in place.
+
+        Args:
+            img (CV2ImgU8): The image the faces have been detected in (BGR)
+            faces (List[Face]): The faces to complete
+            modules (Collection[str]): The modules that should have run on the faces
+
+        Returns:
+            bool: True if at least one module has been run.
+        """
+        updated = False
+        for taskname in sorted(set(modules) - {DETECTION}):
+            missing = [face for face in faces if MODULE_KEYS[taskname] not in face]
+            if missing:
+                model = self.load_module(taskname)
+                for face in missing:
+                    model.get(img, face)
+                updated = True
+        return updated
@@ -1,5 +1,6 @@
-import glob
 import os
+import threading
+import time
 from typing import *
 from insightface.app.common import Face
 from safetensors.torch import save_file, safe_open
@@ -12,9 +13,12 @@ from scripts.faceswaplab_utils.faceswaplab_logging import logger
 from scripts.faceswaplab_utils.typing import *
 from scripts.faceswaplab_utils import imgutils
 from scripts.faceswaplab_utils.models_utils import get_swap_models
+from scripts.faceswaplab_utils.cache_utils import ContentCache
+from scripts.faceswaplab_utils.sd_utils import get_sd_option
 import traceback
 
 from scripts.faceswaplab_swapping import swapper
+from scripts.faceswaplab_swapping.face_analysis import SWAP_MODULES
 from pprint import pformat
 import re
 from client_api import api_utils
@@ -85,7 +89,11 @@ def build_face_checkpoint_and_save(
                 name = "default_name"
             logger.debug("Face %s", pformat(blended_face))
             target_face = swapper.get_or_default(
-                swapper.get_faces(imgutils.pil_to_cv2(reference_preview_img)), 0, None
+                swapper.get_faces(
+                    imgutils.pil_to_cv2(reference_preview_img), modules=SWAP_MODULES
+                ),
+                0,
+                None,
             )
             if target_face is None:
                 logger.error(
@@ -151,6 +159,8 @@ def save_face(face: Face, filename: str) -> None:
             "age": torch.tensor(face["age"]),
         }
         save_file(tensors, filename)
+        # An overwritten file does not change the directory mtime
+        CHECKPOINT_INDEX.invalidate()
     except Exception as e:
         traceback.print_exc
         logger.error("Failed to save checkpoint %s", e)
@@ -183,16 +193,111 @@ def load_face(name: str) -> Optional[Face]:
         return None
 
     elif filename.endswith(".safetensors"):
-        face = {}
-        with safe_open(filename, framework="pt", device="cpu") as f:
-            for k in f.keys():
-                logger.debug("load key %s", k)
-                face[k] = f.get_tensor(k).numpy()
-        return Face(face)
+        cache_key = (filename, CHECKPOINT_INDEX.get_mtime(filename))
+        face = CHECKPOINT_CACHE.get(cache_key)
+        if face is None:
+            face = {}
+            with safe_open(filename, framework="pt", device="cpu") as f:
+                for k in f.keys():
+                    logger.debug("load key %s", k)
+                    face[k] = f.get_tensor(k).numpy()
+            CHECKPOINT_CACHE.put(cache_key, face)
+        # A copy, so that callers can not alter the cached face
+        return Face(dict(face))
 
     raise NotImplementedError("Unknown file type, face extraction not implemented")
 
 
+class CheckpointIndex:
+    """
+    An in-memory index of the face checkpoints directory, mapping names to paths.
+
+    The directory is scanned once, then again when its mtime changes (files added, removed or
+    renamed) or when the index is older than faceswaplab_checkpoint_rescan_interval seconds, to
+    catch checkpoints overwritten in place by another process. Lookups only cost a stat of the
+    directory.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._dir: Optional[str] = None
+        self._dir_mtime: Optional[float] = None
+        self._scan_time = 0.0
+        # name (with and without extension) => path
+        self._paths: Dict[str, str] = {}
+        # path => mtime
+        self._mtimes: Dict[str, float] = {}
+        self._names: List[str] = []
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._dir_mtime = None
+
+    def _refresh(self) -> None:
+        checkpoint_path = get_checkpoint_path()
+        dir_mtime = os.stat(checkpoint_path).st_mtime
+        rescan_interval = get_sd_option("faceswaplab_checkpoint_rescan_interval", 60)
+        if (
+            checkpoint_path == self._dir
+            and dir_mtime == self._dir_mtime
+            and time.monotonic() - self._scan_time < rescan_interval
+        ):
+            return
+
+        paths: Dict[str, str] = {}
+        mtimes: Dict[str, float] = {}
+        with os.scandir(checkpoint_path) as entries:
+            for entry in entries:
+                base, ext = os.path.splitext(entry.name)
+                if ext not in [".safetensors", ".pkl"] or not entry.is_file():
+                    continue
+                paths[entry.name] = entry.path
+                # .safetensors has precedence over .pkl for names without extension
+                if ext == ".safetensors" or base not in paths:
+                    paths[base] = entry.path
+                mtimes[entry.path] = entry.stat().st_mtime
+        self._dir = checkpoint_path
+        self._dir_mtime = dir_mtime
+        self._scan_time = time.monotonic()
+        self._paths = paths
+        self._mtimes = mtimes
+        self._names = sorted(os.path.basename(path) for path in mtimes)
+        logger.debug("Indexed %s face checkpoints", len(self._names))
+
+    def names(self) -> List[str]:
+        with self._lock:
+            self._refresh()
+            return list(self._names)
+
+    def get_path(self, name: str) -> Optional[str]:
+        with self._lock:
+            self._refresh()
+            return self._paths.get(name)
+
+    def get_mtime(self, path: str) -> float:
+        """
+        The mtime of a checkpoint, from the index if it is part of it.
+        """
+        with self._lock:
+            self._refresh()
+            if path in self._mtimes:
+                return self._mtimes[path]
+        return os.stat(path).st_mtime
+
+
+CHECKPOINT_INDEX = CheckpointIndex()
+
+
+def get_checkpoint_cache_max_bytes() -> int:
+    return int(get_sd_option("faceswaplab_checkpoint_cache_size", 16) * 1024 * 1024)
+
+
+# Decoded checkpoints, by path and mtime
+CHECKPOINT_CACHE: ContentCache[Dict[str, Any]] = ContentCache(
+    "checkpoints", max_bytes=get_checkpoint_cache_max_bytes
+)
+
+
 def get_checkpoint_path() -> str:
     checkpoint_path = os.path.join(scripts.basedir(), "models", "faceswaplab", "faces")
     os.makedirs(checkpoint_path, exist_ok=True)
@@ -217,34 +322,22 @@ def matching_checkpoint(name: str) -> Optional[str]:
     if os.path.sep in name:
         return name
 
-    # If the name doesn't end with the specified extensions, look for a matching file
-    if not (name.endswith(".safetensors") or name.endswith(".pkl")):
-        # Try appending each extension and check if the file exists in the checkpoint path
-        for ext in [".safetensors", ".pkl"]:
-            full_path = os.path.join(get_checkpoint_path(), name + ext)
-            if os.path.exists(full_path):
-                return full_path
-        # If no matching file is found, return None
-        return None
-
-    # If the name already ends with the specified extensions, simply complete the path
-    return os.path.join(get_checkpoint_path(), name)
+    # Names without extension match the .safetensors file first, then the .pkl file
+    path = CHECKPOINT_INDEX.get_path(name)
+    if path is None and (name.endswith(".safetensors") or name.endswith(".pkl")):
+        # Not indexed yet, simply complete the path
+        return os.path.join(get_checkpoint_path(), name)
+    return path
 
 
 def get_face_checkpoints() -> List[str]:
     """
     Retrieve a list of face checkpoint paths.
 
-    This function searches for face files with the extension ".safetensors" in the specified directory and returns a list
-    containing the paths of those files.
+    The names of the ".safetensors" and ".pkl" files of the checkpoints directory are served by CHECKPOINT_INDEX,
+    the directory is only scanned again when it changes.
 
     Returns:
         list: A list of face paths, including the string "None" as the first element.
     """
-    faces_path = os.path.join(get_checkpoint_path(), "*.safetensors")
-    faces = glob.glob(faces_path)
-
-    faces_path = os.path.join(get_checkpoint_path(), "*.pkl")
-    faces += glob.glob(faces_path)
-
-    return ["None"] + [os.path.basename(face) for face in sorted(faces)]
+    return ["None"] + CHECKPOINT_INDEX.names()
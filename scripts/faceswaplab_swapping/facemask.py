@@ -1,26 +1,154 @@
+import os
 import cv2
 import numpy as np
 import torch
-from torchvision.transforms.functional import normalize
+from scripts.faceswaplab_globals import FACE_PARSER_DIR
 from scripts.faceswaplab_swapping.parsing import init_parsing_model
-from functools import lru_cache
-from typing import Union, List
+from scripts.faceswaplab_utils.cache_utils import locked_lru_cache
+from scripts.faceswaplab_utils.faceswaplab_logging import logger
+from scripts.faceswaplab_utils.sd_utils import get_sd_option
+from typing import Any, List, Optional, Union
 from torch import device as torch_device
 
+# Mask value of each ParseNet class (background, neck, cloth, hair, hat... are excluded)
+MASK_COLOR_MAP = [
+    0,
+    255,
+    255,
+    255,
+    255,
+    255,
+    255,
+    255,
+    255,
+    255,
+    255,
+    255,
+    255,
+    255,
+    0,
+    255,
+    0,
+    0,
+    0,
+]
+MASK_LUT = np.array(MASK_COLOR_MAP, dtype=np.uint8)
 
-@lru_cache
-def get_parsing_model(device: torch_device) -> torch.nn.Module:
+# Max crops per ParseNet forward pass
+PARSING_BATCH_SIZE = 8
+
+# ParseNet exported by export_parsing_model (faceswaplab_parsing_backend = onnx)
+PARSING_ONNX_PATH = os.path.join(FACE_PARSER_DIR, "parsing_parsenet.onnx")
+
+
+@locked_lru_cache(maxsize=4)
+def get_parsing_model(device: torch_device, half: bool = False) -> torch.nn.Module:
     """
     Returns an instance of the parsing model.
     The returned model is cached for faster subsequent access.
 
     Args:
         device: The torch device to use for computations.
+        half: Convert the model to half precision.
 
     Returns:
         The parsing model.
     """
-    return init_parsing_model(device=device)  # type: ignore
+    model = init_parsing_model(device=device)  # type: ignore
+    return model.half() if half else model
+
+
+def export_parsing_model(output_path: str = PARSING_ONNX_PATH) -> str:
+    """
+    Export ParseNet to onnx, with dynamic batch and image size axes.
+
+    Only the parsing output (N, 19, H, W) is kept. The file is written under a temporary name and
+    renamed, so that a failed export does not leave a broken model.
+
+    Args:
+        output_path (str, optional): Defaults to PARSING_ONNX_PATH.
+
+    Returns:
+        str: The path of the onnx model
+    """
+
+    class ParsingOutput(torch.nn.Module):
+        def __init__(self, model: torch.nn.Module) -> None:
+            super().__init__()
+            self.model = model
+
+        def forward(self, x: torch.Tensor) -> torch.Tensor:
+            return self.model(x)[0]
+
+    logger.info("Export face parser to %s", output_path)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    model = ParsingOutput(init_parsing_model(device="cpu")).eval()  # type: ignore
+    tmp_path = output_path + ".tmp"
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (torch.zeros((1, 3, 512, 512)),),
+            tmp_path,
+            input_names=["input"],
+            output_names=["parsing"],
+            dynamic_axes={
+                "input": {0: "batch", 2: "height", 3: "width"},
+                "parsing": {0: "batch", 2: "height", 3: "width"},
+            },
+            opset_version=14,
+        )
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+@locked_lru_cache(maxsize=1)
+def get_parsing_session() -> Any:
+    """
+    Returns the onnxruntime session of the exported parser (exported on first use).
+
+    The session uses the providers and the thread settings of the swap model.
+    """
+    from scripts.faceswaplab_swapping import swapper
+    from scripts.faceswaplab_utils.onnx_sessions import SWAP_SESSION, create_session
+
+    if not os.path.exists(PARSING_ONNX_PATH):
+        export_parsing_model()
+    return create_session(PARSING_ONNX_PATH, swapper.get_providers(), SWAP_SESSION)
+
+
+def parse_faces_torch(
+    batch: np.ndarray, device: torch.device, half: bool = False
+) -> np.ndarray:
+    """
+    Run ParseNet in pytorch on a batch of RGB uint8 images (N, H, W, 3).
+
+    Returns:
+        The class of each pixel (N, H, W) as uint8.
+    """
+    face_input = torch.from_numpy(batch).to(device).permute(0, 3, 1, 2)
+    face_input = face_input.half() if half else face_input.float()
+    # Same as normalize(x / 255, 0.5, 0.5)
+    face_input = face_input / 127.5 - 1
+
+    with torch.no_grad():
+        model_output = get_parsing_model(device, half)(face_input)[0]
+    return model_output.argmax(dim=1).to(torch.uint8).cpu().numpy()
+
+
+def parse_faces_onnx(batch: np.ndarray, session: Optional[Any] = None) -> np.ndarray:
+    """
+    Run the exported ParseNet with onnxruntime on a batch of RGB uint8 images (N, H, W, 3).
+
+    Args:
+        session: Defaults to get_parsing_session().
+
+    Returns:
+        The class of each pixel (N, H, W) as uint8.
+    """
+    session = session or get_parsing_session()
+    face_input = batch.transpose(0, 3, 1, 2).astype(np.float32) / 127.5 - 1
+    parsing = session.run(None, {session.get_inputs()[0].name: face_input})[0]
+    return parsing.argmax(axis=1).astype(np.uint8)
 
 
 def convert_image_to_tensor(
@@ -61,64 +189,68 @@ def convert_image_to_tensor(
         return _convert_single_image_to_tensor(images, convert_bgr_to_rgb, use_float32)
 
 
+def generate_face_masks(
+    face_images: List[np.ndarray],
+    device: torch.device,
+    size: Optional[int] = None,
+    half: Optional[bool] = None,
+) -> List[np.ndarray]:
+    """
+    Generates the face masks of several face images with batched ParseNet forward passes.
+
+    ParseNet runs in pytorch, or with onnxruntime when faceswaplab_parsing_backend is onnx (see
+    export_parsing_model).
+
+    Args:
+        face_images: The face images (BGR) in numpy.ndarray format, of any size.
+        device: The torch device to use for computations.
+        size: The parsing resolution (multiple of 32). Defaults to faceswaplab_parsing_size (512).
+        half: Run the model in half precision (cuda only). Defaults to faceswaplab_parsing_fp16.
+            Ignored by the onnx backend.
+
+    Returns:
+        The face masks (uint8, 0 or 255 with interpolated borders), each one of the size of its image.
+    """
+    if size is None:
+        size = int(get_sd_option("faceswaplab_parsing_size", 512))
+    if half is None:
+        half = get_sd_option("faceswaplab_parsing_fp16", False)
+    half = bool(half) and torch.device(device).type == "cuda"
+    use_onnx = get_sd_option("faceswaplab_parsing_backend", "torch") == "onnx"
+
+    masks: List[np.ndarray] = []
+    for start in range(0, len(face_images), PARSING_BATCH_SIZE):
+        images = face_images[start : start + PARSING_BATCH_SIZE]
+        # Resize the face images for the model, BGR -> RGB
+        batch = np.stack(
+            [
+                cv2.resize(image, (size, size), interpolation=cv2.INTER_LINEAR)[
+                    :, :, ::-1
+                ]
+                for image in images
+            ]
+        )
+        # Pass the images through the model
+        if use_onnx:
+            labels = parse_faces_onnx(batch)
+        else:
+            labels = parse_faces_torch(batch, device, half)
+
+        # Generate the masks from the model output and resize them to match the images
+        for image, parse_mask in zip(images, MASK_LUT[labels]):
+            masks.append(cv2.resize(parse_mask, (image.shape[1], image.shape[0])))
+    return masks
+
+
 def generate_face_mask(face_image: np.ndarray, device: torch.device) -> np.ndarray:
     """
-    Generates a face mask given a face image.
+    Generates a face mask given a face image (see generate_face_masks).
 
     Args:
         face_image: The face image in numpy.ndarray format.
         device: The torch device to use for computations.
 
     Returns:
-        The face mask as a numpy.ndarray.
-    """
-    # Resize the face image for the model
-    resized_face_image = cv2.resize(
-        face_image, (512, 512), interpolation=cv2.INTER_LINEAR
-    )
-
-    # Preprocess the image
-    face_input = convert_image_to_tensor(
-        (resized_face_image.astype("float32") / 255.0),
-        convert_bgr_to_rgb=True,
-        use_float32=True,
-    )
-    normalize(face_input, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)  # type: ignore
-    assert isinstance(face_input, torch.Tensor)
-    face_input = torch.unsqueeze(face_input, 0).to(device)
-
-    # Pass the image through the model
-    with torch.no_grad():
-        model_output = get_parsing_model(device)(face_input)[0]
-    model_output = model_output.argmax(dim=1).squeeze().cpu().numpy()
-
-    # Generate the mask from the model output
-    parse_mask = np.zeros(model_output.shape)
-    MASK_COLOR_MAP = [
-        0,
-        255,
-        255,
-        255,
-        255,
-        255,
-        255,
-        255,
-        255,
-        255,
-        255,
-        255,
-        255,
-        255,
-        0,
-        255,
-        0,
-        0,
-        0,
-    ]
-    for idx, color in enumerate(MASK_COLOR_MAP):
-        parse_mask[model_output == idx] = color
-
-    # Resize the mask to match the original image
-    face_mask = cv2.resize(parse_mask, (face_image.shape[1], face_image.shape[0]))
-
-    return face_mask
+        The face mask as a numpy.ndarray (uint8).
+    """
+    return generate_face_masks([face_image], device)[0]
@@ -0,0 +1,119 @@
+import threading
+import time
+import traceback
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+
+import gradio as gr
+import numpy as np
+from fastapi import FastAPI
+from insightface.app.common import Face
+from modules import shared
+
+from scripts.faceswaplab_swapping import swapper
+from scripts.faceswaplab_swapping.face_analysis import (
+    DETECTION,
+    GENDER_AGE,
+    RECOGNITION,
+)
+from scripts.faceswaplab_swapping.facemask import generate_face_mask
+from scripts.faceswaplab_utils.faceswaplab_logging import logger
+from scripts.faceswaplab_utils.models_utils import get_current_swap_model
+from scripts.faceswaplab_utils.sd_utils import get_sd_option
+
+
+@dataclass
+class PreloadState:
+    # disabled, loading, ready or failed
+    status: str = "disabled"
+    error: Optional[str] = None
+    # Load + warm up time of each model, in seconds
+    timings: Dict[str, float] = field(default_factory=dict)
+
+    @property
+    def ready(self) -> bool:
+        return self.status == "ready"
+
+
+PRELOAD_STATE = PreloadState()
+
+
+def is_preload_enabled() -> bool:
+    return getattr(shared.cmd_opts, "faceswaplab_preload", False) or get_sd_option(
+        "faceswaplab_preload_models", False
+    )
+
+
+def warmup_models() -> None:
+    """
+    Load the analysis, swap and face parsing models and run a dummy inference through each.
+
+    The first inference of an onnxruntime session is much slower than the next ones (graph setup,
+    memory arenas), so models are run once at the configured det_size.
+    """
+    use_gpu = not swapper.is_cpu_provider()
+    det_size = get_sd_option("faceswaplab_det_size", 640)
+
+    def timed(name: str, func: Any) -> None:
+        start = time.perf_counter()
+        func()
+        PRELOAD_STATE.timings[name] = time.perf_counter() - start
+        logger.info("Preload %s in %.2fs", name, PRELOAD_STATE.timings[name])
+
+    def warmup_analysis() -> None:
+        analyser = swapper.getAnalysisModel(use_gpu=use_gpu)
+        analyser.get(
+            np.zeros((det_size, det_size, 3), dtype=np.uint8),
+            det_size=(det_size, det_size),
+            modules=[DETECTION],
+        )
+        # No face is found in a blank image, call the other modules directly
+        face = Face(bbox=np.array([0, 0, 96, 96], dtype=np.float32))
+        analyser.load_module(GENDER_AGE).get(
+            np.zeros((96, 96, 3), dtype=np.uint8), face
+        )
+        analyser.load_module(RECOGNITION).get_feat(
+            np.zeros((112, 112, 3), dtype=np.uint8)
+        )
+
+    def warmup_swap() -> None:
+        model = swapper.getFaceSwapModel(
+            swapper.get_swap_model_path(get_current_swap_model()), use_gpu=use_gpu
+        )
+        latent = np.ones((1, model.emap.shape[0]), dtype=np.float32)
+        latent /= np.linalg.norm(latent)
+        model.infer(np.zeros((1, 3, *model.input_size[::-1]), dtype=np.float32), latent)
+
+    def warmup_parser() -> None:
+        generate_face_mask(
+            np.zeros((512, 512, 3), dtype=np.uint8), device=shared.device
+        )
+
+    timed("analysis", warmup_analysis)
+    timed("swap", warmup_swap)
+    timed("parser", warmup_parser)
+
+
+def preload_models() -> None:
+    PRELOAD_STATE.status = "loading"
+    try:
+        warmup_models()
+        PRELOAD_STATE.status = "ready"
+        logger.info("FaceSwapLab models are loaded and warm")
+    except Exception as e:
+        PRELOAD_STATE.status = "failed"
+        PRELOAD_STATE.error = str(e)
+        logger.error("Failed to preload models : %s", e)
+        traceback.print_exc()
+
+
+def start_preloader(_: gr.Blocks, app: FastAPI) -> None:
+    """
+    on_app_started callback : start preloading models in a background thread if enabled.
+    """
+    if is_preload_enabled():
+        logger.info("Preload FaceSwapLab models in background")
+        PRELOAD_STATE.status = "loading"
+        threading.Thread(
+            target=preload_models, name="faceswaplab_preloader", daemon=True
+        ).start()
@@ -1,10 +1,26 @@
 import copy
+import hashlib
+import logging
 import os
 from dataclasses import dataclass
 from pprint import pformat
 import traceback
-from typing import Any, Dict, Generator, List, Set, Tuple, Optional, Union
+from typing import (
+    Any,
+    Callable,
+    Collection,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Sequence,
+    Set,
+    Tuple,
+    Optional,
+    Union,
+)
 import tempfile
+import threading
 from tqdm import tqdm
 import sys
 from io import StringIO
@@ -14,17 +30,34 @@ import cv2
 import insightface
 import numpy as np
 from insightface.app.common import Face as ISFace
+from insightface.model_zoo.inswapper import INSwapper
 
 from PIL import Image
 from sklearn.metrics.pairwise import cosine_similarity
 
 from scripts.faceswaplab_swapping import upscaled_inswapper
+from scripts.faceswaplab_swapping.face_analysis import (
+    ALL_MODULES,
+    GENDER_AGE,
+    RECOGNITION,
+    SOURCE_MODULES,
+    SWAP_MODULES,
+    LazyFaceAnalysis,
+)
 from scripts.faceswaplab_swapping.upcaled_inswapper_options import InswappperOptions
 from scripts.faceswaplab_utils.imgutils import (
+    as_cv2,
+    as_pil,
+    crop_cv2,
+    cv2_to_pil,
     pil_to_cv2,
-    check_against_nsfw,
 )
 from scripts.faceswaplab_utils.faceswaplab_logging import logger, save_img_debug
+from scripts.faceswaplab_utils.cache_utils import (
+    ContentCache,
+    image_hash,
+    locked_lru_cache,
+)
 from scripts import faceswaplab_globals
 from functools import lru_cache
 from scripts.faceswaplab_ui.faceswaplab_unit_settings import FaceSwapUnitSettings
@@ -32,11 +65,17 @@ from scripts.faceswaplab_postprocessing.postprocessing import enhance_image
 from scripts.faceswaplab_postprocessing.postprocessing_options import (
     PostProcessingOptions,
 )
-from scripts.faceswaplab_utils.models_utils import get_current_swap_model
-from scripts.faceswaplab_utils.typing import CV2ImgU8, Gender, PILImage, Face
+from scripts.faceswaplab_utils.models_utils import (
+    get_current_swap_model,
+    get_dynamic_batch_model,
+)
+from scripts.faceswaplab_utils.onnx_sessions import SWAP_SESSION, create_session
+from scripts.faceswaplab_utils.typing import AnyImage, CV2ImgU8, Gender, PILImage, Face
 from scripts.faceswaplab_inpainting.i2i_pp import img2img_diffusion
 from modules import shared
 import onnxruntime
+from scripts.faceswaplab_utils.nsfw import check_against_nsfw, check_against_nsfw_batch
+from scripts.faceswaplab_utils.pipeline import Pipeline, PipelineResult, Stage
 from scripts.faceswaplab_utils.sd_utils import get_sd_option
 
 
@@ -112,22 +151,27 @@ def cosine_similarity_face(face1: Face, face2: Face) -> float:
     return max(0, similarity[0, 0])
 
 
-def compare_faces(img1: PILImage, img2: PILImage) -> float:
+def compare_faces(
+    img1: Union[PILImage, CV2ImgU8], img2: Union[PILImage, CV2ImgU8]
+) -> float:
     """
     Compares the similarity between two faces extracted from images using cosine similarity.
 
     Args:
-        img1: The first image containing a face.
-        img2: The second image containing a face.
+        img1: The first image containing a face (PIL or BGR array).
+        img2: The second image containing a face (PIL or BGR array).
 
     Returns:
         A float value representing the similarity between the two faces (0 to 1).
         Returns -1 if one or both of the images do not contain any faces.
     """
 
+    def to_cv2(img: Union[PILImage, CV2ImgU8]) -> CV2ImgU8:
+        return img if isinstance(img, np.ndarray) else pil_to_cv2(img)
+
     # Extract faces from the images
-    face1 = get_or_default(get_faces(pil_to_cv2(img1)), 0, None)
-    face2 = get_or_default(get_faces(pil_to_cv2(img2)), 0, None)
+    face1 = get_or_default(get_faces(to_cv2(img1), modules=SOURCE_MODULES), 0, None)
+    face2 = get_or_default(get_faces(to_cv2(img2), modules=SOURCE_MODULES), 0, None)
 
     # Check if both faces are detected
     if face1 is not None and face2 is not None:
@@ -138,67 +182,248 @@ def compare_faces(img1: PILImage, img2: PILImage) -> float:
     return -1
 
 
+class ProcessingCancelled(Exception):
+    """Exception raised when a processing is cancelled through its ProcessingMonitor."""
+
+
+class ProcessingMonitor:
+    """
+    Follow the progress of batch_process or process_images_units and cancel them from another thread.
+
+    Cancellation is checked between images and between units, the unit being processed is finished.
+    """
+
+    def __init__(
+        self,
+        is_cancelled: Callable[[], bool] = lambda: False,
+        on_progress: Callable[[float], None] = lambda progress: None,
+    ) -> None:
+        """
+        Args:
+            is_cancelled (Callable[[], bool]): Return True to stop the processing (ProcessingCancelled is raised).
+            on_progress (Callable[[float], None]): Called with the progress (0 to 1) after each unit.
+        """
+        self.is_cancelled = is_cancelled
+        self.on_progress = on_progress
+        self.total_steps = 1
+        self.steps = 0
+        self._lock = threading.Lock()
+
+    def check_cancelled(self) -> None:
+        if self.is_cancelled():
+            raise ProcessingCancelled("Processing cancelled")
+
+    def set_steps(self, total_steps: int) -> None:
+        self.total_steps = max(total_steps, 1)
+        self.steps = 0
+
+    def step(self) -> None:
+        with self._lock:
+            self.steps += 1
+            progress = min(self.steps / self.total_steps, 1.0)
+        self.on_progress(progress)
+
+
+@dataclass
+class BatchItem:
+    """
+    An image going through the batch pipeline (see iter_batch_pipeline).
+    """
+
+    # File name, image, or anything the decode function accepts
+    source: Any
+    # The decoded source (PIL or BGR array), then one of the swapped images (PIL)
+    image: Optional[AnyImage] = None
+    info: Optional[str] = None
+    # Position of the image among the swapped images of the source
+    number: int = 0
+    # Value returned by the encode function
+    output: Any = None
+
+
+# Stats of the last batch pipeline run, exposed by the API
+BATCH_PIPELINE_STATS: Dict[str, float] = {}
+
+
+def open_batch_image(source: Union[AnyImage, str]) -> AnyImage:
+    if isinstance(source, np.ndarray):
+        return source
+    image = Image.open(source) if isinstance(source, str) else source
+    # PIL decodes lazily, decode in the decode stage
+    image.load()
+    return image
+
+
+def iter_batch_pipeline(
+    sources: Collection[Any],
+    units: List[FaceSwapUnitSettings],
+    postprocess_options: Optional[PostProcessingOptions],
+    monitor: Optional[ProcessingMonitor] = None,
+    decode: Callable[[Any], AnyImage] = open_batch_image,
+    encode: Optional[Callable[[BatchItem], Any]] = None,
+) -> Generator[PipelineResult, None, None]:
+    """
+    Swap the units in each source image through a staged pipeline : decode, swap and encode run on
+    their own threads, connected by bounded queues, so that the next images are decoded and the
+    previous ones encoded while an image is swapped. Each swapped image is passed to the next
+    stages as soon as it is produced (see iter_process_images_units).
+
+    The number of threads of each stage and the queue size are set by the
+    faceswaplab_pipeline_* settings. The swap stage owns the onnx sessions and the webui models, it
+    also post-processes the swapped images, and has one thread by default. The encode stage is
+    skipped if encode is None.
+
+    Args:
+        sources (Collection[Any]): The images, passed to decode.
+        units (List[FaceSwapUnitSettings]): The enabled units.
+        postprocess_options (Optional[PostProcessingOptions]): Post-processing settings.
+        monitor (Optional[ProcessingMonitor], optional): Reports progress and checks cancellation between units.
+        decode (Callable[[Any], AnyImage], optional): Decode a source. Defaults to open_batch_image.
+        encode (Optional[Callable[[BatchItem], Any]], optional): Encode or save the results of an item, the returned value is stored in item.output.
+
+    Yields:
+        PipelineResult: The results of each source, in order. The value of a result is the BatchItem
+            of one swapped image, or its error the exception raised by a stage. A source without
+            swapped image has a single empty result.
+    """
+    if monitor:
+        monitor.set_steps(len(sources) * len(units))
+
+    def decode_stage(item: BatchItem) -> BatchItem:
+        item.image = decode(item.source)
+        return item
+
+    def swap_stage(item: BatchItem) -> Generator[BatchItem, None, None]:
+        number = -1
+        for number, (image, info) in enumerate(
+            iter_process_images_units(
+                get_current_swap_model(),
+                images=[(item.image, None)],
+                units=units,
+                monitor=monitor,
+            )
+        ):
+            # Post-processing runs on the swap thread : it uses the same webui models (upscalers,
+            # restorers, inpainting) as the upscaled swapper
+            if postprocess_options:
+                image = enhance_image(image, postprocess_options)
+            yield BatchItem(source=item.source, image=image, info=info, number=number)
+        logger.info("%s images generated", number + 1)
+
+    def encode_stage(item: BatchItem) -> BatchItem:
+        assert encode
+        item.output = encode(item)
+        return item
+
+    def workers(stage: str, default: int) -> int:
+        return int(get_sd_option(f"faceswaplab_pipeline_{stage}_workers", default))
+
+    stages = [
+        Stage("decode", decode_stage, workers("decode", 2)),
+        Stage("swap", swap_stage, workers("swap", 1), expand=True),
+    ]
+    if encode:
+        stages.append(Stage("encode", encode_stage, workers("encode", 2)))
+
+    pipeline = Pipeline(
+        "batch", stages, queue_size=get_sd_option("faceswaplab_pipeline_queue_size", 2)
+    )
+    try:
+        yield from pipeline.run([BatchItem(source=source) for source in sources])
+    finally:
+        BATCH_PIPELINE_STATS.clear()
+        BATCH_PIPELINE_STATS.update(pipeline.stats())
+
+
+def iter_batch_process(
+    src_images: Collection[Union[AnyImage, str]],  # image or filename
+    save_path: Optional[str],
+    units: List[FaceSwapUnitSettings],
+    postprocess_options: Optional[PostProcessingOptions],
+    monitor: Optional[ProcessingMonitor] = None,
+) -> Generator[PILImage, None, None]:
+    """
+    Generator version of batch_process : yield each processed image as soon as it is ready (and
+    saved), so that callers can use it before the whole batch is done.
+
+    Images go through the batch pipeline (see iter_batch_pipeline). Closing the generator stops
+    it, and the first error stops the batch and is raised to the caller.
+
+    Yields:
+        PILImage: The processed images, in source order.
+    """
+    if save_path:
+        os.makedirs(save_path, exist_ok=True)
+
+    units = [u for u in units if u.enable]
+    if src_images is None or len(units) == 0:
+        return
+
+    def save(item: BatchItem) -> None:
+        assert save_path and item.image
+        if isinstance(item.source, str):
+            name, ext = os.path.splitext(os.path.basename(item.source))
+            suffix = f"_{item.number}" if item.number else ""
+            path = os.path.join(save_path, f"swapped_{name}{suffix}{ext}")
+        else:
+            path = tempfile.NamedTemporaryFile(
+                delete=False, suffix=".png", dir=save_path
+            ).name
+        as_pil(item.image).save(path)
+
+    results = iter_batch_pipeline(
+        src_images,
+        units,
+        postprocess_options,
+        monitor=monitor,
+        encode=save if save_path else None,
+    )
+    try:
+        for result in results:
+            if result.error is not None:
+                raise result.error
+            if not result.empty:
+                yield result.value.image
+    finally:
+        results.close()
+
+
 def batch_process(
-    src_images: List[Union[PILImage, str]],  # image or filename
+    src_images: List[Union[AnyImage, str]],  # image or filename
     save_path: Optional[str],
     units: List[FaceSwapUnitSettings],
     postprocess_options: Optional[PostProcessingOptions],
+    monitor: Optional[ProcessingMonitor] = None,
 ) -> Optional[List[PILImage]]:
     """
     Process a batch of images, apply face swapping according to the given settings, and optionally save the resulting images to a specified path.
 
     Args:
-        src_images (List[Union[PILImage, str]]): List of source PIL Images to process or list of images file names
+        src_images (List[Union[AnyImage, str]]): List of source images (PIL or BGR arrays) to process or list of images file names
         save_path (Optional[str]): Destination path where the processed images will be saved. If None, no images are saved.
         units (List[FaceSwapUnitSettings]): List of FaceSwapUnitSettings to apply to the images.
         postprocess_options (PostProcessingOptions): Post-processing settings to be applied to the images.
+        monitor (Optional[ProcessingMonitor]): Reports progress and checks cancellation between images and units.
 
     Returns:
         Optional[List[PILImage]]: List of processed images, or None in case of an exception.
 
     Raises:
-        Any exceptions raised by the underlying process will be logged and the function will return None.
+        ProcessingCancelled: If the monitor cancelled the processing.
+        Any other exceptions raised by the underlying process will be logged and the function will return None.
     """
     try:
-        if save_path:
-            os.makedirs(save_path, exist_ok=True)
-
-        units = [u for u in units if u.enable]
-        if src_images is not None and len(units) > 0:
-            result_images = []
-            for src_image in src_images:
-                path: str = ""
-                if isinstance(src_image, str):
-                    if save_path:
-                        path = os.path.join(
-                            save_path, "swapped_" + os.path.basename(src_image)
-                        )
-                    src_image = Image.open(src_image)
-                elif save_path:
-                    path = tempfile.NamedTemporaryFile(
-                        delete=False, suffix=".png", dir=save_path
-                    ).name
-                assert isinstance(src_image, Image.Image)
-
-                current_images = []
-                swapped_images = process_images_units(
-                    get_current_swap_model(), images=[(src_image, None)], units=units
+        if src_images is not None and len([u for u in units if u.enable]) > 0:
+            return list(
+                iter_batch_process(
+                    src_images, save_path, units, postprocess_options, monitor=monitor
                 )
-                if swapped_images and len(swapped_images) > 0:
-                    current_images += [img for img, _ in swapped_images]
-
-                logger.info("%s images generated", len(current_images))
-
-                if postprocess_options:
-                    for i, img in enumerate(current_images):
-                        current_images[i] = enhance_image(img, postprocess_options)
-
-                if save_path:
-                    for img in current_images:
-                        img.save(path)
-
-                result_images += current_images
-            return result_images
+            )
+        elif save_path:
+            os.makedirs(save_path, exist_ok=True)
+    except ProcessingCancelled:
+        logger.info("Batch Process cancelled")
+        raise
     except Exception as e:
         logger.error("Batch Process error : %s", e)
         import traceback
@@ -207,8 +432,50 @@ def batch_process(
     return None
 
 
+def iter_extract_faces(
+    images: Collection[AnyImage],
+    extract_path: Optional[str],
+    postprocess_options: Optional[PostProcessingOptions],
+) -> Generator[PILImage, None, None]:
+    """
+    Generator version of extract_faces : yield each face as soon as it is extracted and
+    post-processed. Exceptions are raised to the caller.
+
+    Images can be BGR arrays, only the face crops are then converted to PIL.
+    """
+    if extract_path:
+        os.makedirs(extract_path, exist_ok=True)
+
+    for img in images or []:
+        faces = get_faces(as_cv2(img), modules=SWAP_MODULES)
+
+        for face in faces or []:
+            bbox = face.bbox.astype(int)  # type: ignore
+            x_min, y_min, x_max, y_max = bbox
+            if isinstance(img, np.ndarray):
+                face_image = cv2_to_pil(crop_cv2(img, (x_min, y_min, x_max, y_max)))
+            else:
+                face_image = img.crop((x_min, y_min, x_max, y_max))
+
+            if postprocess_options and (
+                postprocess_options.face_restorer_name
+                or postprocess_options.restorer_visibility
+            ):
+                postprocess_options.scale = (
+                    1 if face_image.width > 512 else 512 // face_image.width
+                )
+                face_image = enhance_image(face_image, postprocess_options)
+
+            if extract_path:
+                path = tempfile.NamedTemporaryFile(
+                    delete=False, suffix=".png", dir=extract_path
+                ).name
+                face_image.save(path)
+            yield face_image
+
+
 def extract_faces(
-    images: List[PILImage],
+    images: Sequence[AnyImage],
     extract_path: Optional[str],
     postprocess_options: PostProcessingOptions,
 ) -> Optional[List[PILImage]]:
@@ -230,40 +497,10 @@ def extract_faces(
     """
 
     try:
-        if extract_path:
-            os.makedirs(extract_path, exist_ok=True)
-
         if images:
-            result_images: list[PILImage] = []
-            for img in images:
-                faces = get_faces(pil_to_cv2(img))
-
-                if faces:
-                    face_images = []
-                    for face in faces:
-                        bbox = face.bbox.astype(int)  # type: ignore
-                        x_min, y_min, x_max, y_max = bbox
-                        face_image = img.crop((x_min, y_min, x_max, y_max))
-
-                        if postprocess_options and (
-                            postprocess_options.face_restorer_name
-                            or postprocess_options.restorer_visibility
-                        ):
-                            postprocess_options.scale = (
-                                1 if face_image.width > 512 else 512 // face_image.width
-                            )
-                            face_image = enhance_image(face_image, postprocess_options)
-
-                        if extract_path:
-                            path = tempfile.NamedTemporaryFile(
-                                delete=False, suffix=".png", dir=extract_path
-                            ).name
-                            face_image.save(path)
-                        face_images.append(face_image)
-
-                    result_images += face_images
-
-            return result_images
+            return list(iter_extract_faces(images, extract_path, postprocess_options))
+        elif extract_path:
+            os.makedirs(extract_path, exist_ok=True)
     except Exception as e:
         logger.error("Failed to extract : %s", e)
         import traceback
@@ -311,17 +548,18 @@ def capture_stdout() -> Generator[StringIO, None, None]:
         sys.stdout = original_stdout  # Type: ignore
 
 
-@lru_cache(maxsize=3)
-def getAnalysisModel(
-    det_size: Tuple[int, int] = (640, 640),
-    det_thresh: float = 0.5,
-    use_gpu: bool = False,
-) -> insightface.app.FaceAnalysis:
+@locked_lru_cache(maxsize=2)
+def getAnalysisModel(use_gpu: bool = False) -> LazyFaceAnalysis:
     """
     Retrieves the analysis model for face analysis.
 
+    Only the detection module is loaded here, the other buffalo_l modules (gender/age, recognition,
+    landmarks) are loaded the first time a caller requests them. The model is shared by all
+    det_size and det_thresh values (they are parameters of LazyFaceAnalysis.get), so it is only
+    loaded once per provider.
+
     Returns:
-        insightface.app.FaceAnalysis: The analysis model for face analysis.
+        LazyFaceAnalysis: The analysis model for face analysis.
     """
     try:
         if not os.path.exists(faceswaplab_globals.ANALYZER_DIR):
@@ -329,24 +567,21 @@ def getAnalysisModel(
 
         providers = get_providers()
         logger.info(
-            f"Load analysis model det_size={det_size}, det_thresh={det_thresh}, providers = {providers}, will take some time. (> 30s)"
+            f"Load analysis model providers = {providers}, will take some time. (> 30s)"
         )
         # Initialize the analysis model with the specified name and providers
 
         with tqdm(
             total=1,
-            desc=f"Loading {det_size} analysis model (first time is slow)",
+            desc=f"Loading analysis model (first time is slow)",
             unit="model",
         ) as pbar:
             with capture_stdout() as captured:
-                model = insightface.app.FaceAnalysis(
+                model = LazyFaceAnalysis(
                     name="buffalo_l",
                     providers=providers,
                     root=faceswaplab_globals.ANALYZER_DIR,
                 )
-
-                # Prepare the analysis model for face detection with the specified detection size
-                model.prepare(ctx_id=0, det_thresh=det_thresh, det_size=det_size)
             pbar.update(1)
         logger.info("%s", pformat(captured.getvalue()))
 
@@ -358,7 +593,16 @@ def getAnalysisModel(
         raise FaceModelException("Loading of analysis model failed")
 
 
-@lru_cache(maxsize=1)
+def get_swap_model_path(model: str) -> str:
+    """
+    Path given to getFaceSwapModel for a swap model (relative paths are resolved from this
+    directory). Only the last model is cached, by path : every caller builds the path with this
+    function so that they share the loaded session.
+    """
+    return os.path.join(os.path.abspath(os.path.dirname(__file__)), model)
+
+
+@locked_lru_cache(maxsize=1)
 def getFaceSwapModel(
     model_path: str, use_gpu: bool = False
 ) -> upscaled_inswapper.UpscaledINSwapper:
@@ -373,10 +617,15 @@ def getFaceSwapModel(
     """
     try:
         providers = get_providers()
+        if get_sd_option("faceswaplab_dynamic_batch", False):
+            model_path = get_dynamic_batch_model(model_path)
         with tqdm(total=1, desc="Loading swap model", unit="model") as pbar:
             with capture_stdout() as captured:
                 model = upscaled_inswapper.UpscaledINSwapper(
-                    insightface.model_zoo.get_model(model_path, providers=providers)  # type: ignore
+                    INSwapper(
+                        model_file=model_path,
+                        session=create_session(model_path, providers, SWAP_SESSION),
+                    )
                 )
             pbar.update(1)
         logger.info("%s", pformat(captured.getvalue()))
@@ -390,37 +639,235 @@ def getFaceSwapModel(
         raise FaceModelException("Loading of swapping model failed")
 
 
+def get_detection_cache_max_bytes() -> int:
+    return int(get_sd_option("faceswaplab_detection_cache_size", 64) * 1024 * 1024)
+
+
+DETECTION_CACHE: ContentCache[List[Face]] = ContentCache(
+    "detection", max_bytes=get_detection_cache_max_bytes
+)
+
+
+def get_detection_parameters(
+    det_thresh: Optional[float], det_size: Tuple[int, int]
+) -> Tuple[float, Tuple[int, int], bool]:
+    """
+    Resolve the detection parameters from the settings.
+
+    Returns:
+        Tuple[float, Tuple[int, int], bool]: det_thresh, det_size and auto_det_size
+    """
+    if det_thresh is None:
+        det_thresh = get_sd_option("faceswaplab_detection_threshold", 0.5)
+
+    auto_det_size = get_sd_option("faceswaplab_auto_det_size", True)
+    if not auto_det_size:
+        x = get_sd_option("faceswaplab_det_size", 640)
+        det_size = (x, x)
+    return det_thresh, det_size, auto_det_size
+
+
 def get_faces(
     img_data: CV2ImgU8,
     det_thresh: Optional[float] = None,
     det_size: Tuple[int, int] = (640, 640),
+    modules: Collection[str] = ALL_MODULES,
 ) -> List[Face]:
     """
     Detects and retrieves faces from an image using an analysis model.
 
+    Results are cached by image content, det_size and det_thresh (see DETECTION_CACHE), so
+    detecting faces again on unchanged pixels is free. Cached faces are completed with the
+    requested modules if they did not run yet.
+
     Args:
         img_data (CV2ImgU8): The image data as a NumPy array.
         det_size (tuple): The desired detection size (width, height). Defaults to (640, 640).
-        sort_by_face_size (bool) : Will sort the faces by their size from larger to smaller face
+        modules (Collection[str]): The analysis modules to run on each face (see face_analysis).
+            Use SWAP_MODULES when only bbox and kps are needed. Defaults to ALL_MODULES.
 
     Returns:
         list: A list of detected faces, sorted by their x-coordinate of the bounding box.
     """
 
-    if det_thresh is None:
-        det_thresh = get_sd_option("faceswaplab_detection_threshold", 0.5)
+    det_thresh, det_size, auto_det_size = get_detection_parameters(det_thresh, det_size)
+    cache_key = (image_hash(img_data), det_size, det_thresh, auto_det_size)
+    faces = DETECTION_CACHE.get(cache_key)
+    if faces is None:
+        faces = detect_faces(
+            img_data,
+            det_thresh=det_thresh,
+            det_size=det_size,
+            auto_det_size=auto_det_size,
+            modules=modules,
+        )
+        DETECTION_CACHE.put(cache_key, faces)
+    else:
+        face_analyser = getAnalysisModel(use_gpu=not is_cpu_provider())
+        if face_analyser.complete(img_data, faces, modules):
+            # Update the size of the entry
+            DETECTION_CACHE.put(cache_key, faces)
+    return list(faces)
 
-    auto_det_size = get_sd_option("faceswaplab_auto_det_size", True)
-    if not auto_det_size:
-        x = get_sd_option("faceswaplab_det_size", 640)
-        det_size = (x, x)
 
-    face_analyser = getAnalysisModel(
-        det_size=det_size, det_thresh=det_thresh, use_gpu=not is_cpu_provider()
+def get_source_cache_max_bytes() -> int:
+    return int(get_sd_option("faceswaplab_source_cache_size", 16) * 1024 * 1024)
+
+
+SOURCE_FACES_CACHE: ContentCache[List[Face]] = ContentCache(
+    "source_faces", max_bytes=get_source_cache_max_bytes
+)
+
+SOURCE_FACES_DIR = os.path.join(faceswaplab_globals.MODELS_DIR, "source_cache")
+# What a source face needs : detection, gender, age and recognition results
+SOURCE_FACE_KEYS = ["bbox", "kps", "det_score", "embedding", "gender", "age"]
+SOURCE_FACE_SCALARS = ["det_score", "gender", "age"]
+
+
+def source_content_hash(source: Union[bytes, PILImage, CV2ImgU8]) -> str:
+    """
+    Hash a source image. Encoded images (file or base64 content) are hashed without decoding them.
+    """
+    if isinstance(source, bytes):
+        return hashlib.sha1(source, usedforsecurity=False).hexdigest()
+    return image_hash(source)
+
+
+def purge_source_faces_dir(max_bytes: int) -> int:
+    """
+    Delete the least recently used files of SOURCE_FACES_DIR until it holds at most max_bytes.
+    Loading a file updates its modification time (see get_source_faces).
+
+    Returns:
+        int: The number of deleted files.
+    """
+    try:
+        entries = [
+            (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+            for entry in os.scandir(SOURCE_FACES_DIR)
+            if entry.is_file() and entry.name.endswith(".safetensors")
+        ]
+    except FileNotFoundError:
+        return 0
+    total = sum(size for _, size, _ in entries)
+    deleted = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.warning("Failed to delete cached source faces %s : %s", path, e)
+            continue
+        total -= size
+        deleted += 1
+    if deleted:
+        logger.info("Deleted %s cached source faces files", deleted)
+    return deleted
+
+
+def save_source_faces(path: str, faces: List[Face]) -> None:
+    from safetensors.numpy import save_file
+
+    tensors = {}
+    for i, face in enumerate(faces):
+        for key in SOURCE_FACE_KEYS:
+            if face.get(key) is not None:
+                tensors[f"{i}.{key}"] = np.ascontiguousarray(np.array(face[key]))
+    os.makedirs(SOURCE_FACES_DIR, exist_ok=True)
+    save_file(tensors, path, metadata={"count": str(len(faces))})
+
+
+def load_source_faces(path: str) -> List[Face]:
+    from safetensors import safe_open
+
+    with safe_open(path, framework="numpy") as f:  # type: ignore
+        count = int(f.metadata()["count"])
+        faces = [Face() for _ in range(count)]
+        for name in f.keys():
+            i, key = name.split(".", 1)
+            value = f.get_tensor(name)
+            faces[int(i)][key] = value.item() if key in SOURCE_FACE_SCALARS else value
+    return faces
+
+
+def get_source_faces(
+    content_hash: str, load_image: Callable[[], CV2ImgU8]
+) -> List[Face]:
+    """
+    Get the faces of a source image, with embedding, gender and age, from a process wide cache.
+
+    Source images (API payloads, batch files, reference images) are usually sent again and again.
+    The faces are cached by content hash and detection parameters (see SOURCE_FACES_CACHE), and
+    saved in SOURCE_FACES_DIR if faceswaplab_source_cache_persist is enabled, so they survive restarts.
+    The directory is kept under faceswaplab_source_cache_disk_size, least recently used first.
+
+    Args:
+        content_hash (str): The source_content_hash of the image (or of its encoded content)
+        load_image (Callable[[], CV2ImgU8]): Decode the image (BGR), only called on cache misses.
+
+    Returns:
+        List[Face]: The faces of the image, sorted like get_faces.
+    """
+    det_thresh, det_size, auto_det_size = get_detection_parameters(None, (640, 640))
+    cache_key = (
+        f"{content_hash}-{det_size[0]}x{det_size[1]}-{det_thresh}-{auto_det_size}"
     )
+    faces = SOURCE_FACES_CACHE.get(cache_key)
+    if faces is None:
+        persist = get_sd_option("faceswaplab_source_cache_persist", False)
+        path = os.path.join(SOURCE_FACES_DIR, f"{cache_key}.safetensors")
+        if persist and os.path.isfile(path):
+            try:
+                faces = load_source_faces(path)
+                # Recently used files are deleted last
+                os.utime(path)
+            except Exception as e:
+                logger.warning("Failed to load cached source faces %s : %s", path, e)
+        if faces is None:
+            faces = [
+                Face({key: face[key] for key in SOURCE_FACE_KEYS if key in face})
+                for face in get_faces(load_image(), modules=SOURCE_MODULES)
+            ]
+            if persist:
+                save_source_faces(path, faces)
+                purge_source_faces_dir(
+                    int(
+                        get_sd_option("faceswaplab_source_cache_disk_size", 64)
+                        * 1024
+                        * 1024
+                    )
+                )
+        SOURCE_FACES_CACHE.put(cache_key, faces)
+    return list(faces)
+
+
+def detect_faces(
+    img_data: CV2ImgU8,
+    det_thresh: float,
+    det_size: Tuple[int, int],
+    auto_det_size: bool,
+    modules: Collection[str] = ALL_MODULES,
+) -> List[Face]:
+    """
+    Runs the analysis model on an image, without cache. Use get_faces instead.
+
+    Args:
+        img_data (CV2ImgU8): The image data as a NumPy array.
+        det_thresh (float): The detection threshold.
+        det_size (tuple): The detection size (width, height).
+        auto_det_size (bool): Halve det_size until a face is found (down to 320).
+        modules (Collection[str]): The analysis modules to run on each face.
+
+    Returns:
+        list: A list of detected faces, sorted by their x-coordinate of the bounding box.
+    """
+    face_analyser = getAnalysisModel(use_gpu=not is_cpu_provider())
 
     # Get the detected faces from the image using the analysis model
-    faces = face_analyser.get(img_data)
+    faces = face_analyser.get(
+        img_data, det_size=det_size, det_thresh=det_thresh, modules=modules
+    )
 
     # If no faces are detected and the detection size is larger than 320x320,
     # recursively call the function with a smaller detection size
@@ -428,8 +875,12 @@ def get_faces(
         if auto_det_size:
             if det_size[0] > 320 and det_size[1] > 320:
                 det_size_half = (det_size[0] // 2, det_size[1] // 2)
-                return get_faces(
-                    img_data, det_size=det_size_half, det_thresh=det_thresh
+                return detect_faces(
+                    img_data,
+                    det_thresh=det_thresh,
+                    det_size=det_size_half,
+                    auto_det_size=auto_det_size,
+                    modules=modules,
                 )
 
         # If no faces are detected print a warning to user about change in detection
@@ -551,7 +1002,7 @@ def get_faces_from_img_files(images: List[PILImage]) -> List[Face]:
     if len(images) > 0:
         for img in images:
             face = get_or_default(
-                get_faces(pil_to_cv2(img)), 0, None
+                get_source_faces(image_hash(img), lambda: pil_to_cv2(img)), 0, None
             )  # Extract faces from the image
             if face is not None:
                 faces.append(face)  # Add the detected face to the list of faces
@@ -610,7 +1061,7 @@ def blend_faces(faces: List[Face], gender: Gender = Gender.AUTO) -> Optional[Fac
 
 def swap_face(
     source_face: Face,
-    target_img: PILImage,
+    target_img: AnyImage,
     target_faces: List[Face],
     model: str,
     swapping_options: Optional[InswappperOptions],
@@ -620,35 +1071,30 @@ def swap_face(
 
     Args:
         source_face (CV2ImgU8): The source face to be swapped.
-        target_img (PILImage): The target image to swap faces in.
+        target_img (AnyImage): The target image to swap faces in (PIL or BGR array).
         model (str): Path to the face swap model.
 
     Returns:
         ImageResult: An object containing the swapped image and similarity scores.
 
     """
-    return_result = ImageResult(target_img, {}, {})
-    target_img_cv2: CV2ImgU8 = cv2.cvtColor(
-        np.array(target_img), cv2.COLOR_RGB2BGR
-    ).astype("uint8")
+    return_result = ImageResult(target_img, {}, {})  # type: ignore
+    target_img_cv2: CV2ImgU8 = as_cv2(target_img)
     try:
         gender = source_face["gender"]
         logger.info("Source Gender %s", gender)
         if source_face is not None:
             result: CV2ImgU8 = target_img_cv2
-            model_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), model)
+            model_path = get_swap_model_path(model)
             face_swapper = getFaceSwapModel(model_path, use_gpu=not is_cpu_provider())
             logger.info("Target faces count : %s", len(target_faces))
 
-            for i, swapped_face in enumerate(target_faces):
-                logger.info(f"swap face {i}")
-
-                result = face_swapper.get(
-                    img=result,
-                    target_face=swapped_face,
-                    source_face=source_face,
-                    options=swapping_options,
-                )  # type: ignore
+            result = face_swapper.get_batch(
+                img=result,
+                target_faces=target_faces,
+                source_face=source_face,
+                options=swapping_options,
+            )
 
             result_image = Image.fromarray(cv2.cvtColor(result, cv2.COLOR_BGR2RGB))
             return_result.image = result_image
@@ -656,9 +1102,56 @@ def swap_face(
     except Exception as e:
         logger.error("Conversion failed %s", e)
         raise e
+    return_result.image = as_pil(return_result.image)
     return return_result
 
 
+def iter_swap_face_variants(
+    source_faces: List[Face],
+    target_img: AnyImage,
+    target_faces: List[List[Face]],
+    model: str,
+    swapping_options: Optional[InswappperOptions],
+) -> Generator[ImageResult, None, None]:
+    """
+    Swap each source face in the same target image (one result per source face, in order).
+
+    Same results as calling swap_face for each source face, but the target image is converted
+    once and the target faces are prepared once for all the sources (see
+    UpscaledINSwapper.iter_variants), the sources being swapped by batches of
+    faceswaplab_fanout_batch_size.
+
+    Args:
+        source_faces (List[Face]): The source faces.
+        target_img (AnyImage): The target image to swap faces in (PIL or BGR array).
+        target_faces (List[List[Face]]): The faces to replace for each source face.
+        model (str): Path to the face swap model.
+
+    Yields:
+        ImageResult: The target image swapped with each source face.
+    """
+    target_img_cv2: CV2ImgU8 = as_cv2(target_img)
+    model_path = get_swap_model_path(model)
+    face_swapper = getFaceSwapModel(model_path, use_gpu=not is_cpu_provider())
+    logger.info(
+        "Swap %s source faces, target faces count : %s",
+        len(source_faces),
+        [len(faces) for faces in target_faces],
+    )
+    try:
+        for result in face_swapper.iter_variants(
+            target_img_cv2,
+            source_faces,
+            target_faces,
+            options=swapping_options,
+            batch_size=int(get_sd_option("faceswaplab_fanout_batch_size", 8)),
+        ):
+            yield ImageResult(cv2_to_pil(result), {}, {})
+    except Exception as e:
+        logger.error("Conversion failed %s", e)
+        raise e
+
+
 def compute_similarity(
     reference_face: Face,
     source_face: Face,
@@ -671,7 +1164,12 @@ def compute_similarity(
         swapped_image_cv2: CV2ImgU8 = cv2.cvtColor(
             np.array(swapped_image), cv2.COLOR_RGB2BGR
         )
-        new_faces = filter_faces(get_faces(swapped_image_cv2), filtering)
+        modules = SWAP_MODULES | {RECOGNITION}
+        if filtering.source_gender is not None:
+            modules |= {GENDER_AGE}
+        new_faces = filter_faces(
+            get_faces(swapped_image_cv2, modules=modules), filtering
+        )
         if len(new_faces) == 0:
             logger.error("compute_similarity : No faces to compare with !")
             return None
@@ -691,10 +1189,27 @@ def compute_similarity(
     return None
 
 
+def get_unit_target_modules(unit: FaceSwapUnitSettings) -> Set[str]:
+    """
+    Return the analysis modules needed on the target faces of a unit.
+
+    Swapping only needs bbox and kps. Gender is needed for same gender filtering and for the
+    [gender] placeholder of inpainting prompts.
+    """
+    modules = set(SWAP_MODULES)
+    if (
+        unit.same_gender
+        or unit.pre_inpainting.inpainting_denoising_strengh > 0
+        or unit.post_inpainting.inpainting_denoising_strengh > 0
+    ):
+        modules.add(GENDER_AGE)
+    return modules
+
+
 def process_image_unit(
     model: str,
     unit: FaceSwapUnitSettings,
-    image: PILImage,
+    image: AnyImage,
     info: Optional[str] = None,
     force_blend: bool = False,
 ) -> List[Tuple[PILImage, Optional[str]]]:
@@ -708,13 +1223,36 @@ def process_image_unit(
     Returns:
         List of tuple of (image, info) where image is the image where swapping has been applied and info is the image info with similarity infos.
     """
+    return list(iter_process_image_unit(model, unit, image, info, force_blend))
 
-    results = []
+
+def iter_process_image_unit(
+    model: str,
+    unit: FaceSwapUnitSettings,
+    image: AnyImage,
+    info: Optional[str] = None,
+    force_blend: bool = False,
+    nsfw_checked: bool = False,
+) -> Generator[Tuple[PILImage, Optional[str]], None, None]:
+    """
+    Generator version of process_image_unit : yield each (image, info) as soon as it is swapped.
+
+    The image can be a BGR array : it is then analysed and swapped without converting it to PIL
+    (unless pre-inpainting needs it). Yielded images are PIL images.
+
+    nsfw_checked skips the NSFW check, for images derived from an image that passed it by swaps
+    only (see keeps_nsfw_verdict). Inpainted images are checked again.
+    """
+
+    results = 0
     if unit.enable:
-        faces = get_faces(pil_to_cv2(image))
+        # Rejected images skip face analysis
+        if not nsfw_checked and check_against_nsfw(image):
+            yield (as_pil(image), info)
+            return
+        image_cv2 = as_cv2(image)
+        faces = get_faces(image_cv2, modules=get_unit_target_modules(unit))
 
-        if check_against_nsfw(image):
-            return [(image, info)]
         if not unit.blend_faces and not force_blend:
             src_faces = unit.faces
             logger.info(f"will generate {len(src_faces)} images")
@@ -722,8 +1260,30 @@ def process_image_unit(
             logger.info("blend all faces together")
             src_faces = [unit.blended_faces]
 
+        def get_filtering_options(src_face: Face) -> FaceFilteringOptions:
+            return FaceFilteringOptions(
+                faces_index=unit.faces_index,
+                source_gender=src_face["gender"] if unit.same_gender else None,
+                sort_by_face_size=unit.sort_by_size,
+            )
+
+        # Without pre-inpainting, all the sources are swapped in the same target image : the
+        # target faces are prepared once and the sources are swapped by batches
+        variants: Optional[Generator[ImageResult, None, None]] = None
+        if len(src_faces) > 1 and unit.pre_inpainting.inpainting_denoising_strengh == 0:
+            variants = iter_swap_face_variants(
+                source_faces=src_faces,
+                target_img=image_cv2,
+                target_faces=[
+                    filter_faces(faces, get_filtering_options(src_face))
+                    for src_face in src_faces
+                ],
+                model=model,
+                swapping_options=unit.swapping_options,
+            )
+
         for i, src_face in enumerate(src_faces):
-            current_image = image
+            current_image: AnyImage = image_cv2
 
             logger.info(f"Process face {i}")
             if unit.reference_face is not None:
@@ -732,11 +1292,7 @@ def process_image_unit(
                 logger.info("Use source face as reference face")
                 reference_face = src_face
 
-            face_filtering_options = FaceFilteringOptions(
-                faces_index=unit.faces_index,
-                source_gender=src_face["gender"] if unit.same_gender else None,
-                sort_by_face_size=unit.sort_by_size,
-            )
+            face_filtering_options = get_filtering_options(src_face)
 
             target_faces: List[Face] = filter_faces(
                 all_faces=faces, filtering_options=face_filtering_options
@@ -745,17 +1301,23 @@ def process_image_unit(
             # Apply pre-inpainting to image
             if unit.pre_inpainting.inpainting_denoising_strengh > 0:
                 current_image = img2img_diffusion(
-                    img=current_image, faces=target_faces, options=unit.pre_inpainting
+                    img=as_pil(current_image),
+                    faces=target_faces,
+                    options=unit.pre_inpainting,
                 )
 
-            save_img_debug(image, "Before swap")
-            result: ImageResult = swap_face(
-                source_face=src_face,
-                target_img=current_image,
-                target_faces=target_faces,
-                model=model,
-                swapping_options=unit.swapping_options,
-            )
+            if logger.getEffectiveLevel() <= logging.DEBUG:
+                save_img_debug(as_pil(image), "Before swap")
+            if variants is not None:
+                result: ImageResult = next(variants)
+            else:
+                result = swap_face(
+                    source_face=src_face,
+                    target_img=current_image,
+                    target_faces=target_faces,
+                    model=model,
+                    swapping_options=unit.swapping_options,
+                )
             # Apply post-inpainting to image
             if unit.post_inpainting.inpainting_denoising_strengh > 0:
                 result.image = img2img_diffusion(
@@ -790,25 +1352,24 @@ def process_image_unit(
                     + [x >= unit.min_ref_sim for x in result.ref_similarity.values()]
                 )
             ):
-                results.append(
-                    (
-                        result.image,
-                        f"{info}, similarity = {result.similarity}, ref_similarity = {result.ref_similarity}",
-                    )
+                results += 1
+                yield (
+                    result.image,
+                    f"{info}, similarity = {result.similarity}, ref_similarity = {result.ref_similarity}",
                 )
             else:
                 logger.warning(
                     f"skip, similarity to low, sim = {result.similarity} (target {unit.min_sim}) ref sim = {result.ref_similarity} (target = {unit.min_ref_sim})"
                 )
-    logger.debug("process_image_unit : Unit produced %s results", len(results))
-    return results
+    logger.debug("process_image_unit : Unit produced %s results", results)
 
 
 def process_images_units(
     model: str,
     units: List[FaceSwapUnitSettings],
-    images: List[Tuple[Optional[PILImage], Optional[str]]],
+    images: Sequence[Tuple[Optional[AnyImage], Optional[str]]],
     force_blend: bool = False,
+    monitor: Optional[ProcessingMonitor] = None,
 ) -> Optional[List[Tuple[PILImage, str]]]:
     """
     Process a list of images using a specified model and unit settings for face swapping.
@@ -816,13 +1377,13 @@ def process_images_units(
     Args:
         model (str): The name of the model to use for processing.
         units (List[FaceSwapUnitSettings]): A list of settings for face swap units to apply on each image.
-        images (List[Tuple[Optional[PILImage], Optional[str]]]): A list of tuples, each containing
-            an image and its associated info string. If an image or info string is not available,
+        images (Sequence[Tuple[Optional[AnyImage], Optional[str]]]): A list of tuples, each containing
+            an image (PIL or BGR array) and its associated info string. If an image or info string is not available,
             its value can be None.
-        upscaled_swapper (bool, optional): If True, uses an upscaled version of the face swapper.
-            Defaults to False.
         force_blend (bool, optional): If True, forces the blending of the swapped face on the original
             image. Defaults to False.
+        monitor (Optional[ProcessingMonitor], optional): Checks cancellation before each unit and
+            reports progress after it. Defaults to None.
 
     Returns:
         Optional[List[Tuple[PILImage, str]]]: A list of tuples, each containing a processed image
@@ -833,17 +1394,95 @@ def process_images_units(
         logger.info("Finished processing image, return %s images", len(images))
         return None
 
-    logger.debug("%s more units", len(units))
+    # Check all the images in one pass, the units then read the cached verdicts
+    check_against_nsfw_batch([image for image, _ in images if image is not None])
+    return list(
+        iter_process_images_units(model, units, images, force_blend, monitor=monitor)
+    )
+
 
-    processed_images = []
+def keeps_nsfw_verdict(unit: FaceSwapUnitSettings) -> bool:
+    """
+    True if the results of the unit only differ from its input by swapped faces, so they keep the
+    NSFW verdict of the input. Inpainting can generate anything, its results are checked again.
+    """
+    return (
+        unit.pre_inpainting.inpainting_denoising_strengh == 0
+        and unit.post_inpainting.inpainting_denoising_strengh == 0
+    )
+
+
+def iter_process_images_units(
+    model: str,
+    units: List[FaceSwapUnitSettings],
+    images: Iterable[Tuple[Optional[AnyImage], Optional[str]]],
+    force_blend: bool = False,
+    monitor: Optional[ProcessingMonitor] = None,
+    nsfw_checked: bool = False,
+) -> Generator[Tuple[PILImage, str], None, None]:
+    """
+    Generator version of process_images_units : yield each final (image, info) as soon as it is
+    produced.
+
+    Chains of blended units are run in a single pass (see unit_planner). Otherwise units are
+    applied depth first : each result of a unit goes through the next units before the
+    next result is computed, so that only one image per unit is held instead of every combination
+    of source faces. As in process_images_units, the results of a unit are returned as is if the
+    next units produce nothing from them (they are kept only until the next units produce one).
+
+    Each image is checked against NSFW once, before the first unit, unless nsfw_checked is set :
+    a rejected image is returned as is and goes through no unit. The results of a unit that only
+    swaps faces keep the verdict and are not checked again by the next units (see
+    keeps_nsfw_verdict), the results of an inpainting unit are.
+
+    Args:
+        See process_images_units. nsfw_checked is set for images that passed the NSFW check.
+
+    Yields:
+        Tuple[PILImage, str]: A processed image and its info string.
+    """
+    if len(units) == 0:
+        return
+
+    from scripts.faceswaplab_swapping import unit_planner
+
+    single_pass = unit_planner.can_plan_units(units, force_blend)
     for i, (image, info) in enumerate(images):
         logger.debug("Processing image %s", i)
-        swapped = process_image_unit(model, units[0], image, info, force_blend)
-        logger.debug("Image %s -> %s images", i, len(swapped))
-        nexts = process_images_units(model, units[1:], swapped, force_blend)
-        if nexts:
-            processed_images.extend(nexts)
+        if not nsfw_checked and image is not None and check_against_nsfw(image):
+            yield (as_pil(image), info)  # type: ignore
+            if monitor:
+                monitor.step()
+            continue
+        if single_pass and image is not None:
+            # One result per image, detect once and swap all units on a single buffer
+            yield unit_planner.process_units_single_pass(
+                model, units, image, info, monitor=monitor, nsfw_checked=True
+            )
+            continue
+        if monitor:
+            monitor.check_cancelled()
+        swapped = iter_process_image_unit(
+            model, units[0], image, info, force_blend, nsfw_checked=True
+        )
+        if len(units) == 1:
+            yield from swapped  # type: ignore
         else:
-            processed_images.extend(swapped)
-
-    return processed_images
+            fallback: Optional[List[Tuple[PILImage, str]]] = []
+            for result in swapped:
+                if fallback is not None:
+                    fallback.append(result)  # type: ignore
+                for next_result in iter_process_images_units(
+                    model,
+                    units[1:],
+                    [result],
+                    force_blend,
+                    monitor=monitor,
+                    nsfw_checked=keeps_nsfw_verdict(units[0]),
+                ):
+                    fallback = None
+                    yield next_result
+            if fallback:
+                yield from fallback
+        if monitor:
+            monitor.step()
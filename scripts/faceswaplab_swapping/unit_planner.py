@@ -0,0 +1,215 @@
+from dataclasses import dataclass
+from typing import List, Optional, Set, Tuple
+
+import numpy as np
+
+from scripts.faceswaplab_swapping import swapper
+from scripts.faceswaplab_swapping.swapper import (
+    FaceFilteringOptions,
+    ProcessingMonitor,
+    filter_faces,
+    get_unit_target_modules,
+)
+from scripts.faceswaplab_swapping.upscaled_inswapper import (
+    UpscaledINSwapper,
+    boxes_overlap,
+    get_crop_box,
+)
+from scripts.faceswaplab_ui.faceswaplab_unit_settings import FaceSwapUnitSettings
+from scripts.faceswaplab_utils.faceswaplab_logging import logger
+from scripts.faceswaplab_utils.imgutils import as_pil, cv2_to_pil, pil_to_cv2
+from scripts.faceswaplab_utils.nsfw import check_against_nsfw
+from scripts.faceswaplab_utils.typing import (
+    AnyImage,
+    BoxCoords,
+    CV2ImgU8,
+    Face,
+    PILImage,
+)
+
+# Margin added around a swapped face crop (relative to the crop size) to detect it again
+REDETECTION_MARGIN = 0.5
+# Min IoU between a face before and after a swap to consider that it is the same face
+REDETECTION_MIN_IOU = 0.3
+
+
+@dataclass
+class PlannedSwap:
+    unit: FaceSwapUnitSettings
+    source_face: Face
+    target_face: Face
+
+
+def can_plan_units(units: List[FaceSwapUnitSettings], force_blend: bool) -> bool:
+    """
+    True if the units can be applied in a single pass by process_units_single_pass : each unit
+    produces exactly one image (blended sources) and only swaps (no inpainting, no similarity).
+    """
+    return len(units) > 1 and all(
+        unit.enable
+        and (unit.blend_faces or force_blend)
+        and unit.blended_faces is not None
+        and not unit.compute_similarity
+        and unit.pre_inpainting.inpainting_denoising_strengh == 0
+        and unit.post_inpainting.inpainting_denoising_strengh == 0
+        for unit in units
+    )
+
+
+def box_iou(a: np.ndarray, b: np.ndarray) -> float:  # type: ignore
+    x0, y0 = max(a[0], b[0]), max(a[1], b[1])
+    x1, y1 = min(a[2], b[2]), min(a[3], b[3])
+    intersection = max(x1 - x0, 0) * max(y1 - y0, 0)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return float(intersection / union) if union > 0 else 0.0
+
+
+def update_faces_in_regions(
+    img: CV2ImgU8,
+    faces: List[Face],
+    swapped_faces: List[Face],
+    crop_size: int,
+    modules: Set[str],
+) -> List[Face]:
+    """
+    Detect the swapped faces again, only in the region around each of them, and replace them in
+    the list of faces. The other faces are kept as they are, their pixels did not change.
+
+    A swapped face that is not found again keeps its previous detection.
+
+    Returns:
+        List[Face]: The updated faces, sorted by the x coordinate of their bounding box.
+    """
+    det_thresh, det_size, auto_det_size = swapper.get_detection_parameters(
+        None, (640, 640)
+    )
+    faces = list(faces)
+    for swapped_face in swapped_faces:
+        x0, y0, x1, y1 = get_crop_box(swapped_face, crop_size, img.shape)
+        margin = int(max(x1 - x0, y1 - y0) * REDETECTION_MARGIN)
+        x0, y0 = max(x0 - margin, 0), max(y0 - margin, 0)
+        x1, y1 = min(x1 + margin, img.shape[1]), min(y1 + margin, img.shape[0])
+
+        candidates = swapper.detect_faces(
+            np.ascontiguousarray(img[y0:y1, x0:x1]),
+            det_thresh=det_thresh,
+            det_size=det_size,
+            auto_det_size=auto_det_size,
+            modules=modules,
+        )
+        offset = np.array([x0, y0], dtype=np.float32)
+        for candidate in candidates:
+            candidate.bbox = candidate.bbox + np.tile(offset, 2)
+            candidate.kps = candidate.kps + offset
+
+        best: Optional[Face] = max(
+            candidates,
+            key=lambda candidate: box_iou(candidate.bbox, swapped_face.bbox),
+            default=None,
+        )
+        if (
+            best is not None
+            and box_iou(best.bbox, swapped_face.bbox) >= REDETECTION_MIN_IOU
+        ):
+            faces = [best if face is swapped_face else face for face in faces]
+        else:
+            logger.warning("Swapped face not detected again, keep its detection")
+    return sorted(faces, key=lambda face: face.bbox[0])  # type: ignore
+
+
+def run_swaps(
+    face_swapper: UpscaledINSwapper, img: CV2ImgU8, swaps: List[PlannedSwap]
+) -> CV2ImgU8:
+    """
+    Run a group of swaps on the image (in place) with a single inference.
+    """
+    logger.info("Run %s planned swaps", len(swaps))
+    return face_swapper.get_multi(
+        img,
+        [swap.target_face for swap in swaps],
+        [swap.source_face for swap in swaps],
+        [swap.unit.swapping_options for swap in swaps],
+    )
+
+
+def process_units_single_pass(
+    model: str,
+    units: List[FaceSwapUnitSettings],
+    image: AnyImage,
+    info: Optional[str],
+    monitor: Optional[ProcessingMonitor] = None,
+    nsfw_checked: bool = False,
+) -> Tuple[PILImage, str]:
+    """
+    Apply a chain of units (see can_plan_units) to an image in a single pass.
+
+    Faces are detected once, with the analysis modules needed by all units. Each unit resolves its
+    faces_index, gender and size filters against this shared detection, and all swaps run on one
+    BGR buffer, converted back to PIL once at the end.
+
+    Consecutive units whose target face crops do not overlap the faces already swapped by the
+    group (and that do not filter on gender or size, which a swap can change) are grouped and run
+    in a single inference, each face keeping its own source and options. Before a unit that
+    depends on the faces swapped by the previous group, the group is run and only the swapped
+    faces are detected again, in their region.
+
+    The NSFW check runs before detection, unless nsfw_checked is set. The image can be a BGR array
+    (it is not modified).
+
+    Returns:
+        Tuple[PILImage, str]: The processed image and its info string, as process_images_units
+            would return for blended units.
+    """
+    if not nsfw_checked and check_against_nsfw(image):
+        return as_pil(image), info  # type: ignore
+
+    # Swaps write in the buffer
+    img = image.copy() if isinstance(image, np.ndarray) else pil_to_cv2(image)
+    modules: Set[str] = set()
+    for unit in units:
+        modules |= get_unit_target_modules(unit)
+    faces = swapper.get_faces(img, modules=modules)
+    for _ in units:
+        info = f"{info}, similarity = {{}}, ref_similarity = {{}}"
+
+    face_swapper = swapper.getFaceSwapModel(
+        swapper.get_swap_model_path(model),
+        use_gpu=not swapper.is_cpu_provider(),
+    )
+    crop_size = face_swapper.input_size[0]
+
+    group: List[PlannedSwap] = []
+    # Crop boxes of the faces swapped by the group
+    changed: List[BoxCoords] = []
+    for unit in units:
+        if monitor:
+            monitor.check_cancelled()
+        source_face = unit.blended_faces
+        filtering = FaceFilteringOptions(
+            faces_index=unit.faces_index,
+            source_gender=source_face["gender"] if unit.same_gender else None,
+            sort_by_face_size=unit.sort_by_size,
+        )
+        targets = filter_faces(faces, filtering)
+        boxes = [get_crop_box(face, crop_size, img.shape) for face in targets]
+        independent = not (unit.same_gender or unit.sort_by_size) and not any(
+            boxes_overlap(box, changed_box) for box in boxes for changed_box in changed
+        )
+        if group and not independent:
+            img = run_swaps(face_swapper, img, group)
+            faces = update_faces_in_regions(
+                img, faces, [swap.target_face for swap in group], crop_size, modules
+            )
+            group, changed = [], []
+            targets = filter_faces(faces, filtering)
+            boxes = [get_crop_box(face, crop_size, img.shape) for face in targets]
+
+        logger.info("Unit targets %s faces", len(targets))
+        group += [PlannedSwap(unit, source_face, face) for face in targets]
+        changed += boxes
+        if monitor:
+            monitor.step()
+
+    if group:
+        img = run_swaps(face_swapper, img, group)
+    return cv2_to_pil(img), info  # type: ignore
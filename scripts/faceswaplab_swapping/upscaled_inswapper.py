@@ -1,20 +1,27 @@
-from typing import Any, Optional, Tuple, Union
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Dict, Generator, List, Optional, Tuple, Union
 import cv2
 import numpy as np
 from insightface.model_zoo.inswapper import INSwapper
 from insightface.utils import face_align
-from modules import processing, shared
+from modules import shared
 from modules.upscaler import UpscalerData
 
-from scripts.faceswaplab_postprocessing import upscaling
+from scripts.faceswaplab_postprocessing import (
+    color_correction,
+    native_upscaling,
+    upscaling,
+)
+from scripts.faceswaplab_postprocessing.color_correction import ColorStats
 from scripts.faceswaplab_postprocessing.postprocessing_options import (
     PostProcessingOptions,
 )
-from scripts.faceswaplab_swapping.facemask import generate_face_mask
+from scripts.faceswaplab_swapping.facemask import generate_face_masks
 from scripts.faceswaplab_swapping.upcaled_inswapper_options import InswappperOptions
 from scripts.faceswaplab_utils.imgutils import cv2_to_pil, pil_to_cv2
 from scripts.faceswaplab_utils.sd_utils import get_sd_option
-from scripts.faceswaplab_utils.typing import CV2ImgU8, Face
+from scripts.faceswaplab_utils.typing import BoxCoords, CV2ImgU8, Face
 from scripts.faceswaplab_utils.faceswaplab_logging import logger
 
 
@@ -110,7 +117,8 @@ def dilate_mask(mask: CV2ImgU8, kernel_size: int = 5, iterations: int = 1) -> CV
 
 def get_face_mask(aimg: CV2ImgU8, bgr_fake: CV2ImgU8) -> CV2ImgU8:
     """
-    Generates a face mask by performing bitwise OR on two face masks and then dilating the result.
+    Generates a face mask by performing bitwise OR on two face masks (parsed in one pass) and then
+    dilating the result.
 
     Args:
         aimg (CV2Img): Input image for generating the first face mask.
@@ -119,12 +127,247 @@ def get_face_mask(aimg: CV2ImgU8, bgr_fake: CV2ImgU8) -> CV2ImgU8:
     Returns:
         CV2Img: The combined and dilated face mask.
     """
-    mask1 = generate_face_mask(aimg, device=shared.device)
-    mask2 = generate_face_mask(bgr_fake, device=shared.device)
+    mask1, mask2 = generate_face_masks([aimg, bgr_fake], device=shared.device)
     mask = dilate_mask(cv2.bitwise_or(mask1, mask2))
     return mask
 
 
+# Fixed point precision of the cv2.warpAffine sampling coordinates (OpenCV 4 : AB_BITS and
+# INTER_BITS in imgwarp.cpp)
+WARP_AB_BITS = 10
+WARP_INTER_BITS = 5
+
+
+def get_warp_inverse_map(M: np.ndarray) -> np.ndarray:  # type: ignore
+    """
+    The destination -> source matrix used by cv2.warpAffine for M, computed as OpenCV does.
+    """
+    m = M.astype(np.float64).ravel().copy()
+    det = m[0] * m[4] - m[1] * m[3]
+    det = 1.0 / det if det != 0 else 0.0
+    m[0], m[4] = m[4] * det, m[0] * det
+    m[1] *= -det
+    m[3] *= -det
+    m[2], m[5] = -m[0] * m[2] - m[1] * m[5], -m[3] * m[2] - m[4] * m[5]
+    return m
+
+
+def warp_fixed_point_in_roi(
+    src: np.ndarray, M: np.ndarray, roi: BoxCoords  # type: ignore
+) -> np.ndarray:  # type: ignore
+    """
+    The region roi (x0, y0, x1, y1) of cv2.warpAffine(src, M, image size, borderValue=0.0),
+    computed only in the region.
+
+    OpenCV 4 rounds the sampling coordinates of each pixel to fixed point, from its absolute
+    position in the output. Shifting the translation of M to warp a region rounds them
+    differently. The fixed point maps are computed here as warpAffine computes them, then
+    sampled with cv2.remap, so the region is identical to the full frame warp.
+    """
+    x0, y0, x1, y1 = roi
+    m = get_warp_inverse_map(M)
+    ab_scale = 1 << WARP_AB_BITS
+    tab_size = 1 << WARP_INTER_BITS
+    round_delta = ab_scale // tab_size // 2
+    xs = np.arange(x0, x1, dtype=np.float64)
+    ys = np.arange(y0, y1, dtype=np.float64)
+    x_delta = np.rint(m[0] * xs * ab_scale).astype(np.int64)
+    y_delta = np.rint(m[3] * xs * ab_scale).astype(np.int64)
+    x_row = np.rint((m[1] * ys + m[2]) * ab_scale).astype(np.int64) + round_delta
+    y_row = np.rint((m[4] * ys + m[5]) * ab_scale).astype(np.int64) + round_delta
+    shift = WARP_AB_BITS - WARP_INTER_BITS
+    X = (x_row[:, None] + x_delta[None, :]) >> shift
+    Y = (y_row[:, None] + y_delta[None, :]) >> shift
+    map_xy = np.stack([X >> WARP_INTER_BITS, Y >> WARP_INTER_BITS], axis=-1)
+    map_frac = (Y & (tab_size - 1)) * tab_size + (X & (tab_size - 1))
+    return cv2.remap(
+        src,
+        np.clip(map_xy, -32768, 32767).astype(np.int16),
+        map_frac.astype(np.uint16),
+        cv2.INTER_LINEAR,
+        borderMode=cv2.BORDER_CONSTANT,
+        borderValue=0.0,
+    )
+
+
+@lru_cache(maxsize=1)
+def warp_uses_fixed_point() -> bool:
+    """
+    True if cv2.warpAffine samples with the fixed point coordinates of OpenCV 4 (the version
+    shipped with the webui), checked once on a small probe. Other builds warp the region with a
+    shifted matrix, which can differ from the full frame warp by a level on some pixels.
+    """
+    probe = np.random.default_rng(0).integers(0, 256, (32, 32), dtype=np.uint8)
+    M = np.array([[0.73, -0.41, 20.3], [0.41, 0.73, 5.7]])
+    roi = (10, 10, 50, 50)
+    full = cv2.warpAffine(probe, M, (64, 64), borderValue=0.0)
+    return np.array_equal(warp_fixed_point_in_roi(probe, M, roi), full[10:50, 10:50])
+
+
+def paste_back_in_roi(
+    target_img: CV2ImgU8,
+    bgr_fake: CV2ImgU8,
+    M: np.ndarray,  # type: ignore
+    erosion_factor: float = 1,
+) -> CV2ImgU8:
+    """
+    Blends an aligned face crop back into the target image, in place.
+
+    The region covered by the crop is computed from the inverse affine transform and padded by the
+    erosion and blur radius. Warping, feathering and blending are only done inside this region
+    instead of the whole image, so the cost depends on the face size and not on the image size.
+
+    With OpenCV 4 the result is identical to a full frame warp + erode + blur + blend : the region
+    is warped with the sampling coordinates of the full frame warp (see warp_fixed_point_in_roi),
+    and padded so that erosion and blur see the same pixels. Builds sampling differently (see
+    warp_uses_fixed_point) can differ by a few levels on the feathered edge of the face.
+
+    Args:
+        target_img (CV2ImgU8): The image to paste the face into. It is modified in place.
+        bgr_fake (CV2ImgU8): The swapped face, in the aligned crop space.
+        M (np.ndarray): The 2x3 alignment matrix (target image -> crop).
+        erosion_factor (float, optional): The mask erosion factor. Default is 1.
+
+    Returns:
+        CV2ImgU8: The target image (same buffer) with the face pasted back.
+    """
+    img_h, img_w = target_img.shape[:2]
+    crop_h, crop_w = bgr_fake.shape[:2]
+    IM = cv2.invertAffineTransform(M)
+
+    def clip_roi(x0: int, y0: int, x1: int, y1: int) -> BoxCoords:
+        return (max(x0, 0), max(y0, 0), min(x1, img_w), min(y1, img_h))
+
+    fixed_point = warp_uses_fixed_point()
+
+    def warp_in_roi(src: np.ndarray, roi: BoxCoords) -> np.ndarray:  # type: ignore
+        if fixed_point:
+            return warp_fixed_point_in_roi(src, IM, roi)
+        x0, y0, x1, y1 = roi
+        IM_roi = IM.copy()
+        IM_roi[0, 2] -= x0
+        IM_roi[1, 2] -= y0
+        return cv2.warpAffine(src, IM_roi, (x1 - x0, y1 - y0), borderValue=0.0)
+
+    # Bounding box of the crop in the target image (+2 pixels for the interpolation)
+    corners = np.array(
+        [[0, 0, 1], [crop_w, 0, 1], [0, crop_h, 1], [crop_w, crop_h, 1]],
+        dtype=np.float64,
+    )
+    projected = corners @ IM.T
+    bbox = clip_roi(
+        int(np.floor(projected[:, 0].min())) - 2,
+        int(np.floor(projected[:, 1].min())) - 2,
+        int(np.ceil(projected[:, 0].max())) + 2,
+        int(np.ceil(projected[:, 1].max())) + 2,
+    )
+    if bbox[0] >= bbox[2] or bbox[1] >= bbox[3]:
+        logger.warning("Face is outside of the image, skip paste back")
+        return target_img
+
+    img_white = np.full((crop_h, crop_w), 255, dtype=np.float32)
+    white_in_bbox = warp_in_roi(img_white, bbox)
+    mask_h_inds, mask_w_inds = np.where(white_in_bbox > 20)
+    if len(mask_h_inds) == 0:
+        logger.warning("Face is outside of the image, skip paste back")
+        return target_img
+    mask_h = np.max(mask_h_inds) - np.min(mask_h_inds)
+    mask_w = np.max(mask_w_inds) - np.min(mask_w_inds)
+    mask_size = int(np.sqrt(mask_h * mask_w))
+
+    erosion_k = max(int(mask_size // 10 * erosion_factor), int(10 * erosion_factor))
+    blur_k = max(int(mask_size // 20 * erosion_factor), int(5 * erosion_factor))
+
+    # The padding keeps the erosion window of every mask pixel and the reflected blur border inside
+    # the roi, so that it behaves as if the whole image was processed.
+    pad = max(erosion_k // 2 + 1, 2 * blur_k + 1) + 1
+    roi = clip_roi(bbox[0] - pad, bbox[1] - pad, bbox[2] + pad, bbox[3] + pad)
+    x0, y0, x1, y1 = roi
+
+    img_mask = warp_in_roi(img_white, roi)
+    img_mask[img_mask > 20] = 255
+    img_mask = cv2.erode(img_mask, np.ones((erosion_k, erosion_k), np.uint8))
+    img_mask = cv2.GaussianBlur(img_mask, (2 * blur_k + 1, 2 * blur_k + 1), 0)
+    img_mask /= 255
+    img_mask = img_mask[:, :, np.newaxis]
+
+    fake_in_roi = warp_in_roi(bgr_fake, roi)
+    target_roi = target_img[y0:y1, x0:x1]
+    merged = img_mask * fake_in_roi + (1 - img_mask) * target_roi.astype(np.float32)
+    target_roi[...] = merged.astype(np.uint8)
+    return target_img
+
+
+def get_crop_box(face: Face, size: int, img_shape: Tuple[int, ...]) -> BoxCoords:
+    """
+    Bounding box (in the image) of the aligned crop of a face. Swapping a face only reads and
+    writes pixels inside this box.
+    """
+    M = face_align.estimate_norm(face.kps, size)
+    corners = np.array(
+        [[0, 0, 1], [size, 0, 1], [0, size, 1], [size, size, 1]], dtype=np.float64
+    )
+    projected = corners @ cv2.invertAffineTransform(M).T
+    return (
+        max(int(np.floor(projected[:, 0].min())), 0),
+        max(int(np.floor(projected[:, 1].min())), 0),
+        min(int(np.ceil(projected[:, 0].max())), img_shape[1]),
+        min(int(np.ceil(projected[:, 1].max())), img_shape[0]),
+    )
+
+
+def boxes_overlap(a: BoxCoords, b: BoxCoords) -> bool:
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def group_overlapping_faces(
+    faces: List[Face], size: int, img_shape: Tuple[int, ...]
+) -> List[List[int]]:
+    """
+    Split faces in groups that can be swapped in one inference each, with the result of swapping
+    them one after the other.
+
+    A face whose crop box overlaps the crop box of a previous face reads pixels written by that
+    face, so it goes in a later group than it. Groups are run in order, and the faces of a group
+    are pasted in their original order.
+
+    Returns:
+        List[List[int]]: The indexes of the faces of each group.
+    """
+    boxes = [get_crop_box(face, size, img_shape) for face in faces]
+    levels: List[int] = []
+    for i, box in enumerate(boxes):
+        levels.append(
+            max(
+                (levels[j] + 1 for j in range(i) if boxes_overlap(boxes[j], box)),
+                default=0,
+            )
+        )
+    return [
+        [i for i, level in enumerate(levels) if level == group]
+        for group in range(max(levels, default=-1) + 1)
+    ]
+
+
+@dataclass
+class PreparedPaste:
+    """
+    Target side of a paste back (see UpscaledINSwapper.prepare_paste).
+    """
+
+    # Alignment matrix of the crop the swapped face is pasted from
+    M: np.ndarray  # type: ignore
+    # Upscaling factor of the swapped face and whether to restore it (see get_upscale_tier)
+    k: int = 1
+    restore: bool = True
+    # Aligned crop of the target face (upscaled k times), if needed by the options
+    aimg: Optional[CV2ImgU8] = None
+    # Color statistics of aimg (color corrections)
+    color_correction: Optional[ColorStats] = None
+    # Face parsing mask of aimg (improved mask), computed by the first paste_all that needs it
+    mask: Optional[CV2ImgU8] = None
+
+
 class UpscaledINSwapper(INSwapper):
     def __init__(self, inswapper: INSwapper):
         self.__dict__.update(inswapper.__dict__)
@@ -134,11 +377,11 @@ class UpscaledINSwapper(INSwapper):
         img: CV2ImgU8,
         k: int = 2,
         inswapper_options: Optional[InswappperOptions] = None,
+        restore: bool = True,
     ) -> CV2ImgU8:
         if inswapper_options is None:
             return img
 
-        pil_img = cv2_to_pil(img)
         pp_options = PostProcessingOptions(
             upscaler_name=inswapper_options.upscaler_name,
             upscale_visibility=1,
@@ -148,14 +391,140 @@ class UpscaledINSwapper(INSwapper):
             restorer_visibility=inswapper_options.restorer_visibility,
         )
 
+        upscale = bool(pp_options.upscaler_name) and k > 1
+        restore = bool(pp_options.face_restorer_name) and restore
+        # Native upscalers work on the BGR crop, the face stays out of PIL
+        if native_upscaling.is_native_upscaler(pp_options.upscaler_name):
+            result = img
+            if upscale:
+                result = native_upscaling.upscale(img, pp_options.upscaler_name, k)
+            if restore:
+                result = upscaling.restore_face_cv2(result, pp_options)
+            return result
+
+        pil_img = cv2_to_pil(img)
         upscaled = pil_img
-        if pp_options.upscaler_name:
+        # k = 1 : the upscaler is skipped (see get_upscale_tier)
+        if upscale:
             upscaled = upscaling.upscale_img(pil_img, pp_options)
-        if pp_options.face_restorer_name:
+        if restore:
             upscaled = upscaling.restore_face(upscaled, pp_options)
 
         return pil_to_cv2(upscaled)
 
+    def get_upscale_tier(
+        self,
+        M: np.ndarray,  # type: ignore
+        options: InswappperOptions,
+    ) -> Tuple[int, bool]:
+        """
+        Choose the upscaling factor of a swapped face and whether to restore it, from the size of
+        the face on the target image.
+
+        The swapped face is warped back to its size on the image, so upscaling it beyond that size
+        is wasted. With faceswaplab_adaptive_upscale, the face is upscaled 4x only if its aligned
+        crop is larger than faceswaplab_upscale_4x_min_size pixels on the image, 2x if it is larger
+        than faceswaplab_upscale_2x_min_size, and not at all otherwise. It is restored only if it
+        is larger than faceswaplab_restore_min_size.
+
+        Args:
+            M (np.ndarray): The alignment matrix (target image -> model input crop)
+            options (InswappperOptions): The swapping options
+
+        Returns:
+            Tuple[int, bool]: The upscaling factor (1, 2 or 4) and whether to restore the face
+        """
+        upscale = bool(options.upscaler_name and options.upscaler_name != "None")
+        k = 4 if upscale else 1
+        if not get_sd_option("faceswaplab_adaptive_upscale", False):
+            return k, True
+
+        # Size of the aligned crop on the image (M scales the image to the crop)
+        face_size = self.input_size[0] / np.sqrt(abs(np.linalg.det(M[:, :2])))
+        restore = bool(face_size >= get_sd_option("faceswaplab_restore_min_size", 64))
+        if upscale:
+            if face_size > get_sd_option("faceswaplab_upscale_4x_min_size", 320):
+                k = 4
+            elif face_size > get_sd_option("faceswaplab_upscale_2x_min_size", 160):
+                k = 2
+            else:
+                k = 1
+            if k < 4:
+                logger.info(
+                    "Face of %spx on the image : upscale x%s instead of x4",
+                    int(face_size),
+                    k,
+                )
+        if options.face_restorer_name and not restore:
+            logger.info(
+                "Face of %spx on the image : skip face restoration", int(face_size)
+            )
+        return k, restore
+
+    @property
+    def supports_batch(self) -> bool:
+        """
+        True if the loaded graph accepts more than one face per inference (dynamic batch axis).
+        """
+        assert self.session is not None
+        batch_dim = self.session.get_inputs()[0].shape[0]
+        return not (isinstance(batch_dim, int) and batch_dim == 1)
+
+    def compute_latent(self, source_face: Face) -> np.ndarray:  # type: ignore
+        """
+        Project the source face embedding in the latent space of the swap model.
+
+        Args:
+            source_face (Face): The face to use as source (needs a normed_embedding)
+
+        Returns:
+            np.ndarray: A (1, 512) latent vector.
+        """
+        latent = source_face.normed_embedding.reshape((1, -1))  # type: ignore
+        latent = np.dot(latent, self.emap)
+        latent /= np.linalg.norm(latent)
+        return latent
+
+    def infer(self, blob: np.ndarray, latents: np.ndarray) -> List[CV2ImgU8]:  # type: ignore
+        """
+        Run the swap model on a NCHW blob of aligned faces and their N latents.
+
+        If the graph has a dynamic batch axis, all faces go through a single session.run,
+        otherwise the model is called once per face.
+
+        Args:
+            blob (np.ndarray): The aligned target faces, shape (N, 3, 128, 128)
+            latents (np.ndarray): The source latents, shape (N, 512)
+
+        Returns:
+            List[CV2ImgU8]: The N swapped faces (BGR, 128x128), in the same order.
+        """
+        assert self.session is not None
+        assert blob.shape[0] == latents.shape[0], "one latent is required per face"
+        if self.supports_batch or blob.shape[0] == 1:
+            preds = self.session.run(
+                self.output_names,
+                {self.input_names[0]: blob, self.input_names[1]: latents},
+            )[0]
+        else:
+            preds = np.concatenate(
+                [
+                    self.session.run(
+                        self.output_names,
+                        {
+                            self.input_names[0]: blob[i : i + 1],
+                            self.input_names[1]: latents[i : i + 1],
+                        },
+                    )[0]
+                    for i in range(blob.shape[0])
+                ]
+            )
+        imgs_fake = preds.transpose((0, 2, 3, 1))
+        return [
+            np.clip(255 * img_fake, 0, 255).astype(np.uint8)[:, :, ::-1]
+            for img_fake in imgs_fake
+        ]
+
     def get(
         self,
         img: CV2ImgU8,
@@ -172,155 +541,405 @@ class UpscaledINSwapper(INSwapper):
             (self.input_mean, self.input_mean, self.input_mean),
             swapRB=True,
         )
-        latent = source_face.normed_embedding.reshape((1, -1))  # type: ignore
-        latent = np.dot(latent, self.emap)
-        latent /= np.linalg.norm(latent)
-        assert self.session is not None
-        pred = self.session.run(
-            self.output_names, {self.input_names[0]: blob, self.input_names[1]: latent}
-        )[0]
-        # print(latent.shape, latent.dtype, pred.shape)
-        img_fake = pred.transpose((0, 2, 3, 1))[0]
-        bgr_fake = np.clip(255 * img_fake, 0, 255).astype(np.uint8)[:, :, ::-1]
+        bgr_fake = self.infer(blob, self.compute_latent(source_face))[0]
 
-        try:
-            if not paste_back:
-                return bgr_fake, M
-            else:
-                target_img = img
-
-                def compute_diff(bgr_fake: CV2ImgU8, aimg: CV2ImgU8) -> CV2ImgU8:
-                    fake_diff = bgr_fake.astype(np.float32) - aimg.astype(np.float32)
-                    fake_diff = np.abs(fake_diff).mean(axis=2)
-                    fake_diff[:2, :] = 0
-                    fake_diff[-2:, :] = 0
-                    fake_diff[:, :2] = 0
-                    fake_diff[:, -2:] = 0
-                    return fake_diff
-
-                if options:
-                    logger.info("*" * 80)
-                    logger.info(f"Inswapper")
-
-                    if options.upscaler_name and options.upscaler_name != "None":
-                        # Upscale original image
-                        k = 4
-                        aimg, M = face_align.norm_crop2(
-                            img, target_face.kps, self.input_size[0] * k
-                        )
-                    else:
-                        k = 1
-
-                    # upscale and restore face :
-                    bgr_fake = self.upscale_and_restore(
-                        bgr_fake, inswapper_options=options, k=k
-                    )
+        if not paste_back:
+            return bgr_fake, M
+        return self.paste_back(img.copy(), target_face, bgr_fake, M, options)
 
-                    fake_diff: CV2ImgU8 = None  # type: ignore
+    def get_batch(
+        self,
+        img: CV2ImgU8,
+        target_faces: List[Face],
+        source_face: Face,
+        options: Optional[InswappperOptions] = None,
+    ) -> CV2ImgU8:
+        """
+        Swap the source face in all the target faces of an image.
+
+        All target faces are aligned and stacked in one NCHW blob and sent to the model
+        with N copies of the source latent (one inference if the model supports batching).
+        The results are then pasted back in the order of target_faces. Overlapping faces are
+        swapped in successive inferences (see get_multi).
+
+        Args:
+            img (CV2ImgU8): The target image
+            target_faces (List[Face]): The faces to replace
+            source_face (Face): The face to use as source
+            options (Optional[InswappperOptions]): The swapping options
+
+        Returns:
+            CV2ImgU8: The image with all target faces swapped
+        """
+        if len(target_faces) == 0:
+            return img
 
-                    if not options.improved_mask:
-                        # If improved mask is not used, we should compute before sharpen and color correction (better diff)
-                        fake_diff = compute_diff(bgr_fake, aimg=aimg)
+        # paste_back writes in the image, keep the input untouched
+        return self.get_multi(
+            img.copy(),
+            target_faces,
+            [source_face] * len(target_faces),
+            [options] * len(target_faces),
+        )
 
-                    if options.sharpen:
-                        logger.info("sharpen")
-                        # Add sharpness
-                        blurred = cv2.GaussianBlur(bgr_fake, (0, 0), 3)
-                        bgr_fake = cv2.addWeighted(bgr_fake, 1.5, blurred, -0.5, 0)
+    def get_multi(
+        self,
+        img: CV2ImgU8,
+        target_faces: List[Face],
+        source_faces: List[Face],
+        options: List[Optional[InswappperOptions]],
+    ) -> CV2ImgU8:
+        """
+        Swap each target face with its own source face and options, in one inference.
+
+        Faces whose crops overlap the crop of a previous face are swapped in a later inference,
+        after that face is pasted back (see group_overlapping_faces), so the result is the same
+        as swapping the faces one after the other. The image is modified in place.
+
+        Args:
+            img (CV2ImgU8): The target image, modified in place
+            target_faces (List[Face]): The faces to replace
+            source_faces (List[Face]): The source face of each target face
+            options (List[Optional[InswappperOptions]]): The swapping options of each target face
+
+        Returns:
+            CV2ImgU8: The image (same buffer) with all target faces swapped
+        """
+        groups = group_overlapping_faces(target_faces, self.input_size[0], img.shape)
+        if len(groups) > 1:
+            logger.info(
+                "Overlapping faces, swap %s faces in %s inferences",
+                len(target_faces),
+                len(groups),
+            )
+        for group in groups:
+            img = self.swap_group(
+                img,
+                [target_faces[i] for i in group],
+                [source_faces[i] for i in group],
+                [options[i] for i in group],
+            )
+        return img
+
+    def swap_group(
+        self,
+        img: CV2ImgU8,
+        target_faces: List[Face],
+        source_faces: List[Face],
+        options: List[Optional[InswappperOptions]],
+    ) -> CV2ImgU8:
+        """
+        Like get_multi, for faces whose crops do not overlap : they are all aligned on the image
+        as it is on entry, swapped in one inference and pasted back in order (see paste_all).
+        """
+        aligned = [
+            face_align.norm_crop2(img, face.kps, self.input_size[0])
+            for face in target_faces
+        ]
+        blob = cv2.dnn.blobFromImages(
+            [aimg for aimg, _ in aligned],
+            1.0 / self.input_std,
+            self.input_size,
+            (self.input_mean, self.input_mean, self.input_mean),
+            swapRB=True,
+        )
+        # Source faces are usually shared by several targets
+        latents: Dict[int, np.ndarray] = {}  # type: ignore
+        for face in source_faces:
+            if id(face) not in latents:
+                latents[id(face)] = self.compute_latent(face)
+        bgr_fakes = self.infer(
+            blob, np.concatenate([latents[id(face)] for face in source_faces])
+        )
 
-                    # Apply color corrections
-                    if options.color_corrections:
-                        logger.info("color correction")
-                        correction = processing.setup_color_correction(cv2_to_pil(aimg))
-                        bgr_fake_pil = processing.apply_color_correction(
-                            correction, cv2_to_pil(bgr_fake)
-                        )
-                        bgr_fake = pil_to_cv2(bgr_fake_pil)
+        prepared = [
+            self.prepare_paste(img, face, M, face_options)
+            for face, (_, M), face_options in zip(target_faces, aligned, options)
+        ]
+        return self.paste_all(img, prepared, bgr_fakes, options)
 
-                    if options.improved_mask:
-                        if k == 1:
-                            logger.warning(
-                                "Please note that improved mask does not work well without upscaling. Set upscaling to Lanczos at least if you want speed and want to use improved mask."
-                            )
+    def iter_variants(
+        self,
+        img: CV2ImgU8,
+        source_faces: List[Face],
+        target_faces: List[List[Face]],
+        options: Optional[InswappperOptions] = None,
+        batch_size: int = 8,
+    ) -> Generator[CV2ImgU8, None, None]:
+        """
+        Swap each source face in the same target image, yield one image per source face.
+
+        The target side (alignment, model input, upscaled crop, color correction and face parsing
+        mask) is computed once per target face, whatever the number of sources. The faces of
+        batch_size sources are then sent to the model together, with one latent per face.
+
+        This reads the target image before any face is pasted, which only matches swapping the
+        faces one after the other when their crops do not overlap : the sources whose target
+        faces overlap are swapped by get_batch instead, in successive inferences.
+
+        Args:
+            img (CV2ImgU8): The target image, not modified
+            source_faces (List[Face]): The source faces
+            target_faces (List[List[Face]]): The faces to replace for each source face
+            options (Optional[InswappperOptions]): The swapping options
+            batch_size (int, optional): Number of sources per inference. Defaults to 8.
+
+        Yields:
+            CV2ImgU8: The target image swapped with each source face, in order.
+        """
+        sequential = {
+            s
+            for s, faces in enumerate(target_faces)
+            if len(group_overlapping_faces(faces, self.input_size[0], img.shape)) > 1
+        }
+        prepared: Dict[int, Tuple[np.ndarray, PreparedPaste]] = {}  # type: ignore
+        for s, faces in enumerate(target_faces):
+            if s in sequential:
+                continue
+            for face in faces:
+                if id(face) not in prepared:
+                    aimg, M = face_align.norm_crop2(img, face.kps, self.input_size[0])
+                    blob = cv2.dnn.blobFromImage(
+                        aimg,
+                        1.0 / self.input_std,
+                        self.input_size,
+                        (self.input_mean, self.input_mean, self.input_mean),
+                        swapRB=True,
+                    )
+                    prepared[id(face)] = (
+                        blob,
+                        self.prepare_paste(img, face, M, options),
+                    )
 
-                        logger.info("improved_mask")
-                        mask = get_face_mask(aimg, bgr_fake)
-                        # save_img_debug(cv2_to_pil(bgr_fake), "Before Mask")
-                        bgr_fake = merge_images_with_mask(aimg, bgr_fake, mask)
-                        # save_img_debug(cv2_to_pil(bgr_fake), "After Mask")
+        batch_size = max(batch_size, 1)
+        for start in range(0, len(source_faces), batch_size):
+            sources = range(start, min(start + batch_size, len(source_faces)))
+            pairs = [
+                (s, face)
+                for s in sources
+                if s not in sequential
+                for face in target_faces[s]
+            ]
+            bgr_fakes: List[CV2ImgU8] = []
+            if pairs:
+                latents = {s: self.compute_latent(source_faces[s]) for s in sources}
+                bgr_fakes = self.infer(
+                    np.concatenate([prepared[id(face)][0] for _, face in pairs]),
+                    np.concatenate([latents[s] for s, _ in pairs]),
+                )
+            for s in sources:
+                if s in sequential:
+                    yield self.get_batch(img, target_faces[s], source_faces[s], options)
+                    continue
+                faces = [
+                    (face, bgr_fake)
+                    for (pair_source, face), bgr_fake in zip(pairs, bgr_fakes)
+                    if pair_source == s
+                ]
+                yield self.paste_all(
+                    img.copy(),
+                    [prepared[id(face)][1] for face, _ in faces],
+                    [bgr_fake for _, bgr_fake in faces],
+                    [options] * len(faces),
+                )
 
-                        fake_diff = compute_diff(bgr_fake, aimg=aimg)
+    def prepare_paste(
+        self,
+        img: CV2ImgU8,
+        target_face: Face,
+        M: np.ndarray,  # type: ignore
+        options: Optional[InswappperOptions] = None,
+    ) -> PreparedPaste:
+        """
+        Compute what paste_back needs from the target image for a face : the (upscaled) aligned
+        crop and its color correction, depending on the options. Its face parsing mask is computed
+        by the first paste_all that needs it. It only depends on the target, so it can be reused
+        to paste several swapped faces on the same target face.
+
+        Args:
+            img (CV2ImgU8): The target image
+            target_face (Face): The face that is swapped
+            M (np.ndarray): The alignment matrix used to crop the target face for the model
+            options (Optional[InswappperOptions]): The swapping options
+        """
+        prepared = PreparedPaste(M=M)
+        if not options:
+            return prepared
+        prepared.k, prepared.restore = self.get_upscale_tier(M, options)
+        if prepared.k > 1:
+            # Upscale original image
+            prepared.aimg, prepared.M = face_align.norm_crop2(
+                img, target_face.kps, self.input_size[0] * prepared.k
+            )
+        elif options.color_corrections or options.improved_mask:
+            prepared.aimg, _ = face_align.norm_crop2(
+                img, target_face.kps, self.input_size[0]
+            )
+        if options.color_corrections:
+            prepared.color_correction = color_correction.setup_color_correction(
+                prepared.aimg
+            )
+        return prepared
+
+    def paste_back(
+        self,
+        img: CV2ImgU8,
+        target_face: Face,
+        bgr_fake: CV2ImgU8,
+        M: np.ndarray,  # type: ignore
+        options: Optional[InswappperOptions] = None,
+    ) -> CV2ImgU8:
+        """
+        Post-process a swapped face (upscale, restore, mask...) and blend it in the target image.
+        The target image is modified in place.
+
+        Args:
+            img (CV2ImgU8): The target image
+            target_face (Face): The face that has been swapped
+            bgr_fake (CV2ImgU8): The raw output of the swap model for this face
+            M (np.ndarray): The alignment matrix used to crop the target face
+            options (Optional[InswappperOptions]): The swapping options
+
+        Returns:
+            CV2ImgU8: The target image with the swapped face pasted back
+        """
+        return self.paste_prepared(
+            img, self.prepare_paste(img, target_face, M, options), bgr_fake, options
+        )
+
+    def paste_prepared(
+        self,
+        img: CV2ImgU8,
+        prepared: PreparedPaste,
+        bgr_fake: CV2ImgU8,
+        options: Optional[InswappperOptions] = None,
+    ) -> CV2ImgU8:
+        """
+        Like paste_back, with the target side computed by prepare_paste.
+        """
+        return self.paste_all(img, [prepared], [bgr_fake], [options])
 
-                    assert (
-                        fake_diff is not None
-                    ), "fake diff is None, this should not happen"
+    def enhance_fake(
+        self,
+        prepared: PreparedPaste,
+        bgr_fake: CV2ImgU8,
+        options: InswappperOptions,
+    ) -> CV2ImgU8:
+        """
+        Upscale, restore, sharpen and color correct a swapped face.
+        """
+        logger.info("*" * 80)
+        logger.info(f"Inswapper")
+
+        # upscale and restore face :
+        bgr_fake = self.upscale_and_restore(
+            bgr_fake,
+            inswapper_options=options,
+            k=prepared.k,
+            restore=prepared.restore,
+        )
 
-                    logger.info("*" * 80)
+        if options.sharpen:
+            logger.info("sharpen")
+            # Add sharpness
+            blurred = cv2.GaussianBlur(bgr_fake, (0, 0), 3)
+            bgr_fake = cv2.addWeighted(bgr_fake, 1.5, blurred, -0.5, 0)
 
-                else:
-                    fake_diff = compute_diff(bgr_fake, aimg)
+        # Apply color corrections
+        if options.color_corrections:
+            logger.info("color correction")
+            assert prepared.color_correction is not None
+            bgr_fake = color_correction.apply_color_correction(
+                prepared.color_correction, bgr_fake
+            )
 
-                IM = cv2.invertAffineTransform(M)
+        logger.info("*" * 80)
+        return bgr_fake
 
-                img_white = np.full(
-                    (aimg.shape[0], aimg.shape[1]), 255, dtype=np.float32
-                )
-                bgr_fake = cv2.warpAffine(
-                    bgr_fake,
-                    IM,
-                    (target_img.shape[1], target_img.shape[0]),
-                    borderValue=0.0,
-                )
-                img_white = cv2.warpAffine(
-                    img_white,
-                    IM,
-                    (target_img.shape[1], target_img.shape[0]),
-                    borderValue=0.0,
+    def paste_all(
+        self,
+        img: CV2ImgU8,
+        prepared: List[PreparedPaste],
+        bgr_fakes: List[CV2ImgU8],
+        options: List[Optional[InswappperOptions]],
+    ) -> CV2ImgU8:
+        """
+        Post-process swapped faces and blend them in the target image, in order. The target image
+        is modified in place.
+
+        With improved mask, the target crops (not parsed yet) and the swapped faces of all the
+        faces go through the face parser together (see generate_face_masks).
+
+        Args:
+            img (CV2ImgU8): The target image
+            prepared (List[PreparedPaste]): The target side of each face (see prepare_paste)
+            bgr_fakes (List[CV2ImgU8]): The raw output of the swap model for each face
+            options (List[Optional[InswappperOptions]]): The swapping options of each face
+
+        Returns:
+            CV2ImgU8: The target image with the swapped faces pasted back
+        """
+        try:
+            bgr_fakes = [
+                self.enhance_fake(face_prepared, bgr_fake, face_options)
+                if face_options
+                else bgr_fake
+                for face_prepared, bgr_fake, face_options in zip(
+                    prepared, bgr_fakes, options
                 )
-
-                fake_diff = cv2.warpAffine(
-                    fake_diff,
-                    IM,
-                    (target_img.shape[1], target_img.shape[0]),
-                    borderValue=0.0,
+            ]
+
+            masked = [
+                i
+                for i, face_options in enumerate(options)
+                if face_options and face_options.improved_mask
+            ]
+            if masked:
+                # Small faces are not upscaled on purpose (see get_upscale_tier)
+                if any(
+                    not options[i].upscaler_name  # type: ignore
+                    or options[i].upscaler_name == "None"  # type: ignore
+                    for i in masked
+                ):
+                    logger.warning(
+                        "Please note that improved mask does not work well without upscaling. Set upscaling to Lanczos at least if you want speed and want to use improved mask."
+                    )
+                logger.info("improved_mask")
+                # Target masks are computed once, even if several swapped faces use them
+                unparsed = list(
+                    {
+                        id(prepared[i]): prepared[i]
+                        for i in masked
+                        if prepared[i].mask is None
+                    }.values()
                 )
-                img_white[img_white > 20] = 255
-                fthresh = 10
-                fake_diff[fake_diff < fthresh] = 0
-                fake_diff[fake_diff >= fthresh] = 255
-                img_mask = img_white
-                mask_h_inds, mask_w_inds = np.where(img_mask == 255)
-                mask_h = np.max(mask_h_inds) - np.min(mask_h_inds)
-                mask_w = np.max(mask_w_inds) - np.min(mask_w_inds)
-                mask_size = int(np.sqrt(mask_h * mask_w))
-                erosion_factor = options.erosion_factor if options else 1
-
-                k = max(int(mask_size // 10 * erosion_factor), int(10 * erosion_factor))
-
-                kernel = np.ones((k, k), np.uint8)
-                img_mask = cv2.erode(img_mask, kernel, iterations=1)
-                kernel = np.ones((2, 2), np.uint8)
-                fake_diff = cv2.dilate(fake_diff, kernel, iterations=1)
-                k = max(int(mask_size // 20 * erosion_factor), int(5 * erosion_factor))
-
-                kernel_size = (k, k)
-                blur_size = tuple(2 * i + 1 for i in kernel_size)
-                img_mask = cv2.GaussianBlur(img_mask, blur_size, 0)
-                k = int(5 * erosion_factor)
-                kernel_size = (k, k)
-                blur_size = tuple(2 * i + 1 for i in kernel_size)
-                fake_diff = cv2.GaussianBlur(fake_diff, blur_size, 0)
-                img_mask /= 255
-                fake_diff /= 255
-
-                img_mask = np.reshape(
-                    img_mask, [img_mask.shape[0], img_mask.shape[1], 1]
+                masks = generate_face_masks(
+                    [face_prepared.aimg for face_prepared in unparsed]  # type: ignore
+                    + [bgr_fakes[i] for i in masked],
+                    device=shared.device,
                 )
-                fake_merged = img_mask * bgr_fake + (1 - img_mask) * target_img.astype(
-                    np.float32
+                for face_prepared, mask in zip(unparsed, masks):
+                    face_prepared.mask = mask
+                for i, fake_mask in zip(masked, masks[len(unparsed) :]):
+                    assert prepared[i].aimg is not None
+                    mask = dilate_mask(cv2.bitwise_or(prepared[i].mask, fake_mask))
+                    # save_img_debug(cv2_to_pil(bgr_fake), "Before Mask")
+                    bgr_fakes[i] = merge_images_with_mask(
+                        prepared[i].aimg, bgr_fakes[i], mask
+                    )
+                    # save_img_debug(cv2_to_pil(bgr_fake), "After Mask")
+
+            for i, (face_prepared, bgr_fake, face_options) in enumerate(
+                zip(prepared, bgr_fakes, options)
+            ):
+                logger.info(f"paste back face {i}")
+                img = paste_back_in_roi(
+                    target_img=img,
+                    bgr_fake=bgr_fake,
+                    M=face_prepared.M,
+                    erosion_factor=face_options.erosion_factor if face_options else 1,
                 )
-                fake_merged = fake_merged.astype(np.uint8)
-                return fake_merged
+            return img
         except Exception as e:
             import traceback
 
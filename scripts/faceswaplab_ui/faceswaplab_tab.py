@@ -18,6 +18,11 @@ from scripts.faceswaplab_ui.faceswaplab_unit_settings import FaceSwapUnitSetting
 from scripts.faceswaplab_ui.faceswaplab_unit_ui import faceswap_unit_ui
 from scripts.faceswaplab_utils import imgutils
 from scripts.faceswaplab_utils.faceswaplab_logging import logger
+from scripts.faceswaplab_utils.model_conversion import (
+    PRECISIONS,
+    convert_parser_model,
+    convert_swap_model,
+)
 from scripts.faceswaplab_utils.models_utils import get_swap_models
 from scripts.faceswaplab_utils.ui_utils import dataclasses_from_flat_list
 
@@ -207,6 +212,28 @@ def explore_onnx_faceswap_model(model_path: str) -> pd.DataFrame:
     return df
 
 
+def convert_model(model_path: str, precision: str) -> Optional[str]:
+    try:
+        if not model_path:
+            return "Select a model to convert"
+        report = convert_swap_model(model_path, precision)
+        return pformat(report, sort_dicts=False)
+    except Exception as e:
+        logger.error("Failed to convert model %s", e)
+        traceback.print_exc()
+        return f"Conversion failed : {e}"
+
+
+def convert_parser() -> Optional[str]:
+    try:
+        report = convert_parser_model()
+        return pformat(report, sort_dicts=False)
+    except Exception as e:
+        logger.error("Failed to export face parser %s", e)
+        traceback.print_exc()
+        return f"Export failed : {e}"
+
+
 def batch_process(
     files: List[gr.File], save_path: str, *components: Tuple[Any, ...]
 ) -> List[PILImage]:
@@ -339,6 +366,34 @@ def tools_ui() -> None:
                 label="Explored",
                 elem_id="faceswaplab_explore_result",
             )
+        with gr.Tab("Convert Model"):
+            gr.Markdown(
+                "Write a quantized (int8) or half precision (fp16) copy of a swap model in models/faceswaplab, and compare it to the original on the reference images. Restart to select the new model in settings. fp16 requires onnxconverter-common."
+            )
+            convert_model_path = gr.Dropdown(
+                choices=models,
+                label="Model",
+                elem_id="faceswaplab_convert_model",
+            )
+            convert_precision = gr.Radio(
+                PRECISIONS,
+                value=PRECISIONS[0],
+                label="Precision",
+                elem_id="faceswaplab_convert_precision",
+            )
+            convert_btn = gr.Button("Convert", elem_id="faceswaplab_convert_btn")
+            gr.Markdown(
+                "Export the improved mask face parser to onnx (models/faceswaplab/parser), and compare it to the pytorch parser on the reference images (mask agreement and CPU time). Set the face parser backend to onnx in settings to use it."
+            )
+            convert_parser_btn = gr.Button(
+                "Export face parser", elem_id="faceswaplab_convert_parser_btn"
+            )
+            convert_results = gr.Textbox(
+                label="Report",
+                interactive=False,
+                value="",
+                elem_id="faceswaplab_convert_results",
+            )
         with gr.Tab("Analyse Face"):
             img_to_analyse = gr.components.Image(
                 type="pil", label="Face", elem_id="faceswaplab_analyse_face"
@@ -394,6 +449,16 @@ def tools_ui() -> None:
     explore_btn.click(
         explore_onnx_faceswap_model, inputs=[model], outputs=[explore_result_text]
     )
+    convert_btn.click(
+        convert_model,
+        inputs=[convert_model_path, convert_precision],
+        outputs=[convert_results],
+    )
+    convert_parser_btn.click(
+        convert_parser,
+        inputs=[],
+        outputs=[convert_results],
+    )
     compare_btn.click(compare, inputs=[img1, img2], outputs=[compare_result_text])
     generate_checkpoint_btn.click(
         build_face_checkpoint_and_save,
@@ -1,13 +1,12 @@
 from scripts.faceswaplab_swapping import swapper
 import base64
-import io
 from dataclasses import dataclass
 from typing import List, Optional, Set, Union
 import gradio as gr
 from insightface.app.common import Face
 from PIL import Image
 from scripts.faceswaplab_swapping.upcaled_inswapper_options import InswappperOptions
-from scripts.faceswaplab_utils.imgutils import pil_to_cv2
+from scripts.faceswaplab_utils.imgutils import bytes_to_cv2, pil_to_cv2
 from scripts.faceswaplab_utils.faceswaplab_logging import logger
 from scripts.faceswaplab_swapping import face_checkpoints
 from scripts.faceswaplab_inpainting.faceswaplab_inpainting import InpaintingOptions
@@ -18,8 +17,8 @@ from client_api import api_utils
 class FaceSwapUnitSettings:
     # ORDER of parameters is IMPORTANT. It should match the result of faceswap_unit_ui
 
-    # The image given in reference
-    source_img: Optional[Union[Image.Image, str]]
+    # The image given in reference (PIL, base64 or encoded bytes)
+    source_img: Optional[Union[Image.Image, str, bytes]]
     # The checkpoint file
     source_face: Optional[str]
     # The batch source images
@@ -68,7 +67,8 @@ class FaceSwapUnitSettings:
                 from the API DTO.
         """
         return FaceSwapUnitSettings(
-            source_img=api_utils.base64_to_pil(dto.source_img),
+            # Kept encoded : reference_face hashes it and only decodes it on cache misses
+            source_img=dto.source_img,
             source_face=dto.source_face,
             _batch_files=dto.get_batch_images(),
             blend_faces=dto.blend_faces,
@@ -130,8 +130,10 @@ class FaceSwapUnitSettings:
                     logger.error("Failed to load checkpoint  : %s", e)
                     raise e
             elif self.source_img is not None:
-                if isinstance(self.source_img, str):  # source_img is a base64 string
-                    if (
+                if isinstance(self.source_img, (str, bytes)):
+                    if isinstance(self.source_img, bytes):  # encoded image (binary api)
+                        img_bytes = self.source_img
+                    elif (
                         "base64," in self.source_img
                     ):  # check if the base64 string has a data URL scheme
                         base64_data = self.source_img.split("base64,")[-1]
@@ -139,10 +141,16 @@ class FaceSwapUnitSettings:
                     else:
                         # if no data URL scheme, just decode
                         img_bytes = base64.b64decode(self.source_img)
-                    self.source_img = Image.open(io.BytesIO(img_bytes))
-                source_img = pil_to_cv2(self.source_img)
+                    content_hash = swapper.source_content_hash(img_bytes)
+                    load_image = lambda: bytes_to_cv2(img_bytes)
+                else:
+                    source_img = self.source_img
+                    content_hash = swapper.source_content_hash(source_img)
+                    load_image = lambda: pil_to_cv2(source_img)
                 self._reference_face = swapper.get_or_default(
-                    swapper.get_faces(source_img), self.reference_face_index, None
+                    swapper.get_source_faces(content_hash, load_image),
+                    self.reference_face_index,
+                    None,
                 )
                 if self._reference_face is None:
                     logger.error("Face not found in reference image")
@@ -168,11 +176,16 @@ class FaceSwapUnitSettings:
             for file in self.batch_files:
                 if isinstance(file, Image.Image):
                     img = file
+                    content_hash = swapper.source_content_hash(img)
                 else:
                     img = Image.open(file.name)  # type: ignore
+                    with open(file.name, "rb") as f:  # type: ignore
+                        content_hash = swapper.source_content_hash(f.read())
 
                 face = swapper.get_or_default(
-                    swapper.get_faces(pil_to_cv2(img)), 0, None
+                    swapper.get_source_faces(content_hash, lambda: pil_to_cv2(img)),
+                    0,
+                    None,
                 )
                 if face is not None:
                     self._faces.append(face)
@@ -187,3 +200,15 @@ class FaceSwapUnitSettings:
             self._blended_faces = swapper.blend_faces(self.faces)
 
         return self._blended_faces
+
+    def prepare_sources(self) -> None:
+        """
+        Extract the reference and source faces now. They are stored on the unit, so a unit reused
+        for several images only resolves them once.
+        """
+        if self.enable:
+            if self.blend_faces:
+                self.blended_faces
+            else:
+                self.faces
+            self.reference_face
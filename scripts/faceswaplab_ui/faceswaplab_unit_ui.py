@@ -4,6 +4,7 @@ from scripts.faceswaplab_swapping.face_checkpoints import get_face_checkpoints
 import gradio as gr
 from modules import shared
 from scripts.faceswaplab_utils.sd_utils import get_sd_option
+from scripts.faceswaplab_postprocessing.native_upscaling import get_native_upscalers
 
 
 def faceswap_unit_advanced_options(
@@ -47,7 +48,8 @@ def faceswap_unit_advanced_options(
                     elem_id=f"{id_prefix}_face{unit_num}_face_restorer_weight",
                 )
         upscaler_name = gr.Dropdown(
-            choices=[upscaler.name for upscaler in shared.sd_upscalers],
+            choices=[upscaler.name for upscaler in shared.sd_upscalers]
+            + get_native_upscalers(),
             value=get_sd_option("faceswaplab_default_upscaled_swapper_upscaler", ""),
             label="Upscaler",
             elem_id=f"{id_prefix}_face{unit_num}_upscaler",
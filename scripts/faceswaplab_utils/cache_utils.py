@@ -0,0 +1,162 @@
+import functools
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Generic, Hashable, Optional, TypeVar, Union
+
+import numpy as np
+from PIL import Image
+
+from scripts.faceswaplab_utils.faceswaplab_logging import logger
+from scripts.faceswaplab_utils.typing import CV2ImgU8, PILImage
+
+V = TypeVar("V")
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+def image_hash(img: Union[CV2ImgU8, PILImage]) -> str:
+    """
+    Compute a hash of the pixels of an image (cv2 array or PIL image).
+
+    Two images with the same pixels, shape and format have the same hash, whatever object holds them.
+
+    Args:
+        img (Union[CV2ImgU8, PILImage]): The image to hash.
+
+    Returns:
+        str: The hex digest of the image content.
+    """
+    sha1_hash = hashlib.sha1(usedforsecurity=False)
+    if isinstance(img, Image.Image):
+        sha1_hash.update(f"{img.mode}{img.size}".encode())
+        sha1_hash.update(img.tobytes())
+    else:
+        sha1_hash.update(f"{img.dtype}{img.shape}".encode())
+        sha1_hash.update(np.ascontiguousarray(img).data)
+    return sha1_hash.hexdigest()
+
+
+def sizeof(value: Any) -> int:
+    """
+    Roughly estimate the memory used by a value (numpy arrays, dicts and lists of them).
+
+    Args:
+        value (Any): The value to measure.
+
+    Returns:
+        int: The estimated size in bytes.
+    """
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, dict):
+        return 64 + sum(sizeof(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return 64 + sum(sizeof(v) for v in value)
+    return 64
+
+
+class ContentCache(Generic[V]):
+    """
+    A thread safe LRU cache bounded by the estimated memory size of its values.
+
+    Keys are usually built from a content hash (see image_hash) and the parameters used to compute
+    the value. The least recently used entries are evicted when the total size goes over max_bytes.
+    Hits and misses are counted to be exposed in stats().
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_bytes: Callable[[], int],
+        value_size: Callable[[V], int] = sizeof,
+    ) -> None:
+        """
+        Args:
+            name (str): The name of the cache (used in logs and stats).
+            max_bytes (Callable[[], int]): Returns the current memory budget, read on every insertion
+                so that a settings change is applied without restart. 0 disables the cache.
+            value_size (Callable[[V], int], optional): Estimate the size of a value. Defaults to sizeof.
+        """
+        self.name = name
+        self.max_bytes = max_bytes
+        self.value_size = value_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[Hashable, V]" = OrderedDict()
+        self._sizes: Dict[Hashable, int] = {}
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[V]:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: Hashable, value: V) -> None:
+        max_bytes = self.max_bytes()
+        size = self.value_size(value)
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= self._sizes.pop(key)
+                del self._entries[key]
+            if size > max_bytes:
+                return
+            self._entries[key] = value
+            self._sizes[key] = size
+            self._total_bytes += size
+            while self._total_bytes > max_bytes:
+                old_key, _ = self._entries.popitem(last=False)
+                self._total_bytes -= self._sizes.pop(old_key)
+                self.evictions += 1
+        logger.debug("%s cache : %s", self.name, self.stats())
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._total_bytes = 0
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes(),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+def locked_lru_cache(maxsize: int) -> Callable[[F], F]:
+    """
+    Like functools.lru_cache, but concurrent calls wait for the one computing the value.
+
+    Used for model loaders : without the lock, a request arriving while the preloader (or another
+    request) is loading a model would load a second copy.
+
+    Args:
+        maxsize (int): The lru_cache maxsize.
+    """
+
+    def decorator(func: F) -> F:
+        cached = functools.lru_cache(maxsize=maxsize)(func)
+        lock = threading.RLock()
+
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with lock:
+                return cached(*args, **kwargs)
+
+        wrapper.cache_clear = cached.cache_clear  # type: ignore
+        wrapper.cache_info = cached.cache_info  # type: ignore
+        return wrapper  # type: ignore
+
+    return decorator
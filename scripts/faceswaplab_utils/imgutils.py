@@ -9,39 +9,9 @@ from modules import processing
 import base64
 from collections import Counter
 from scripts.faceswaplab_utils.sd_utils import get_sd_option
-from scripts.faceswaplab_utils.typing import BoxCoords, CV2ImgU8, PILImage
+from scripts.faceswaplab_utils.typing import AnyImage, BoxCoords, CV2ImgU8, PILImage
 from scripts.faceswaplab_utils.faceswaplab_logging import logger
-
-
-def check_against_nsfw(img: PILImage) -> bool:
-    """
-    Check if an image exceeds the Not Safe for Work (NSFW) score.
-
-    Parameters:
-    img (PILImage): The image to be checked.
-
-    Returns:
-    bool: True if any part of the image is considered NSFW, False otherwise.
-    """
-
-    NSFW_SCORE_THRESHOLD = get_sd_option("faceswaplab_nsfw_threshold", 0.7)
-
-    # For testing purpose :
-    if NSFW_SCORE_THRESHOLD >= 1:
-        return False
-
-    from ifnude import detect
-
-    shapes: List[bool] = []
-    chunks: List[Dict[str, Union[int, float]]] = detect(img)
-
-    for chunk in chunks:
-        logger.debug(
-            f"chunck score {chunk['score']}, threshold : {NSFW_SCORE_THRESHOLD}"
-        )
-        shapes.append(chunk["score"] > NSFW_SCORE_THRESHOLD)
-
-    return any(shapes)
+from scripts.faceswaplab_utils.nsfw import check_against_nsfw  # noqa: F401
 
 
 def pil_to_cv2(pil_img: PILImage) -> CV2ImgU8:
@@ -70,6 +40,45 @@ def cv2_to_pil(cv2_img: CV2ImgU8) -> PILImage:  # type: ignore
     return Image.fromarray(cv2.cvtColor(cv2_img, cv2.COLOR_BGR2RGB))
 
 
+def as_cv2(img: AnyImage) -> CV2ImgU8:
+    """
+    Returns the image in OpenCV format (BGR), converted only if it is a PIL image.
+    """
+    return img if isinstance(img, np.ndarray) else pil_to_cv2(img)
+
+
+def as_pil(img: AnyImage) -> PILImage:
+    """
+    Returns the image in PIL format, converted only if it is an OpenCV image (BGR).
+    """
+    return cv2_to_pil(img) if isinstance(img, np.ndarray) else img
+
+
+def crop_cv2(img: CV2ImgU8, box: BoxCoords) -> CV2ImgU8:
+    """
+    Crop an OpenCV image like PIL.Image.crop : the parts of the box outside the image are black.
+
+    Args:
+        img (CV2ImgU8): The image
+        box (BoxCoords): x_min, y_min, x_max, y_max
+
+    Returns:
+        CV2ImgU8: The crop, of the size of the box
+    """
+    x_min, y_min, x_max, y_max = box
+    height, width = img.shape[:2]
+    crop = img[max(y_min, 0) : min(y_max, height), max(x_min, 0) : min(x_max, width)]
+    return cv2.copyMakeBorder(
+        crop,
+        max(-y_min, 0),
+        max(y_max - max(height, y_min), 0),
+        max(-x_min, 0),
+        max(x_max - max(width, x_min), 0),
+        cv2.BORDER_CONSTANT,
+        value=0,
+    )
+
+
 def torch_to_pil(tensor: torch.Tensor) -> List[PILImage]:
     """
     Converts a tensor image or a batch of tensor images to a PIL image or a list of PIL images.
@@ -287,3 +296,70 @@ def base64_to_pil(base64str: Optional[str]) -> Optional[PILImage]:
         img_bytes = base64.b64decode(base64str)
 
     return Image.open(io.BytesIO(img_bytes))
+
+
+IMAGE_MEDIA_TYPES: Dict[str, str] = {
+    "png": "image/png",
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+}
+
+
+def bytes_to_cv2(data: bytes) -> CV2ImgU8:
+    """
+    Decode an encoded image (png, jpeg, webp...) straight into an OpenCV image.
+
+    The EXIF orientation is ignored, as PIL does when decoding base64 images (base64_to_pil), so
+    that an image gives the same pixels whatever the endpoint it is sent to.
+
+    Args:
+        data (bytes): The encoded image.
+
+    Returns:
+        CV2ImgU8: The decoded image (BGR).
+
+    Raises:
+        ValueError: If the data can not be decoded.
+    """
+    img = cv2.imdecode(
+        np.frombuffer(data, dtype=np.uint8),
+        cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION,
+    )
+    if img is None:
+        raise ValueError("Can not decode image")
+    return img
+
+
+def encode_image(
+    img: Union[PILImage, CV2ImgU8],
+    format: str = "png",
+    quality: int = 90,
+    lossless: bool = False,
+) -> bytes:
+    """
+    Encode an image with OpenCV.
+
+    Args:
+        img (Union[PILImage, CV2ImgU8]): The image (PIL or BGR array).
+        format (str, optional): png, jpeg or webp. Defaults to "png".
+        quality (int, optional): jpeg and webp quality (1-100). Defaults to 90.
+        lossless (bool, optional): Lossless webp. Defaults to False.
+
+    Returns:
+        bytes: The encoded image.
+    """
+    if isinstance(img, Image.Image):
+        img = pil_to_cv2(img.convert("RGB"))
+    if format == "jpeg":
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+    elif format == "webp":
+        # OpenCV encodes lossless webp for qualities above 100
+        params = [cv2.IMWRITE_WEBP_QUALITY, 101 if lossless else quality]
+    elif format == "png":
+        params = [cv2.IMWRITE_PNG_COMPRESSION, 3]
+    else:
+        raise ValueError(f"Unknown image format {format}")
+    ok, buffer = cv2.imencode(f".{format}", img, params)
+    if not ok:
+        raise ValueError(f"Failed to encode image as {format}")
+    return buffer.tobytes()
@@ -0,0 +1,313 @@
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from scripts.faceswaplab_globals import MODELS_DIR, REFERENCE_PATH
+from scripts.faceswaplab_utils.faceswaplab_logging import logger
+
+PRECISIONS = ["int8", "fp16"]
+
+
+def get_variant_path(model_path: str, precision: str) -> str:
+    """
+    Path of the converted variant of a model : <MODELS_DIR>/<name>.<precision>.onnx, so that swap
+    model variants are listed by get_swap_models.
+    """
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(MODELS_DIR, f"{name}.{precision}.onnx")
+
+
+def get_report_path(variant_path: str) -> str:
+    return os.path.splitext(variant_path)[0] + ".report.json"
+
+
+def get_unused_last_initializer(model: Any) -> Optional[Any]:
+    """
+    Return the last initializer of a graph if no node uses it.
+
+    inswapper stores the embedding projection (emap) this way : it is read from the file by
+    insightface (graph.initializer[-1]) and is not part of the computation.
+    """
+    if not model.graph.initializer:
+        return None
+    last = model.graph.initializer[-1]
+    used = {name for node in model.graph.node for name in node.input}
+    return None if last.name in used else last
+
+
+def convert_model(
+    model_path: str, precision: str, output_path: Optional[str] = None
+) -> str:
+    """
+    Write an INT8 (dynamic quantization) or FP16 copy of an onnx model.
+
+    Inputs and outputs stay float32, so variants are drop-in replacements. An unused last
+    initializer (the inswapper emap) is copied unchanged in float32 at the end of the graph.
+    FP16 conversion requires the optional onnxconverter-common package.
+
+    Args:
+        model_path (str): The fp32 model
+        precision (str): "int8" or "fp16"
+        output_path (Optional[str], optional): Defaults to get_variant_path(model_path, precision)
+
+    Returns:
+        str: The path of the converted model
+    """
+    import onnx
+
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}, expected one of {PRECISIONS}")
+    output_path = output_path or get_variant_path(model_path, precision)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    logger.info("Convert %s to %s (%s)", model_path, precision, output_path)
+
+    model = onnx.load(model_path)
+    emap = get_unused_last_initializer(model)
+
+    if precision == "int8":
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        # onnxruntime cpu ConvInteger only supports uint8 weights
+        quantize_dynamic(model_path, output_path, weight_type=QuantType.QUInt8)
+        variant = onnx.load(output_path)
+    else:
+        try:
+            from onnxconverter_common import float16
+        except ImportError:
+            raise ImportError(
+                "fp16 conversion requires onnxconverter-common (pip install onnxconverter-common)"
+            )
+        variant = float16.convert_float_to_float16(model, keep_io_types=True)
+
+    if emap is not None:
+        initializers = [i for i in variant.graph.initializer if i.name != emap.name]
+        del variant.graph.initializer[:]
+        variant.graph.initializer.extend(initializers)
+        variant.graph.initializer.append(emap)
+    onnx.save(variant, output_path)
+    return output_path
+
+
+def build_conversion_report(
+    reference_model_path: str, variant_model_path: str, runs: int = 5
+) -> Dict[str, Any]:
+    """
+    Compare a swap model variant to its fp32 reference on the reference images (man.png and woman.png).
+
+    Each reference face is swapped with the other one as source, by both models. The report gives,
+    for each swap, the pixel error between the 128x128 outputs and the identity similarity of the
+    swapped face with the source face (cosine similarity of recognition embeddings), along with the
+    file sizes and the mean inference time of both models.
+
+    Args:
+        reference_model_path (str): The fp32 swap model
+        variant_model_path (str): The converted swap model
+        runs (int, optional): Number of inferences used for timings. Defaults to 5.
+
+    Returns:
+        Dict[str, Any]: The report
+    """
+    import cv2
+    from insightface.app.common import Face
+    from insightface.model_zoo.inswapper import INSwapper
+
+    from scripts.faceswaplab_swapping import swapper
+    from scripts.faceswaplab_swapping.face_analysis import RECOGNITION, SOURCE_MODULES
+    from scripts.faceswaplab_swapping.upscaled_inswapper import UpscaledINSwapper
+    from scripts.faceswaplab_utils.onnx_sessions import SWAP_SESSION, create_session
+
+    providers = swapper.get_providers()
+    models = {
+        name: UpscaledINSwapper(
+            INSwapper(
+                model_file=path,
+                session=create_session(path, providers, SWAP_SESSION),
+            )
+        )
+        for name, path in [
+            ("reference", reference_model_path),
+            ("variant", variant_model_path),
+        ]
+    }
+    analyser = swapper.getAnalysisModel(use_gpu=not swapper.is_cpu_provider())
+    recognition = analyser.load_module(RECOGNITION)
+
+    images = [
+        cv2.imread(os.path.join(REFERENCE_PATH, name))
+        for name in ["man.png", "woman.png"]
+    ]
+    faces = [swapper.get_faces(img, modules=SOURCE_MODULES)[0] for img in images]
+
+    def identity(img: np.ndarray, target: Face, source: Face) -> float:
+        embedding = recognition.get(img, Face(kps=target.kps))
+        return float(
+            np.dot(embedding / np.linalg.norm(embedding), source.normed_embedding)
+        )
+
+    swaps: List[Dict[str, Any]] = []
+    for i, (target_img, target_face) in enumerate(zip(images, faces)):
+        source_face = faces[1 - i]
+        results = {}
+        for name, model in models.items():
+            bgr_fake, M = model.get(
+                target_img, target_face, source_face, paste_back=False
+            )
+            pasted = model.paste_back(target_img.copy(), target_face, bgr_fake, M, None)
+            results[name] = (bgr_fake.astype(np.float32), pasted)
+        error = np.abs(results["reference"][0] - results["variant"][0])
+        swaps.append(
+            {
+                "target": ["man.png", "woman.png"][i],
+                "pixel_mae": float(error.mean()),
+                "pixel_max_error": float(error.max()),
+                "identity_reference": identity(
+                    results["reference"][1], target_face, source_face
+                ),
+                "identity_variant": identity(
+                    results["variant"][1], target_face, source_face
+                ),
+            }
+        )
+
+    timings = {}
+    for name, model in models.items():
+        model.get(images[0], faces[0], faces[1], paste_back=False)
+        start = time.perf_counter()
+        for _ in range(runs):
+            model.get(images[0], faces[0], faces[1], paste_back=False)
+        timings[name] = (time.perf_counter() - start) / runs
+
+    return {
+        "reference_model": reference_model_path,
+        "variant_model": variant_model_path,
+        "providers": providers,
+        "reference_size_mb": os.path.getsize(reference_model_path) / 2**20,
+        "variant_size_mb": os.path.getsize(variant_model_path) / 2**20,
+        "reference_seconds_per_face": timings["reference"],
+        "variant_seconds_per_face": timings["variant"],
+        "swaps": swaps,
+    }
+
+
+def convert_swap_model(model_path: str, precision: str) -> Dict[str, Any]:
+    """
+    Convert a swap model, then build its report and save it next to the variant (<variant>.report.json).
+
+    Returns:
+        Dict[str, Any]: The report (see build_conversion_report)
+    """
+    variant_path = convert_model(model_path, precision)
+    report = build_conversion_report(model_path, variant_path)
+    with open(get_report_path(variant_path), "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info("Conversion report : %s", report)
+    return report
+
+
+def build_parser_report(
+    onnx_path: Optional[str] = None, size: int = 512, runs: int = 5
+) -> Dict[str, Any]:
+    """
+    Compare the exported face parser to the pytorch ParseNet on the reference faces, on CPU.
+
+    The report gives, for each face crop, the share of pixels classified the same way by both
+    backends and the IoU of their face masks, along with the mean parsing time per crop of both
+    backends (one batch of all crops).
+
+    Args:
+        onnx_path (Optional[str], optional): Defaults to facemask.PARSING_ONNX_PATH
+        size (int, optional): Parsing resolution. Defaults to 512.
+        runs (int, optional): Number of batches used for timings. Defaults to 5.
+
+    Returns:
+        Dict[str, Any]: The report
+    """
+    import cv2
+    import torch
+    from insightface.utils import face_align
+
+    from scripts.faceswaplab_swapping import facemask, swapper
+    from scripts.faceswaplab_swapping.face_analysis import SWAP_MODULES
+    from scripts.faceswaplab_utils.onnx_sessions import SWAP_SESSION, create_session
+
+    onnx_path = onnx_path or facemask.PARSING_ONNX_PATH
+    session = create_session(onnx_path, ["CPUExecutionProvider"], SWAP_SESSION)
+    device = torch.device("cpu")
+
+    names = ["man.png", "woman.png"]
+    crops = []
+    for name in names:
+        img = cv2.imread(os.path.join(REFERENCE_PATH, name))
+        face = swapper.get_faces(img, modules=SWAP_MODULES)[0]
+        crop, _ = face_align.norm_crop2(img, face.kps, size)
+        crops.append(crop)
+    batch = np.stack([crop[:, :, ::-1] for crop in crops])
+
+    labels = {
+        "torch": facemask.parse_faces_torch(batch, device),
+        "onnx": facemask.parse_faces_onnx(batch, session),
+    }
+    faces: List[Dict[str, Any]] = []
+    for i, name in enumerate(names):
+        torch_mask = facemask.MASK_LUT[labels["torch"][i]] > 0
+        onnx_mask = facemask.MASK_LUT[labels["onnx"][i]] > 0
+        union = np.logical_or(torch_mask, onnx_mask).sum()
+        faces.append(
+            {
+                "image": name,
+                "label_agreement": float(
+                    (labels["torch"][i] == labels["onnx"][i]).mean()
+                ),
+                "mask_iou": float(
+                    np.logical_and(torch_mask, onnx_mask).sum() / union
+                    if union
+                    else 1.0
+                ),
+            }
+        )
+
+    def parse_torch() -> np.ndarray:  # type: ignore
+        return facemask.parse_faces_torch(batch, device)
+
+    def parse_onnx() -> np.ndarray:  # type: ignore
+        return facemask.parse_faces_onnx(batch, session)
+
+    timings = {}
+    for name, parse in [("torch", parse_torch), ("onnx", parse_onnx)]:
+        parse()
+        start = time.perf_counter()
+        for _ in range(runs):
+            parse()
+        timings[name] = (time.perf_counter() - start) / (runs * len(crops))
+
+    return {
+        "onnx_model": onnx_path,
+        "size": size,
+        "torch_threads": torch.get_num_threads(),
+        "torch_cpu_seconds_per_face": timings["torch"],
+        "onnx_cpu_seconds_per_face": timings["onnx"],
+        "faces": faces,
+    }
+
+
+def convert_parser_model() -> Dict[str, Any]:
+    """
+    Export the face parser to onnx (see facemask.export_parsing_model), then build its report and
+    save it next to the model (<model>.report.json).
+
+    Returns:
+        Dict[str, Any]: The report (see build_parser_report)
+    """
+    from scripts.faceswaplab_swapping import facemask
+
+    onnx_path = facemask.export_parsing_model()
+    # The previous session (if any) used the previous export
+    facemask.get_parsing_session.cache_clear()  # type: ignore
+    report = build_parser_report(onnx_path)
+    with open(get_report_path(onnx_path), "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info("Face parser conversion report : %s", report)
+    return report
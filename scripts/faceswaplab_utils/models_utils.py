@@ -3,23 +3,28 @@ import os
 from typing import List
 import modules.scripts as scripts
 from modules import scripts
-from scripts.faceswaplab_globals import EXPECTED_INSWAPPER_SHA1, EXTENSION_PATH
+from scripts.faceswaplab_globals import (
+    EXPECTED_INSWAPPER_SHA1,
+    EXTENSION_PATH,
+    MODELS_DIR,
+)
 from modules.shared import opts
 from scripts.faceswaplab_utils.faceswaplab_logging import logger
 import traceback
 import hashlib
 
 
-def is_sha1_matching(file_path: str, expected_sha1: str) -> bool:
+def get_file_sha1(file_path: str) -> str:
     sha1_hash = hashlib.sha1(usedforsecurity=False)
+    with open(file_path, "rb") as file:
+        for byte_block in iter(lambda: file.read(1024 * 1024), b""):
+            sha1_hash.update(byte_block)
+    return sha1_hash.hexdigest()
+
+
+def is_sha1_matching(file_path: str, expected_sha1: str) -> bool:
     try:
-        with open(file_path, "rb") as file:
-            for byte_block in iter(lambda: file.read(4096), b""):
-                sha1_hash.update(byte_block)
-            if sha1_hash.hexdigest() == expected_sha1:
-                return True
-            else:
-                return False
+        return get_file_sha1(file_path) == expected_sha1
     except Exception as e:
         logger.error(
             "Failed to check model hash, check the model is valid or has been downloaded adequately : %e",
@@ -85,3 +90,71 @@ def get_current_swap_model() -> str:
 
     assert model is not None
     return model
+
+
+def get_dynamic_batch_model(model_path: str) -> str:
+    """
+    Return the path of a copy of the swap model whose batch axis is dynamic, building it if needed.
+
+    The inswapper_128 graph is exported with a fixed batch size of 1. This rewrites the first
+    dimension of every graph input and output to a symbolic "batch" dimension and drops the
+    intermediate shape annotations so that onnxruntime infers them again. The rewritten model is
+    checked by running a batch of 2 faces. The copy is stored in MODELS_DIR/dynamic_batch, which is
+    not listed in the swap models.
+
+    Args:
+        model_path (str): The path of the swap model.
+
+    Returns:
+        str: The path of the dynamic batch model, or model_path if it already is dynamic or if the
+        conversion failed.
+    """
+    import numpy as np
+    import onnx
+    import onnxruntime
+
+    dynamic_dir = os.path.join(MODELS_DIR, "dynamic_batch")
+    dynamic_path = os.path.join(dynamic_dir, os.path.basename(model_path))
+    if os.path.isfile(dynamic_path) and os.path.getmtime(
+        dynamic_path
+    ) >= os.path.getmtime(model_path):
+        return dynamic_path
+
+    try:
+        model = onnx.load(model_path)
+        graph_ios = list(model.graph.input) + list(model.graph.output)
+        batch_dims = [io.type.tensor_type.shape.dim[0] for io in graph_ios]
+        if all(dim.dim_param for dim in batch_dims):
+            return model_path
+
+        logger.info("Rewrite %s with a dynamic batch axis", model_path)
+        for dim in batch_dims:
+            dim.ClearField("dim_value")
+            dim.dim_param = "batch"
+        del model.graph.value_info[:]
+
+        os.makedirs(dynamic_dir, exist_ok=True)
+        onnx.save(model, dynamic_path)
+
+        # Check that the graph really accepts more than one face
+        session = onnxruntime.InferenceSession(
+            dynamic_path, providers=["CPUExecutionProvider"]
+        )
+        feeds = {}
+        for graph_input in session.get_inputs():
+            shape = [2] + [
+                d if isinstance(d, int) else 1 for d in graph_input.shape[1:]
+            ]
+            feeds[graph_input.name] = np.random.rand(*shape).astype(np.float32)
+        outputs = session.run(None, feeds)
+        assert outputs[0].shape[0] == 2, "batch axis not propagated"
+        return dynamic_path
+    except Exception as e:
+        logger.warning(
+            "Failed to build dynamic batch model for %s, faces will be swapped one by one : %s",
+            model_path,
+            e,
+        )
+        if os.path.isfile(dynamic_path):
+            os.remove(dynamic_path)
+        return model_path
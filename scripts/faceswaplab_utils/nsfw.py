@@ -0,0 +1,181 @@
+from typing import Any, Dict, List, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+from scripts.faceswaplab_utils.cache_utils import (
+    ContentCache,
+    image_hash,
+    locked_lru_cache,
+)
+from scripts.faceswaplab_utils.faceswaplab_logging import logger
+from scripts.faceswaplab_utils.sd_utils import get_sd_option
+from scripts.faceswaplab_utils.typing import AnyImage, CV2ImgU8
+
+# Preprocessing and filtering of ifnude.detect (default mode), used as the full size reference
+FULL_SIZE_MIN_SIDE = 800
+FULL_SIZE_MAX_SIDE = 1333
+CAFFE_MEAN = np.array([103.939, 116.779, 123.68], dtype=np.float32)
+MIN_PROB = 0.6
+IGNORED_LABELS = {"EXPOSED_BELLY"}
+
+# Verdicts are tiny, this keeps about 16k of them
+NSFW_CACHE: ContentCache[bool] = ContentCache(
+    "nsfw", max_bytes=lambda: 1024 * 1024, value_size=lambda _: 64
+)
+
+
+@locked_lru_cache(maxsize=1)
+def get_nsfw_detector() -> Tuple[Any, List[str]]:
+    """
+    Load the ifnude detection model once.
+
+    ifnude.detect creates a new onnxruntime session on every call, which costs more than the
+    detection itself. The model and its classes are downloaded by ifnude on first import.
+
+    This reads ifnude internals (detector.model_path, detector.classes) and copies the
+    preprocessing and filtering of ifnude.detect, as of ifnude 0.0.3 : the version is pinned in
+    the requirements and must be checked again before upgrading it.
+
+    Returns:
+        Tuple[Any, List[str]]: The onnxruntime session and the class names.
+    """
+    import onnxruntime
+    from ifnude import detector
+
+    session = onnxruntime.InferenceSession(
+        detector.model_path, providers=["CPUExecutionProvider"]
+    )
+    return session, list(detector.classes)
+
+
+def get_resize_scale(shape: Tuple[int, ...], min_side: int, max_side: int) -> float:
+    """
+    Scale giving the image a smallest side of min_side, without a largest side above max_side.
+    """
+    rows, cols = shape[:2]
+    scale = min_side / min(rows, cols)
+    if max(rows, cols) * scale > max_side:
+        scale = max_side / max(rows, cols)
+    return scale
+
+
+def preprocess(img: CV2ImgU8, min_side: int) -> np.ndarray:  # type: ignore
+    """
+    Resize a BGR image for the detector and subtract the caffe mean.
+
+    min_side is the smallest side of the detector input (the largest side keeps the ratio of the
+    ifnude defaults). Resizing is done on uint8 pixels, with INTER_AREA when downscaling.
+    """
+    max_side = min_side * FULL_SIZE_MAX_SIDE // FULL_SIZE_MIN_SIDE
+    scale = get_resize_scale(img.shape, min_side, max_side)
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+    resized = cv2.resize(img, None, fx=scale, fy=scale, interpolation=interpolation)
+    return resized.astype(np.float32) - CAFFE_MEAN
+
+
+def detect_nsfw(
+    images: Sequence[CV2ImgU8], min_side: int, threshold: float
+) -> List[bool]:
+    """
+    Run the detector on BGR images and return whether each one has a part scored above threshold.
+
+    Images with the same input shape once resized go through a single inference when the model
+    accepts batches.
+    """
+    session, classes = get_nsfw_detector()
+    model_input = session.get_inputs()[0]
+    batch_dim = model_input.shape[0]
+    supports_batch = not (isinstance(batch_dim, int) and batch_dim == 1)
+
+    groups: Dict[Tuple[int, ...], List[int]] = {}
+    blobs = [preprocess(img, min_side) for img in images]
+    for i, blob in enumerate(blobs):
+        groups.setdefault(blob.shape, []).append(i)
+
+    verdicts = [False] * len(images)
+    for indices in groups.values():
+        batches = [indices] if supports_batch else [[i] for i in indices]
+        for batch in batches:
+            outputs = session.run(
+                [output.name for output in session.get_outputs()],
+                {model_input.name: np.stack([blobs[i] for i in batch])},
+            )
+            # Same output selection as ifnude.detect
+            labels = [op for op in outputs if op.dtype == "int32"][0]
+            scores = [op for op in outputs if isinstance(op[0][0], np.float32)][0]
+            for row, i in enumerate(batch):
+                for score, label in zip(scores[row], labels[row]):
+                    if score < MIN_PROB or classes[label] in IGNORED_LABELS:
+                        continue
+                    logger.debug(f"chunck score {score}, threshold : {threshold}")
+                    if score > threshold:
+                        verdicts[i] = True
+    return verdicts
+
+
+def check_against_nsfw_batch(images: Sequence[AnyImage]) -> List[bool]:
+    """
+    Check a list of images against the NSFW score threshold, in one pass.
+
+    Images are checked on a copy downscaled to faceswaplab_nsfw_size (smallest side). Verdicts are
+    cached by image content (see NSFW_CACHE), so an image is only evaluated once, whatever the
+    number of units it goes through. With faceswaplab_nsfw_validate, images are also checked at
+    the ifnude full size : a different verdict is logged and the full size verdict is used.
+
+    Args:
+        images (Sequence[AnyImage]): The images to check (PIL or BGR arrays).
+
+    Returns:
+        List[bool]: For each image, True if any part is considered NSFW.
+    """
+    threshold = get_sd_option("faceswaplab_nsfw_threshold", 0.7)
+
+    # For testing purpose :
+    if threshold >= 1:
+        return [False] * len(images)
+
+    min_side = int(get_sd_option("faceswaplab_nsfw_size", 480))
+    validate = get_sd_option("faceswaplab_nsfw_validate", False)
+    keys = [(image_hash(img), min_side, threshold, validate) for img in images]
+    verdicts: Dict[Any, bool] = {}
+    missing: Dict[Any, CV2ImgU8] = {}
+    for key, img in zip(keys, images):
+        verdict = NSFW_CACHE.get(key)
+        if verdict is not None:
+            verdicts[key] = verdict
+        elif key not in missing:
+            missing[key] = (
+                img
+                if isinstance(img, np.ndarray)
+                else cv2.cvtColor(np.array(img.convert("RGB")), cv2.COLOR_RGB2BGR)
+            )
+
+    if missing:
+        imgs = list(missing.values())
+        results = detect_nsfw(imgs, min_side, threshold)
+        if validate:
+            full_size = detect_nsfw(imgs, FULL_SIZE_MIN_SIDE, threshold)
+            for downscaled, reference in zip(results, full_size):
+                if downscaled != reference:
+                    logger.warning(
+                        "NSFW verdict at size %s (%s) differs from full size (%s), increase faceswaplab_nsfw_size",
+                        min_side,
+                        downscaled,
+                        reference,
+                    )
+            results = full_size
+        for key, verdict in zip(missing, results):
+            NSFW_CACHE.put(key, verdict)
+            verdicts[key] = verdict
+    return [verdicts[key] for key in keys]
+
+
+def check_against_nsfw(img: AnyImage) -> bool:
+    """
+    Check if an image exceeds the Not Safe for Work (NSFW) score (see check_against_nsfw_batch).
+
+    Returns:
+        bool: True if any part of the image is considered NSFW, False otherwise.
+    """
+    return check_against_nsfw_batch([img])[0]
@@ -0,0 +1,167 @@
+import json
+import os
+import platform
+import threading
+from typing import Dict, List, Optional
+
+import onnxruntime
+
+from scripts.faceswaplab_globals import MODELS_DIR
+from scripts.faceswaplab_utils.faceswaplab_logging import logger
+from scripts.faceswaplab_utils.models_utils import get_file_sha1
+from scripts.faceswaplab_utils.sd_utils import get_sd_option
+
+# Optimized graphs written by onnxruntime, reused on the next starts
+ORT_CACHE_DIR = os.path.join(MODELS_DIR, "ort_cache")
+
+# Kinds of models that can be tuned separately (see the faceswaplab_ort_<kind>_* settings)
+ANALYSIS_SESSION = "analysis"
+SWAP_SESSION = "swap"
+
+OPTIMIZATION_LEVELS: Dict[str, onnxruntime.GraphOptimizationLevel] = {
+    "disabled": onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+EXECUTION_MODES: Dict[str, onnxruntime.ExecutionMode] = {
+    "sequential": onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": onnxruntime.ExecutionMode.ORT_PARALLEL,
+}
+
+_sha1_lock = threading.Lock()
+
+
+def get_model_sha1(model_path: str) -> str:
+    """
+    Return the sha1 of a model, reading it from an index in ORT_CACHE_DIR when the file has not changed.
+
+    Hashing the swap model takes about a second, the index avoids paying it on every start.
+    """
+    index_path = os.path.join(ORT_CACHE_DIR, "sha1_index.json")
+    stat = os.stat(model_path)
+    key = os.path.abspath(model_path)
+    with _sha1_lock:
+        index: Dict[str, Dict[str, object]] = {}
+        if os.path.exists(index_path):
+            try:
+                with open(index_path, "r") as f:
+                    index = json.load(f)
+            except Exception as e:
+                logger.warning("Ignore invalid ORT cache index %s : %s", index_path, e)
+        entry = index.get(key)
+        if (
+            entry
+            and entry.get("size") == stat.st_size
+            and entry.get("mtime") == stat.st_mtime
+        ):
+            return str(entry["sha1"])
+        sha1 = get_file_sha1(model_path)
+        index[key] = {"size": stat.st_size, "mtime": stat.st_mtime, "sha1": sha1}
+        os.makedirs(ORT_CACHE_DIR, exist_ok=True)
+        with open(index_path, "w") as f:
+            json.dump(index, f, indent=2)
+        return sha1
+
+
+def get_optimized_model_path(
+    model_path: str, provider: str, optimization_level: str
+) -> str:
+    """
+    Path of the optimized graph of a model in ORT_CACHE_DIR.
+
+    Optimized graphs can contain provider and hardware specific nodes, so the path depends on the
+    model content, the onnxruntime version, the provider, the optimization level and the machine.
+    """
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    key = "-".join(
+        [
+            name,
+            get_model_sha1(model_path)[:16],
+            f"ort{onnxruntime.__version__}",
+            provider,
+            optimization_level,
+            platform.machine(),
+        ]
+    )
+    return os.path.join(ORT_CACHE_DIR, f"{key}.onnx")
+
+
+def get_session_options(kind: str) -> onnxruntime.SessionOptions:
+    """
+    Build the onnxruntime session options of a kind of model from the settings.
+
+    Args:
+        kind (str): ANALYSIS_SESSION or SWAP_SESSION
+
+    Returns:
+        onnxruntime.SessionOptions: The options (without optimized_model_filepath)
+    """
+    options = onnxruntime.SessionOptions()
+    level = get_sd_option("faceswaplab_ort_optimization_level", "all")
+    options.graph_optimization_level = OPTIMIZATION_LEVELS.get(
+        level, onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    )
+    options.intra_op_num_threads = int(
+        get_sd_option(f"faceswaplab_ort_{kind}_intra_op_threads", 0)
+    )
+    options.inter_op_num_threads = int(
+        get_sd_option(f"faceswaplab_ort_{kind}_inter_op_threads", 0)
+    )
+    options.execution_mode = EXECUTION_MODES.get(
+        get_sd_option(f"faceswaplab_ort_{kind}_execution_mode", "sequential"),
+        onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+    )
+    return options
+
+
+def create_session(
+    model_path: str, providers: List[str], kind: str
+) -> onnxruntime.InferenceSession:
+    """
+    Create an onnxruntime session for a model with the configured session options.
+
+    When faceswaplab_ort_cache is enabled, the graph optimized by onnxruntime is saved in
+    ORT_CACHE_DIR and loaded (without optimizing it again) on the next starts. If the cached graph
+    cannot be loaded, it is removed and the original model is used.
+
+    Args:
+        model_path (str): The onnx model
+        providers (List[str]): The onnxruntime providers
+        kind (str): ANALYSIS_SESSION or SWAP_SESSION, selects the thread and execution settings
+
+    Returns:
+        onnxruntime.InferenceSession: The session
+    """
+    options = get_session_options(kind)
+    level = get_sd_option("faceswaplab_ort_optimization_level", "all")
+    optimized_path: Optional[str] = None
+    if get_sd_option("faceswaplab_ort_cache", False) and level != "disabled":
+        optimized_path = get_optimized_model_path(model_path, providers[0], level)
+
+    if optimized_path and os.path.exists(optimized_path):
+        try:
+            # The cached graph is already optimized
+            options.graph_optimization_level = (
+                onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+            )
+            session = onnxruntime.InferenceSession(
+                optimized_path, sess_options=options, providers=providers
+            )
+            logger.info("Load optimized model %s", optimized_path)
+            return session
+        except Exception as e:
+            logger.warning(
+                "Failed to load optimized model %s, remove it : %s", optimized_path, e
+            )
+            os.remove(optimized_path)
+            options = get_session_options(kind)
+
+    if optimized_path:
+        os.makedirs(ORT_CACHE_DIR, exist_ok=True)
+        options.optimized_model_filepath = optimized_path
+        logger.info("Save optimized model to %s", optimized_path)
+    return onnxruntime.InferenceSession(
+        model_path, sess_options=options, providers=providers
+    )
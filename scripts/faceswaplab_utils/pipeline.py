@@ -0,0 +1,321 @@
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sized,
+    Tuple,
+)
+
+from scripts.faceswaplab_utils.faceswaplab_logging import logger
+
+# Sent through the queues once the items are exhausted
+_DONE = object()
+
+
+class _FeedError:
+    """
+    Sent through the queues (before _DONE) when reading the items failed.
+    """
+
+    def __init__(self, error: Exception) -> None:
+        self.error = error
+
+
+@dataclass
+class Stage:
+    name: str
+    # Process the value of an item and return the value passed to the next stage
+    func: Callable[[Any], Any]
+    workers: int = 1
+    # func returns an iterable, each of its values goes to the next stages as a separate result
+    # of the same item (a pipeline can have one expanding stage)
+    expand: bool = False
+
+
+@dataclass
+class PipelineResult:
+    index: int
+    value: Any = None
+    # Exception raised by the first failing stage, the next stages are skipped
+    error: Optional[Exception] = None
+    # Position among the results of an item expanded by a stage, and whether it is the last one
+    part: int = 0
+    last: bool = True
+    # The expanding stage produced no value for this item, the next stages are skipped
+    empty: bool = False
+
+    @property
+    def done(self) -> bool:
+        return self.error is not None or self.empty
+
+
+class _StageStats:
+    def __init__(self, workers: int) -> None:
+        self.workers = workers
+        self.busy = 0.0
+        self.items = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+
+class Pipeline:
+    """
+    Run items through a sequence of stages, each stage on its own threads, connected by bounded
+    queues.
+
+    While one item is processed by a stage, the next ones are processed by the previous stages, so
+    that decoding, inference and encoding overlap. The queues hold at most queue_size items
+    between two stages, which bounds the memory used whatever the number of items. Results are
+    yielded in the order of the items, each with its value or the error of the stage that failed.
+    An expanding stage turns an item into several results, yielded in the order they are produced.
+    If reading the items fails, the error is raised by run once the items read before are yielded.
+    """
+
+    def __init__(self, name: str, stages: List[Stage], queue_size: int = 2) -> None:
+        """
+        Args:
+            name (str): The name of the pipeline (used in logs).
+            stages (List[Stage]): The stages, in processing order.
+            queue_size (int, optional): Max items waiting between two stages. Defaults to 2.
+        """
+        assert len([stage for stage in stages if stage.expand]) <= 1
+        self.name = name
+        self.stages = stages
+        self.queue_size = max(queue_size, 1)
+        self._stats: Dict[str, _StageStats] = {}
+        self._seconds = 0.0
+
+    def _process(self, stage: Stage, result: PipelineResult) -> None:
+        stats = self._stats[stage.name]
+        start = time.perf_counter()
+        try:
+            result.value = stage.func(result.value)
+        except Exception as e:
+            result.error = e
+            with stats.lock:
+                stats.errors += 1
+        finally:
+            with stats.lock:
+                stats.busy += time.perf_counter() - start
+                stats.items += 1
+
+    def _expand(
+        self, stage: Stage, result: PipelineResult
+    ) -> Generator[PipelineResult, None, None]:
+        """
+        Results of an item through an expanding stage. Values are produced lazily, only the
+        current one is held to flag the last one.
+        """
+        stats = self._stats[stage.name]
+        values: Optional[Iterator[Any]] = None
+        held: Optional[PipelineResult] = None
+        error: Optional[PipelineResult] = None
+        part = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                if values is None:
+                    values = iter(stage.func(result.value))
+                value = next(values)
+            except StopIteration:
+                break
+            except Exception as e:
+                error = PipelineResult(index=result.index, error=e, part=part)
+                with stats.lock:
+                    stats.errors += 1
+                break
+            finally:
+                with stats.lock:
+                    stats.busy += time.perf_counter() - start
+            if held is not None:
+                yield held
+            held = PipelineResult(
+                index=result.index, value=value, part=part, last=False
+            )
+            part += 1
+        with stats.lock:
+            stats.items += 1
+
+        if held is not None:
+            held.last = error is None
+            yield held
+        if error is not None:
+            yield error
+        elif held is None:
+            yield PipelineResult(index=result.index, empty=True)
+
+    def _run_inline(
+        self, result: PipelineResult, stages: List[Stage]
+    ) -> Generator[PipelineResult, None, None]:
+        for i, stage in enumerate(stages):
+            if result.done:
+                break
+            if stage.expand:
+                for part in self._expand(stage, result):
+                    yield from self._run_inline(part, stages[i + 1 :])
+                return
+            self._process(stage, result)
+        yield result
+
+    def run(self, items: Iterable[Any]) -> Generator[PipelineResult, None, None]:
+        """
+        Process the items, yield their results in order as soon as they are available.
+
+        A single item is processed in the calling thread. Closing the generator stops the stages
+        (the items being processed are finished).
+        """
+        self._stats = {
+            stage.name: _StageStats(max(stage.workers, 1)) for stage in self.stages
+        }
+        start = time.perf_counter()
+        try:
+            if isinstance(items, Sized) and len(items) <= 1:
+                for i, item in enumerate(items):
+                    yield from self._run_inline(
+                        PipelineResult(index=i, value=item), self.stages
+                    )
+            else:
+                yield from self._run_threaded(items)
+        finally:
+            self._seconds = time.perf_counter() - start
+            logger.info("%s pipeline : %s", self.name, self.stats())
+
+    def _run_threaded(
+        self, items: Iterable[Any]
+    ) -> Generator[PipelineResult, None, None]:
+        stopped = threading.Event()
+        queues: List["queue.Queue[Any]"] = [
+            queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)
+        ]
+
+        def put(q: "queue.Queue[Any]", entry: Any) -> bool:
+            while not stopped.is_set():
+                try:
+                    q.put(entry, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def get(q: "queue.Queue[Any]") -> Any:
+            while not stopped.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            return _DONE
+
+        def feed() -> None:
+            try:
+                for i, item in enumerate(items):
+                    if not put(queues[0], PipelineResult(index=i, value=item)):
+                        return
+            except Exception as e:
+                logger.error("%s pipeline : failed to read items : %s", self.name, e)
+                put(queues[0], _FeedError(e))
+            put(queues[0], _DONE)
+
+        def work(
+            stage: Stage,
+            inbox: "queue.Queue[Any]",
+            outbox: "queue.Queue[Any]",
+            running: List[int],
+            lock: threading.Lock,
+        ) -> None:
+            try:
+                while True:
+                    entry = get(inbox)
+                    if entry is _DONE:
+                        # Let the other workers of the stage see it
+                        put(inbox, _DONE)
+                        return
+                    if isinstance(entry, _FeedError):
+                        if not put(outbox, entry):
+                            return
+                        continue
+                    if stage.expand and not entry.done:
+                        for part in self._expand(stage, entry):
+                            if not put(outbox, part):
+                                return
+                        continue
+                    if not entry.done:
+                        self._process(stage, entry)
+                    if not put(outbox, entry):
+                        return
+            finally:
+                with lock:
+                    running[0] -= 1
+                    last = running[0] == 0
+                if last:
+                    put(outbox, _DONE)
+
+        threads = [threading.Thread(target=feed, daemon=True)]
+        for i, stage in enumerate(self.stages):
+            workers = max(stage.workers, 1)
+            running, lock = [workers], threading.Lock()
+            for w in range(workers):
+                threads.append(
+                    threading.Thread(
+                        target=work,
+                        args=(stage, queues[i], queues[i + 1], running, lock),
+                        name=f"faceswaplab_{self.name}_{stage.name}_{w}",
+                        daemon=True,
+                    )
+                )
+        for thread in threads:
+            thread.start()
+
+        try:
+            # Results completed out of order (stages with several workers)
+            pending: Dict[Tuple[int, int], PipelineResult] = {}
+            next_key = (0, 0)
+            feed_error: Optional[Exception] = None
+            while True:
+                entry = get(queues[-1])
+                if entry is _DONE:
+                    break
+                if isinstance(entry, _FeedError):
+                    # Raised once the items read before the error are yielded
+                    feed_error = entry.error
+                    continue
+                pending[(entry.index, entry.part)] = entry
+                while next_key in pending:
+                    result = pending.pop(next_key)
+                    yield result
+                    next_key = (
+                        (result.index + 1, 0)
+                        if result.last
+                        else (result.index, result.part + 1)
+                    )
+            if feed_error is not None:
+                raise feed_error
+        finally:
+            stopped.set()
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Utilisation of each stage (busy time of its workers / (duration * workers)) of the last run.
+
+        A stage close to 1 is the bottleneck, giving it more workers (if it can run in parallel)
+        speeds up the pipeline.
+        """
+        stats: Dict[str, float] = {"seconds": self._seconds}
+        for name, stage_stats in self._stats.items():
+            with stage_stats.lock:
+                stats[f"{name}_items"] = stage_stats.items
+                stats[f"{name}_errors"] = stage_stats.errors
+                stats[f"{name}_utilisation"] = (
+                    stage_stats.busy / (self._seconds * stage_stats.workers)
+                    if self._seconds
+                    else 0.0
+                )
+        return stats
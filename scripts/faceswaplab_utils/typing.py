@@ -1,4 +1,4 @@
-from typing import Tuple
+from typing import Tuple, Union
 from numpy import uint8
 from insightface.app.common import Face as IFace
 from PIL import Image
@@ -9,6 +9,8 @@ PILImage = Image.Image
 CV2ImgU8 = np.ndarray[int, np.dtype[uint8]]
 Face = IFace
 BoxCoords = Tuple[int, int, int, int]
+# A PIL image, or a BGR array (images decoded by OpenCV, see imgutils.bytes_to_cv2)
+AnyImage = Union[PILImage, CV2ImgU8]
 
 
 class Gender(Enum):
@@ -2,7 +2,9 @@ from typing import List
 import pytest
 import requests
 import sys
+import io
 import tempfile
+import time
 import safetensors
 
 sys.path.append(".")
@@ -20,6 +22,14 @@ from client_api.api_utils import (
     FaceSwapExtractRequest,
     FaceSwapCompareRequest,
     FaceSwapExtractResponse,
+    FaceSwapBatchRequest,
+    FaceSwapBatchResponse,
+    FaceSwapBatchStreamResult,
+    FaceSwapExtractStreamResult,
+    FaceSwapJob,
+    FaceSwapJobStatus,
+    ImageEncoding,
+    ImageFormat,
     compare_faces,
     base64_to_pil,
     base64_to_safetensors,
@@ -81,6 +91,22 @@ def test_version() -> None:
     assert "version" in response.json()
 
 
+def test_ready() -> None:
+    response = requests.get(f"{base_url}/faceswaplab/ready")
+    assert response.status_code in (200, 503)
+    assert response.json()["status"] in ("disabled", "loading", "ready", "failed")
+
+
+def test_stats() -> None:
+    response = requests.get(f"{base_url}/faceswaplab/stats")
+    assert response.status_code == 200
+    assert "admitted" in response.json()["executor"]
+    for cache in ["detection", "source_faces", "checkpoints", "nsfw"]:
+        assert cache in response.json()
+        for key in ["hits", "misses", "entries", "bytes"]:
+            assert key in response.json()[cache]
+
+
 def test_compare() -> None:
     request = FaceSwapCompareRequest(
         image1=pil_to_base64("references/man.png"),
@@ -166,6 +192,167 @@ def test_faceswap(face_swap_request: FaceSwapRequest) -> None:
     assert similarity > 0.50
 
 
+def test_faceswap_output_encoding(face_swap_request: FaceSwapRequest) -> None:
+    face_swap_request.output = ImageEncoding(format=ImageFormat.JPEG, quality=80)
+    response = requests.post(
+        f"{base_url}/faceswaplab/swap_face",
+        data=face_swap_request.json(),
+        headers={"Content-Type": "application/json; charset=utf-8"},
+    )
+    assert response.status_code == 200
+    res = FaceSwapResponse.parse_obj(response.json())
+    assert res.pil_images[0].format == "JPEG"
+
+
+def test_faceswap_binary(face_swap_request: FaceSwapRequest) -> None:
+    request = FaceSwapRequest(
+        units=face_swap_request.units,
+        output=ImageEncoding(format=ImageFormat.WEBP, lossless=True),
+    )
+    with open("tests/test_image.png", "rb") as image, open(
+        "references/man.png", "rb"
+    ) as source:
+        response = requests.post(
+            f"{base_url}/faceswaplab/swap_face/binary",
+            files=[("image", image), ("sources", source)],
+            data={"request": request.json()},
+        )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/webp"
+    result = Image.open(io.BytesIO(response.content))
+    assert result.size == Image.open("tests/test_image.png").size
+
+
+def test_compare_binary() -> None:
+    with open("references/man.png", "rb") as image1, open(
+        "references/man.png", "rb"
+    ) as image2:
+        response = requests.post(
+            f"{base_url}/faceswaplab/compare/binary",
+            files=[("image1", image1), ("image2", image2)],
+        )
+    assert response.status_code == 200
+    assert float(response.text) > 0.90
+
+
+def test_extract_binary() -> None:
+    with open("tests/test_image.png", "rb") as image:
+        response = requests.post(
+            f"{base_url}/faceswaplab/extract/binary",
+            files=[("images", image)],
+        )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("multipart/mixed")
+
+
+def test_faceswap_batch(face_swap_request: FaceSwapRequest) -> None:
+    request = FaceSwapBatchRequest(
+        images=[face_swap_request.image, "invalid", face_swap_request.image],
+        units=face_swap_request.units,
+    )
+    response = requests.post(
+        f"{base_url}/faceswaplab/swap_faces",
+        data=request.json(),
+        headers={"Content-Type": "application/json; charset=utf-8"},
+    )
+    assert response.status_code == 200
+    res = FaceSwapBatchResponse.parse_obj(response.json())
+    assert len(res.results) == 3
+    assert res.results[0].error is None and len(res.results[0].pil_images) == 1
+    assert res.results[1].error is not None
+    assert res.results[2].error is None and len(res.results[2].pil_images) == 1
+
+    pipeline = requests.get(f"{base_url}/faceswaplab/stats").json()["batch_pipeline"]
+    assert pipeline["decode_items"] == 3
+    assert pipeline["decode_errors"] == 1
+    assert 0 < pipeline["swap_utilisation"] <= 1
+
+
+def test_faceswap_batch_stream(face_swap_request: FaceSwapRequest) -> None:
+    request = FaceSwapBatchRequest(
+        images=[face_swap_request.image, "invalid", face_swap_request.image],
+        units=face_swap_request.units,
+    )
+    with requests.post(
+        f"{base_url}/faceswaplab/swap_faces/stream",
+        data=request.json(),
+        headers={"Content-Type": "application/json; charset=utf-8"},
+        stream=True,
+    ) as response:
+        assert response.status_code == 200
+        assert response.headers["Content-Type"].startswith("application/x-ndjson")
+        results = [
+            FaceSwapBatchStreamResult.parse_raw(line)
+            for line in response.iter_lines()
+            if line
+        ]
+    assert [result.index for result in results] == [0, 1, 2]
+    assert results[0].error is None and len(results[0].pil_images) == 1
+    assert results[1].error is not None
+    assert results[2].error is None and len(results[2].pil_images) == 1
+
+
+def test_extract_stream() -> None:
+    request = FaceSwapExtractRequest(
+        images=[pil_to_base64("tests/test_image.png")], postprocessing=None
+    )
+    with requests.post(
+        f"{base_url}/faceswaplab/extract/stream",
+        data=request.json(),
+        headers={"Content-Type": "application/json; charset=utf-8"},
+        stream=True,
+    ) as response:
+        assert response.status_code == 200
+        results = [
+            FaceSwapExtractStreamResult.parse_raw(line)
+            for line in response.iter_lines()
+            if line
+        ]
+    assert len(results) == 2
+    assert all(result.index == 0 and result.error is None for result in results)
+    assert results[0].pil_image is not None
+
+
+def test_faceswap_job(face_swap_request: FaceSwapRequest) -> None:
+    response = requests.post(
+        f"{base_url}/faceswaplab/jobs",
+        data=face_swap_request.json(),
+        headers={"Content-Type": "application/json; charset=utf-8"},
+    )
+    assert response.status_code == 200
+    job = FaceSwapJob.parse_obj(response.json())
+    assert job.status == FaceSwapJobStatus.QUEUED
+
+    for _ in range(120):
+        job = FaceSwapJob.parse_obj(
+            requests.get(f"{base_url}/faceswaplab/jobs/{job.id}").json()
+        )
+        if job.status not in (FaceSwapJobStatus.QUEUED, FaceSwapJobStatus.RUNNING):
+            break
+        time.sleep(1)
+    assert job.status == FaceSwapJobStatus.DONE
+    assert job.progress == 1
+
+    response = requests.get(f"{base_url}/faceswaplab/jobs/{job.id}/result")
+    assert response.status_code == 200
+    res = FaceSwapResponse.parse_obj(response.json())
+    assert len(res.pil_images) == 1
+
+
+def test_faceswap_job_cancel(face_swap_request: FaceSwapRequest) -> None:
+    response = requests.post(
+        f"{base_url}/faceswaplab/jobs",
+        data=face_swap_request.json(),
+        headers={"Content-Type": "application/json; charset=utf-8"},
+    )
+    job_id = response.json()["id"]
+    response = requests.delete(f"{base_url}/faceswaplab/jobs/{job_id}")
+    assert response.status_code == 200
+    assert response.json()["status"] in ("cancelled", "running", "done")
+
+    assert requests.get(f"{base_url}/faceswaplab/jobs/unknown").status_code == 404
+
+
 def test_faceswap_inpainting(face_swap_request: FaceSwapRequest) -> None:
     face_swap_request.units[0].pre_inpainting = InpaintingOptions(
         inpainting_denoising_strengh=0.4,
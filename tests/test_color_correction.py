@@ -0,0 +1,78 @@
+import sys
+from typing import Tuple
+
+import cv2
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.append(".")
+
+pytest.importorskip("modules.shared", reason="requires the webui modules")
+exposure = pytest.importorskip("skimage.exposure", reason="requires scikit-image")
+
+from scripts.faceswaplab_postprocessing import color_correction
+from scripts.faceswaplab_postprocessing.color_correction import (
+    HISTOGRAM,
+    MEAN_STD,
+    apply_color_correction,
+    setup_color_correction,
+)
+from scripts.faceswaplab_utils.typing import CV2ImgU8
+
+
+def webui_color_correction(target: np.ndarray, face: np.ndarray) -> np.ndarray:  # type: ignore
+    """
+    webui processing.setup_color_correction + apply_color_correction, on BGR images.
+    """
+    blend = pytest.importorskip("blendmodes.blend", reason="requires blendmodes")
+    correction = cv2.cvtColor(
+        cv2.cvtColor(target, cv2.COLOR_BGR2RGB), cv2.COLOR_RGB2LAB
+    )
+    original = Image.fromarray(cv2.cvtColor(face, cv2.COLOR_BGR2RGB))
+    matched = exposure.match_histograms(
+        cv2.cvtColor(np.asarray(original), cv2.COLOR_RGB2LAB),
+        correction,
+        channel_axis=2,
+    )
+    image = Image.fromarray(cv2.cvtColor(matched, cv2.COLOR_LAB2RGB).astype("uint8"))
+    image = blend.blendLayers(image, original, blend.BlendType.LUMINOSITY)
+    return cv2.cvtColor(np.asarray(image.convert("RGB")), cv2.COLOR_RGB2BGR)
+
+
+@pytest.fixture
+def crops() -> Tuple[CV2ImgU8, CV2ImgU8]:
+    """
+    A target crop and a face crop (twice larger, as an upscaled face) with a red cast.
+    """
+    img = cv2.imread("tests/test_image.png")
+    h, w = img.shape[:2]
+    target = img[: h // 2, : w // 2].copy()
+    face = cv2.resize(img[h // 2 :, w // 2 :], (w, h))
+    face[:, :, 2] = np.clip(face[:, :, 2].astype(int) + 40, 0, 255)
+    return target, face
+
+
+def test_histogram_matches_skimage(crops: Tuple[CV2ImgU8, CV2ImgU8]) -> None:
+    target, face = crops
+    corrected = apply_color_correction(setup_color_correction(target, HISTOGRAM), face)
+
+    target_lab = cv2.cvtColor(target, cv2.COLOR_BGR2LAB)
+    face_lab = cv2.cvtColor(face, cv2.COLOR_BGR2LAB)
+    expected = face_lab.copy()
+    for c in color_correction.COLOR_CHANNELS:
+        matched = exposure.match_histograms(face_lab[:, :, c], target_lab[:, :, c])
+        expected[:, :, c] = np.rint(matched).astype(np.uint8)
+    assert np.array_equal(corrected, cv2.cvtColor(expected, cv2.COLOR_LAB2BGR))
+
+
+@pytest.mark.parametrize("method", [HISTOGRAM, MEAN_STD])
+def test_close_to_webui(crops: Tuple[CV2ImgU8, CV2ImgU8], method: str) -> None:
+    target, face = crops
+    expected = webui_color_correction(target, face).astype(int)
+    corrected = apply_color_correction(setup_color_correction(target, method), face)
+
+    error = np.abs(corrected.astype(int) - expected).mean()
+    uncorrected_error = np.abs(face.astype(int) - expected).mean()
+    assert error < 3
+    assert error < uncorrected_error / 4
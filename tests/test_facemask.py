@@ -0,0 +1,61 @@
+import sys
+from typing import Any
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.append(".")
+
+pytest.importorskip("torch", reason="requires torch")
+pytest.importorskip("modules.shared", reason="requires the webui modules")
+
+import torch
+
+from scripts.faceswaplab_swapping import facemask
+
+
+def loop_mask(labels: np.ndarray) -> np.ndarray:  # type: ignore
+    """
+    The mask of the original generate_face_mask : a float64 image filled class by class.
+    """
+    parse_mask = np.zeros(labels.shape)
+    for idx, color in enumerate(facemask.MASK_COLOR_MAP):
+        parse_mask[labels == idx] = color
+    return parse_mask
+
+
+def random_labels(shape: Any, seed: int = 0) -> np.ndarray:  # type: ignore
+    rng = np.random.default_rng(seed)
+    # Blocks of classes, like a parsing, so that resizing interpolates between regions
+    small = rng.integers(0, len(facemask.MASK_COLOR_MAP), (8, 8), dtype=np.uint8)
+    return cv2.resize(small, shape[::-1], interpolation=cv2.INTER_NEAREST)
+
+
+def test_lut_matches_loop() -> None:
+    labels = random_labels((64, 64))
+    assert np.array_equal(facemask.MASK_LUT[labels], loop_mask(labels))
+
+
+@pytest.mark.parametrize("image_size", [(128, 128), (512, 512), (300, 200)])
+def test_generate_face_masks_matches_loop(monkeypatch, image_size) -> None:  # type: ignore
+    parsing_size = 64
+    labels = [random_labels((parsing_size, parsing_size), seed) for seed in range(3)]
+    monkeypatch.setattr(facemask, "get_sd_option", lambda name, default=None: default)
+    monkeypatch.setattr(
+        facemask, "parse_faces_torch", lambda batch, device, half: np.stack(labels)
+    )
+    images = [np.zeros(image_size + (3,), dtype=np.uint8) for _ in labels]
+
+    masks = facemask.generate_face_masks(
+        images, torch.device("cpu"), size=parsing_size, half=False
+    )
+
+    for image, mask, image_labels in zip(images, masks, labels):
+        expected = cv2.resize(
+            loop_mask(image_labels), (image.shape[1], image.shape[0])
+        ).astype(np.uint8)
+        assert mask.dtype == np.uint8
+        assert mask.shape == image.shape[:2]
+        # uint8 resizing rounds the interpolated borders, the float mask was truncated
+        assert np.abs(mask.astype(int) - expected).max() <= 1
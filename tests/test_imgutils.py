@@ -0,0 +1,57 @@
+import base64
+import io
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.append(".")
+
+pytest.importorskip("modules.processing", reason="requires the webui modules")
+
+from scripts.faceswaplab_utils.imgutils import (
+    base64_to_pil,
+    bytes_to_cv2,
+    crop_cv2,
+    pil_to_cv2,
+)
+
+
+def rotated_jpeg() -> bytes:
+    """
+    A 64x32 jpeg (left half red) whose EXIF orientation asks for a 90° rotation.
+    """
+    image = Image.new("RGB", (64, 32))
+    image.paste((255, 0, 0), (0, 0, 32, 32))
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", exif=exif, quality=95)
+    return buffer.getvalue()
+
+
+def test_bytes_to_cv2_ignores_exif_orientation() -> None:
+    data = rotated_jpeg()
+    img = bytes_to_cv2(data)
+    assert img.shape == (32, 64, 3)
+
+    # Same pixels as the base64 path
+    pil_img = base64_to_pil(base64.b64encode(data).decode())
+    assert pil_img is not None
+    assert np.abs(pil_to_cv2(pil_img).astype(int) - img).max() <= 2
+
+
+def test_bytes_to_cv2_invalid() -> None:
+    with pytest.raises(ValueError):
+        bytes_to_cv2(b"not an image")
+
+
+@pytest.mark.parametrize(
+    "box",
+    [(10, 10, 20, 30), (-10, -5, 30, 20), (60, 40, 90, 80), (-5, -5, 80, 60)],
+)
+def test_crop_cv2_matches_pil_crop(box) -> None:  # type: ignore
+    img = np.random.default_rng(0).integers(0, 255, (50, 70, 3), dtype=np.uint8)
+    expected = np.array(Image.fromarray(img).crop(box))
+    assert np.array_equal(crop_cv2(img, box), expected)
@@ -0,0 +1,116 @@
+import sys
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+import pytest
+
+sys.path.append(".")
+
+pytest.importorskip("modules.shared", reason="requires the webui modules")
+
+from scripts.faceswaplab_utils import nsfw
+from scripts.faceswaplab_utils.cache_utils import image_hash
+from scripts.faceswaplab_utils.typing import CV2ImgU8
+
+
+class FakeSession:
+    """
+    Stands for the ifnude onnxruntime session : one detection per image, scored by is_nsfw on the
+    preprocessed blob.
+    """
+
+    def __init__(self, is_nsfw: Callable[[np.ndarray], bool]) -> None:  # type: ignore
+        self.is_nsfw = is_nsfw
+        self.runs: List[Any] = []
+
+    def get_inputs(self) -> List[SimpleNamespace]:
+        return [SimpleNamespace(name="input", shape=["N", "H", "W", 3])]
+
+    def get_outputs(self) -> List[SimpleNamespace]:
+        return [SimpleNamespace(name="scores"), SimpleNamespace(name="labels")]
+
+    def run(self, names: List[str], feed: Dict[str, np.ndarray]) -> List[np.ndarray]:  # type: ignore
+        batch = feed["input"]
+        self.runs.append(batch.shape)
+        scores = [[0.9 if self.is_nsfw(blob) else 0.1] for blob in batch]
+        return [
+            np.array(scores, dtype=np.float32),
+            np.zeros((len(batch), 1), dtype=np.int32),
+        ]
+
+
+@pytest.fixture
+def detector(monkeypatch: pytest.MonkeyPatch) -> Callable[..., FakeSession]:
+    """
+    Install a fake detector and the given options, with an empty verdict cache.
+    """
+
+    def install(
+        is_nsfw: Callable[[np.ndarray], bool], **options: Any  # type: ignore
+    ) -> FakeSession:
+        session = FakeSession(is_nsfw)
+        monkeypatch.setattr(
+            nsfw, "get_nsfw_detector", lambda: (session, ["EXPOSED_BREAST_F"])
+        )
+        monkeypatch.setattr(
+            nsfw,
+            "get_sd_option",
+            lambda name, default=None: options.get(name, default),
+        )
+        nsfw.NSFW_CACHE.clear()
+        return session
+
+    return install
+
+
+def bright(blob: np.ndarray) -> bool:  # type: ignore
+    return bool((blob + nsfw.CAFFE_MEAN).mean() > 128)
+
+
+def image(value: int, shape: Any = (100, 100)) -> CV2ImgU8:
+    return np.full(shape + (3,), value, dtype=np.uint8)
+
+
+def test_batches_by_shape_and_caches(detector: Callable[..., FakeSession]) -> None:
+    session = detector(bright)
+    images = [image(10), image(200), image(220, (100, 150)), image(10), image(20)]
+
+    assert nsfw.check_against_nsfw_batch(images) == [False, True, True, False, False]
+    # One inference per input shape, the duplicated image is checked once
+    assert sorted(shape[0] for shape in session.runs) == [1, 3]
+    assert all(shape[1] == 480 for shape in session.runs)
+
+    verdicts = nsfw.check_against_nsfw_batch(images[::-1])
+    assert verdicts == [False, False, True, True, False]
+    assert nsfw.check_against_nsfw(images[1])
+    assert len(session.runs) == 2
+
+
+def test_threshold_disables_the_check(detector: Callable[..., FakeSession]) -> None:
+    session = detector(bright, faceswaplab_nsfw_threshold=1)
+    assert nsfw.check_against_nsfw_batch([image(200), image(10)]) == [False, False]
+    assert session.runs == []
+
+
+def test_validate_uses_the_full_size_verdict(
+    detector: Callable[..., FakeSession]
+) -> None:
+    # Only visible at full size
+    def full_size(blob: np.ndarray) -> bool:  # type: ignore
+        return blob.shape[0] >= nsfw.FULL_SIZE_MIN_SIDE
+
+    img = image(10)
+    session = detector(full_size, faceswaplab_nsfw_size=240)
+    assert nsfw.check_against_nsfw_batch([img]) == [False]
+    assert [shape[1] for shape in session.runs] == [240]
+
+    session = detector(
+        full_size, faceswaplab_nsfw_size=240, faceswaplab_nsfw_validate=True
+    )
+    assert nsfw.check_against_nsfw_batch([img]) == [True]
+    assert [shape[1] for shape in session.runs] == [240, nsfw.FULL_SIZE_MIN_SIDE]
+    # Verdicts are cached per size, threshold and validation
+    key = (image_hash(img), 240, 0.7, True)
+    assert nsfw.NSFW_CACHE.get(key) is True
+    assert nsfw.NSFW_CACHE.get(key[:3] + (False,)) is None
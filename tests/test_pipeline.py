@@ -0,0 +1,97 @@
+import sys
+import time
+from typing import Iterator, List
+
+import pytest
+
+sys.path.append(".")
+
+pytest.importorskip("modules.shared", reason="requires the webui modules")
+
+from scripts.faceswaplab_utils.pipeline import Pipeline, Stage
+
+
+def slow_double(value: int) -> int:
+    # Later items finish first, to check that results are reordered
+    time.sleep(0.01 * (5 - value % 5))
+    return value * 2
+
+
+def fail_on_three(value: int) -> int:
+    if value == 3:
+        raise ValueError("three")
+    return value
+
+
+def test_results_in_order() -> None:
+    pipeline = Pipeline(
+        "test",
+        [Stage("double", slow_double, workers=3), Stage("inc", lambda v: v + 1)],
+    )
+    results = list(pipeline.run(range(10)))
+    assert [result.index for result in results] == list(range(10))
+    assert [result.value for result in results] == [v * 2 + 1 for v in range(10)]
+    stats = pipeline.stats()
+    assert stats["double_items"] == 10
+    assert stats["inc_items"] == 10
+
+
+def test_single_item_inline() -> None:
+    pipeline = Pipeline("test", [Stage("double", slow_double)])
+    assert [result.value for result in pipeline.run([4])] == [8]
+
+
+def test_stage_error_skips_next_stages() -> None:
+    calls: List[int] = []
+
+    def record(value: int) -> int:
+        calls.append(value)
+        return value
+
+    pipeline = Pipeline(
+        "test", [Stage("fail", fail_on_three, workers=2), Stage("record", record)]
+    )
+    results = list(pipeline.run(range(5)))
+    assert [result.index for result in results] == list(range(5))
+    assert isinstance(results[3].error, ValueError)
+    assert 3 not in calls
+    assert [result.value for result in results if result.error is None] == [
+        0,
+        1,
+        2,
+        4,
+    ]
+    assert pipeline.stats()["fail_errors"] == 1
+
+
+def test_expanding_stage() -> None:
+    pipeline = Pipeline(
+        "test",
+        [
+            Stage("expand", lambda v: range(v), expand=True),
+            Stage("double", slow_double, workers=2),
+        ],
+    )
+    results = list(pipeline.run([2, 0, 3]))
+    assert [(r.index, r.part, r.last, r.empty) for r in results] == [
+        (0, 0, False, False),
+        (0, 1, True, False),
+        (1, 0, True, True),
+        (2, 0, False, False),
+        (2, 1, False, False),
+        (2, 2, True, False),
+    ]
+    assert [r.value for r in results if not r.empty] == [0, 2, 0, 2, 4]
+
+
+def test_feed_error_raised_after_read_items() -> None:
+    def items() -> Iterator[int]:
+        yield from range(4)
+        raise OSError("unreadable")
+
+    pipeline = Pipeline("test", [Stage("double", slow_double, workers=3)])
+    values: List[int] = []
+    with pytest.raises(OSError, match="unreadable"):
+        for result in pipeline.run(items()):
+            values.append(result.value)
+    assert values == [0, 2, 4, 6]
@@ -0,0 +1,61 @@
+import sys
+from types import SimpleNamespace
+from typing import Any, List
+
+import numpy as np
+import pytest
+
+sys.path.append(".")
+
+pytest.importorskip("insightface", reason="requires insightface")
+pytest.importorskip("modules.shared", reason="requires the webui modules")
+
+from insightface.app.common import Face
+
+from scripts.faceswaplab_swapping import swapper
+
+
+def make_unit(**kwargs: Any) -> SimpleNamespace:
+    no_inpainting = SimpleNamespace(inpainting_denoising_strengh=0)
+    options = dict(
+        enable=True,
+        blend_faces=False,
+        faces=[Face(gender=0), Face(gender=0)],
+        reference_face=None,
+        compute_similarity=False,
+        pre_inpainting=no_inpainting,
+        post_inpainting=no_inpainting,
+        faces_index={0},
+        same_gender=False,
+        sort_by_size=False,
+        swapping_options=None,
+    )
+    options.update(kwargs)
+    return SimpleNamespace(**options)
+
+
+def test_rejected_image_goes_through_no_unit(monkeypatch: pytest.MonkeyPatch) -> None:
+    calls: List[str] = []
+
+    def record(name: str) -> Any:
+        def call(*args: Any, **kwargs: Any) -> Any:
+            calls.append(name)
+            raise AssertionError(f"{name} called on a rejected image")
+
+        return call
+
+    monkeypatch.setattr(swapper, "check_against_nsfw", lambda img: True)
+    for name in ["get_faces", "swap_face", "iter_swap_face_variants"]:
+        monkeypatch.setattr(swapper, name, record(name))
+    img = np.zeros((64, 64, 3), dtype=np.uint8)
+
+    results = list(
+        swapper.iter_process_images_units(
+            "inswapper_128.onnx", [make_unit(), make_unit()], [(img, "info")]  # type: ignore
+        )
+    )
+
+    assert calls == []
+    assert len(results) == 1
+    assert np.array_equal(np.asarray(results[0][0]), img[:, :, ::-1])
+    assert results[0][1] == "info"
@@ -0,0 +1,143 @@
+import sys
+from types import SimpleNamespace
+from typing import Any, Callable, List, Optional, Set
+
+import numpy as np
+import pytest
+
+sys.path.append(".")
+
+pytest.importorskip("insightface", reason="requires insightface")
+pytest.importorskip("modules.shared", reason="requires the webui modules")
+
+from insightface.app.common import Face
+from insightface.utils import face_align
+
+from scripts.faceswaplab_swapping import unit_planner
+from scripts.faceswaplab_swapping.upcaled_inswapper_options import InswappperOptions
+from scripts.faceswaplab_utils.typing import CV2ImgU8
+
+CROP_SIZE = 128
+
+Planner = Callable[[List[SimpleNamespace]], SimpleNamespace]
+
+
+def face_at(x: float, y: float, size: float = 100) -> Face:
+    kps = face_align.arcface_dst * size / 112 + np.array([x, y], dtype=np.float32)
+    bbox = np.array([x, y, x + size, y + size], dtype=np.float32)
+    return Face(kps=kps, bbox=bbox, gender=0)
+
+
+def make_unit(faces_index: Set[int], **kwargs: Any) -> SimpleNamespace:
+    no_inpainting = SimpleNamespace(inpainting_denoising_strengh=0)
+    options = dict(
+        enable=True,
+        blend_faces=True,
+        blended_faces=Face(gender=0),
+        compute_similarity=False,
+        pre_inpainting=no_inpainting,
+        post_inpainting=no_inpainting,
+        faces_index=faces_index,
+        same_gender=False,
+        sort_by_size=False,
+        swapping_options=None,
+    )
+    options.update(kwargs)
+    return SimpleNamespace(**options)
+
+
+class RecordingSwapper:
+    input_size = (CROP_SIZE, CROP_SIZE)
+
+    def __init__(self) -> None:
+        self.runs: List[List[Face]] = []
+
+    def get_multi(
+        self,
+        img: CV2ImgU8,
+        target_faces: List[Face],
+        source_faces: List[Face],
+        options: List[Optional[InswappperOptions]],
+    ) -> CV2ImgU8:
+        self.runs.append(list(target_faces))
+        return img
+
+
+@pytest.fixture
+def planner(monkeypatch: pytest.MonkeyPatch) -> Planner:
+    """
+    Run process_units_single_pass on three faces far apart, recording the swap inferences and the
+    redetections.
+    """
+    faces = [face_at(10, 10), face_at(250, 10), face_at(10, 250)]
+    face_swapper = RecordingSwapper()
+    redetections: List[List[Face]] = []
+
+    def update_faces_in_regions(
+        img: CV2ImgU8,
+        faces: List[Face],
+        swapped_faces: List[Face],
+        crop_size: int,
+        modules: Set[str],
+    ) -> List[Face]:
+        redetections.append(list(swapped_faces))
+        return faces
+
+    swapper = unit_planner.swapper
+    monkeypatch.setattr(swapper, "get_faces", lambda img, modules: list(faces))
+    monkeypatch.setattr(swapper, "getFaceSwapModel", lambda path, use_gpu: face_swapper)
+    monkeypatch.setattr(swapper, "is_cpu_provider", lambda: True)
+    monkeypatch.setattr(unit_planner, "get_unit_target_modules", lambda unit: set())
+    monkeypatch.setattr(
+        unit_planner, "update_faces_in_regions", update_faces_in_regions
+    )
+
+    def run(units: List[SimpleNamespace]) -> SimpleNamespace:
+        img = np.zeros((480, 640, 3), dtype=np.uint8)
+        unit_planner.process_units_single_pass(
+            "inswapper_128.onnx", units, img, "info", nsfw_checked=True  # type: ignore
+        )
+        return SimpleNamespace(
+            faces=faces, runs=face_swapper.runs, redetections=redetections
+        )
+
+    return run
+
+
+def test_can_plan_units() -> None:
+    units = [make_unit({0}), make_unit({1})]
+    assert unit_planner.can_plan_units(units, force_blend=False)  # type: ignore
+    assert not unit_planner.can_plan_units(units[:1], force_blend=False)  # type: ignore
+    inpainting = SimpleNamespace(inpainting_denoising_strengh=0.2)
+    for unit in [
+        make_unit({1}, compute_similarity=True),
+        make_unit({1}, post_inpainting=inpainting),
+        make_unit({1}, blend_faces=False),
+    ]:
+        assert not unit_planner.can_plan_units(
+            [units[0], unit], force_blend=False  # type: ignore
+        )
+    assert unit_planner.can_plan_units(
+        [units[0], make_unit({1}, blend_faces=False)], force_blend=True  # type: ignore
+    )
+
+
+def test_independent_units_share_one_inference(planner: Planner) -> None:
+    result = planner([make_unit({0}), make_unit({1}), make_unit({2})])
+    assert result.runs == [result.faces]
+    assert result.redetections == []
+
+
+def test_overlapping_unit_starts_a_new_group(planner: Planner) -> None:
+    result = planner([make_unit({0}), make_unit({1}), make_unit({0, 2})])
+    faces = result.faces
+    assert result.runs == [[faces[0], faces[1]], [faces[0], faces[2]]]
+    # Only the faces of the first group are detected again
+    assert result.redetections == [[faces[0], faces[1]]]
+
+
+def test_gender_filter_starts_a_new_group(planner: Planner) -> None:
+    result = planner([make_unit({0}), make_unit({1}, same_gender=True)])
+    faces = result.faces
+    assert result.runs == [[faces[0]], [faces[1]]]
+    assert result.redetections == [[faces[0]]]
@@ -0,0 +1,215 @@
+import sys
+from typing import Any, Dict, List, Tuple
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.append(".")
+
+pytest.importorskip("insightface", reason="requires insightface")
+pytest.importorskip("modules.shared", reason="requires the webui modules")
+
+from insightface.app.common import Face
+from insightface.utils import face_align
+
+from scripts.faceswaplab_swapping.upscaled_inswapper import (
+    UpscaledINSwapper,
+    group_overlapping_faces,
+    paste_back_in_roi,
+    warp_fixed_point_in_roi,
+    warp_uses_fixed_point,
+)
+
+CROP_SIZE = 128
+
+
+def paste_back_full_frame(
+    target_img: np.ndarray, bgr_fake: np.ndarray, M: np.ndarray, erosion_factor: float
+) -> np.ndarray:
+    """
+    The paste back of the original upscaled swapper : warp, erode, blur and blend on the whole
+    image.
+    """
+    size = (target_img.shape[1], target_img.shape[0])
+    IM = cv2.invertAffineTransform(M)
+    img_white = np.full(bgr_fake.shape[:2], 255, dtype=np.float32)
+    bgr_fake = cv2.warpAffine(bgr_fake, IM, size, borderValue=0.0)
+    img_mask = cv2.warpAffine(img_white, IM, size, borderValue=0.0)
+    img_mask[img_mask > 20] = 255
+    mask_h_inds, mask_w_inds = np.where(img_mask == 255)
+    mask_h = np.max(mask_h_inds) - np.min(mask_h_inds)
+    mask_w = np.max(mask_w_inds) - np.min(mask_w_inds)
+    mask_size = int(np.sqrt(mask_h * mask_w))
+    k = max(int(mask_size // 10 * erosion_factor), int(10 * erosion_factor))
+    img_mask = cv2.erode(img_mask, np.ones((k, k), np.uint8), iterations=1)
+    k = max(int(mask_size // 20 * erosion_factor), int(5 * erosion_factor))
+    img_mask = cv2.GaussianBlur(img_mask, (2 * k + 1, 2 * k + 1), 0)
+    img_mask /= 255
+    img_mask = img_mask[:, :, np.newaxis]
+    merged = img_mask * bgr_fake + (1 - img_mask) * target_img.astype(np.float32)
+    return merged.astype(np.uint8)
+
+
+def random_alignment(
+    rng: np.random.Generator, img_shape: Tuple[int, ...]
+) -> np.ndarray:
+    """
+    A random similarity transform image -> crop, for a face of 40 to 400 pixels anywhere on the
+    image (partly outside of it sometimes).
+    """
+    face_size = rng.uniform(40, 400)
+    scale = CROP_SIZE / face_size
+    angle = rng.uniform(-np.pi / 4, np.pi / 4)
+    center_x = rng.uniform(-0.2, 1.2) * img_shape[1]
+    center_y = rng.uniform(-0.2, 1.2) * img_shape[0]
+    cos, sin = scale * np.cos(angle), scale * np.sin(angle)
+    return np.array(
+        [
+            [cos, -sin, CROP_SIZE / 2 - cos * center_x + sin * center_y],
+            [sin, cos, CROP_SIZE / 2 - sin * center_x - cos * center_y],
+        ]
+    )
+
+
+@pytest.mark.parametrize("erosion_factor", [0.5, 1.0, 2.0])
+def test_paste_back_in_roi_matches_full_frame(erosion_factor: float) -> None:
+    # Exact with the fixed point warp of OpenCV 4, a few levels on the mask edge otherwise
+    tolerance = 0 if warp_uses_fixed_point() else 4
+    rng = np.random.default_rng(int(erosion_factor * 10))
+    for _ in range(20):
+        target = rng.integers(0, 256, (480, 640, 3), dtype=np.uint8)
+        fake = rng.integers(0, 256, (CROP_SIZE, CROP_SIZE, 3), dtype=np.uint8)
+        M = random_alignment(rng, target.shape)
+        corners = cv2.transform(
+            np.array([[[0, 0], [CROP_SIZE, CROP_SIZE]]], dtype=np.float64),
+            cv2.invertAffineTransform(M),
+        )[0]
+        if (
+            corners[:, 0].max() < 0
+            or corners[:, 1].max() < 0
+            or corners[:, 0].min() > target.shape[1]
+            or corners[:, 1].min() > target.shape[0]
+        ):
+            continue
+        expected = paste_back_full_frame(target, fake, M, erosion_factor)
+        result = paste_back_in_roi(target.copy(), fake, M, erosion_factor)
+        assert np.abs(result.astype(int) - expected).max() <= tolerance
+
+
+def test_warp_in_roi_matches_full_frame() -> None:
+    if not warp_uses_fixed_point():
+        pytest.skip("cv2.warpAffine samples with float coordinates")
+    rng = np.random.default_rng(0)
+    src = rng.integers(0, 256, (CROP_SIZE, CROP_SIZE, 3), dtype=np.uint8)
+    for _ in range(20):
+        IM = cv2.invertAffineTransform(random_alignment(rng, (480, 640)))
+        full = cv2.warpAffine(src, IM, (640, 480), borderValue=0.0)
+        x0, y0 = int(rng.integers(0, 320)), int(rng.integers(0, 240))
+        region = warp_fixed_point_in_roi(src, IM, (x0, y0, x0 + 200, y0 + 150))
+        assert np.array_equal(region, full[y0 : y0 + 150, x0 : x0 + 200])
+
+
+class FakeSession:
+    """
+    Stands for the swap model : the swapped face is the inverted input, shifted by the latent, so
+    that it depends on the pixels already pasted by the previous faces.
+    """
+
+    def get_inputs(self) -> List[Any]:
+        return [type("Input", (), {"shape": ["None", 3, CROP_SIZE, CROP_SIZE]})]
+
+    def run(self, output_names: List[str], feed: Dict[str, np.ndarray]) -> List[np.ndarray]:  # type: ignore
+        blob, latents = feed["target"], feed["source"]
+        return [np.clip(1 - blob + latents[:, :1, None, None], 0, 1)]
+
+
+def fake_swapper() -> UpscaledINSwapper:
+    swapper = UpscaledINSwapper.__new__(UpscaledINSwapper)
+    swapper.__dict__.update(
+        session=FakeSession(),
+        input_size=(CROP_SIZE, CROP_SIZE),
+        input_mean=0.0,
+        input_std=255.0,
+        input_names=["target", "source"],
+        output_names=["output"],
+        emap=np.eye(512, dtype=np.float32),
+    )
+    return swapper
+
+
+def face_at(x: float, y: float, size: float) -> Face:
+    kps = face_align.arcface_dst * size / 112 + np.array([x, y], dtype=np.float32)
+    return Face(kps=kps)
+
+
+def source_face(value: float) -> Face:
+    embedding = np.zeros(512, dtype=np.float32)
+    embedding[0] = value
+    embedding[1] = 1 - value
+    return Face(embedding=embedding)
+
+
+def test_group_overlapping_faces() -> None:
+    faces = [face_at(10, 10, 100), face_at(300, 10, 100), face_at(60, 40, 100)]
+    faces.append(face_at(90, 60, 100))
+    assert group_overlapping_faces(faces, CROP_SIZE, (480, 640, 3)) == [
+        [0, 1],
+        [2],
+        [3],
+    ]
+    assert group_overlapping_faces([], CROP_SIZE, (480, 640, 3)) == []
+
+
+@pytest.mark.parametrize(
+    "positions",
+    [
+        [(10, 10), (300, 10), (150, 250)],
+        [(10, 10), (60, 40), (300, 10), (90, 80)],
+    ],
+)
+def test_get_batch_matches_sequential_swaps(positions: List[Tuple[int, int]]) -> None:
+    swapper = fake_swapper()
+    img = np.random.default_rng(0).integers(0, 256, (480, 640, 3), dtype=np.uint8)
+    faces = [face_at(x, y, 120) for x, y in positions]
+    source = source_face(0.5)
+
+    expected = img
+    for face in faces:
+        expected = swapper.get(expected, face, source)
+    result = swapper.get_batch(img, faces, source)
+    assert np.array_equal(result, expected)
+
+
+def test_get_multi_sources_with_overlap() -> None:
+    swapper = fake_swapper()
+    img = np.random.default_rng(1).integers(0, 256, (480, 640, 3), dtype=np.uint8)
+    faces = [face_at(10, 10, 120), face_at(50, 30, 120), face_at(300, 200, 120)]
+    sources = [source_face(0.2), source_face(0.8), source_face(0.2)]
+
+    expected = img
+    for face, source in zip(faces, sources):
+        expected = swapper.get(expected, face, source)
+    result = swapper.get_multi(img.copy(), faces, sources, [None] * len(faces))
+    assert np.array_equal(result, expected)
+
+
+@pytest.mark.parametrize("batch_size", [1, 2, 8])
+def test_iter_variants_matches_sequential_swaps(batch_size: int) -> None:
+    swapper = fake_swapper()
+    img = np.random.default_rng(2).integers(0, 256, (480, 640, 3), dtype=np.uint8)
+    apart = [face_at(10, 10, 120), face_at(300, 200, 120)]
+    overlapping = [face_at(10, 10, 120), face_at(50, 30, 120), face_at(300, 200, 120)]
+    sources = [source_face(0.2), source_face(0.5), source_face(0.8)]
+    target_faces = [apart, overlapping, apart]
+
+    variants = list(
+        swapper.iter_variants(img, sources, target_faces, batch_size=batch_size)
+    )
+
+    assert len(variants) == len(sources)
+    for variant, source, faces in zip(variants, sources, target_faces):
+        expected = img
+        for face in faces:
+            expected = swapper.get(expected, face, source)
+        assert np.array_equal(variant, expected)
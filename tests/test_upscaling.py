@@ -0,0 +1,59 @@
+import sys
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.append(".")
+
+pytest.importorskip("modules.shared", reason="requires the webui modules")
+
+from scripts.faceswaplab_postprocessing.upscaling import (
+    restore_face,
+    restore_face_cv2,
+)
+
+
+class FakeRestorer:
+    """
+    Stands for a webui face restorer (RGB uint8 in and out), brightens the red channel.
+    """
+
+    def name(self) -> str:
+        return "Fake"
+
+    def restore(self, np_image: np.ndarray) -> np.ndarray:  # type: ignore
+        restored = np_image.astype(int)
+        restored[:, :, 0] = np.minimum(restored[:, :, 0] * 2 + 17, 255)
+        return restored.astype(np.uint8)
+
+
+def restorer_options(visibility: float) -> SimpleNamespace:
+    return SimpleNamespace(
+        face_restorer=FakeRestorer(),
+        face_restorer_name="Fake",
+        restorer_visibility=visibility,
+        codeformer_weight=1,
+    )
+
+
+@pytest.mark.parametrize("visibility", [0.0, 0.3, 0.5, 1.0])
+def test_restore_face_cv2_matches_restore_face(visibility: float) -> None:
+    img = np.random.default_rng(0).integers(0, 256, (96, 80, 3), dtype=np.uint8)
+    options = restorer_options(visibility)
+
+    expected = restore_face(Image.fromarray(img[:, :, ::-1]), options)  # type: ignore
+    result = restore_face_cv2(img, options)  # type: ignore
+
+    assert result.shape == img.shape
+    # PIL truncates the blend, cv2.addWeighted rounds it
+    diff = result.astype(int) - cv2.cvtColor(np.array(expected), cv2.COLOR_RGB2BGR)
+    assert diff.min() >= 0 and diff.max() <= 1
+
+
+def test_restore_face_cv2_without_restorer() -> None:
+    img = np.zeros((8, 8, 3), dtype=np.uint8)
+    options = SimpleNamespace(face_restorer=None)
+    assert restore_face_cv2(img, options) is img  # type: ignore